@@ -0,0 +1,357 @@
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from prompt_builder import content_text
+
+ARTICLE_STORE = 'articles.sqlite'
+
+
+def compress(text):
+    """
+    Returns (codec, bytes) for {text}, using zstd when it is installed.
+    """
+    data = (text or '').encode('utf-8')
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'zlib', zlib.compress(data, 9)
+
+
+def decompress(codec, data):
+    if data is None:
+        return ''
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+
+class ArticleStore:
+    """
+    SQLite store of outlines and articles, one row per (site, keyword,
+    language), with compressed text bodies and indexes on keyword, site and
+    status. Language '' is the single article written in config["language"];
+    other languages come from the "languages" fan-out.
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, path=ARTICLE_STORE):
+        self.path = path
+        self._lock = threading.Lock()
+        # Wait out other processes writing to a shared store, as job_queue does
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS articles (
+                id INTEGER PRIMARY KEY,
+                site TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                status TEXT NOT NULL,
+                codec TEXT NOT NULL,
+                outline BLOB,
+                article BLOB,
+                updated REAL NOT NULL,
+                language TEXT NOT NULL DEFAULT '',
+                UNIQUE (site, keyword, language)
+            );
+            CREATE INDEX IF NOT EXISTS articles_keyword ON articles (keyword);
+            CREATE INDEX IF NOT EXISTS articles_status ON articles (site, status);
+            CREATE TABLE IF NOT EXISTS failures (
+                site TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                language TEXT NOT NULL DEFAULT '',
+                attempts INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (site, keyword, language)
+            );
+            CREATE TABLE IF NOT EXISTS published (
+                site TEXT NOT NULL,
+                slug TEXT NOT NULL,
+                post_id INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (site, slug)
+            );
+        ''')
+        self._connection.commit()
+
+    def _migrate(self):
+        # Stores made before articles had a language: one row per (site, keyword) becomes language ''
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(articles)')]
+        if not columns or 'language' in columns:
+            return
+        self._connection.executescript('''
+            BEGIN;
+            ALTER TABLE articles RENAME TO articles_old;
+            DROP INDEX IF EXISTS articles_keyword;
+            DROP INDEX IF EXISTS articles_status;
+            CREATE TABLE articles (
+                id INTEGER PRIMARY KEY,
+                site TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                status TEXT NOT NULL,
+                codec TEXT NOT NULL,
+                outline BLOB,
+                article BLOB,
+                updated REAL NOT NULL,
+                language TEXT NOT NULL DEFAULT '',
+                UNIQUE (site, keyword, language)
+            );
+            INSERT INTO articles (id, site, keyword, status, codec, outline, article, updated)
+                SELECT id, site, keyword, status, codec, outline, article, updated FROM articles_old;
+            DROP TABLE articles_old;
+            COMMIT;
+        ''')
+
+    def put(self, site, Keyword, outline, article, status, language=''):
+        """
+        Inserts or replaces the row for ({site}, {Keyword}, {language}) and
+        commits it, so finished articles are on disk as soon as they are written.
+        Assistants message content is stored as its plain text. A failure
+        never replaces a finished ('Yes') row: the finished article is kept
+        and the failure is only counted in the failures table.
+        Returns:
+            bool: False when a finished article was kept instead.
+        """
+        codec, outline_data = compress(content_text(outline))
+        _, article_data = compress(content_text(article))
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                'INSERT INTO articles (site, keyword, language, status, codec, outline, article, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (site, keyword, language) DO UPDATE SET status = excluded.status, '
+                'codec = excluded.codec, outline = excluded.outline, article = excluded.article, '
+                "updated = excluded.updated WHERE articles.status != 'Yes' OR excluded.status = 'Yes'",
+                (site, Keyword, language, status, codec, outline_data, article_data, now))
+            if status == 'Yes':
+                self._connection.execute(
+                    'DELETE FROM failures WHERE site = ? AND keyword = ? AND language = ?',
+                    (site, Keyword, language))
+            else:
+                self._connection.execute(
+                    'INSERT INTO failures (site, keyword, language, attempts, updated) VALUES (?, ?, ?, 1, ?) '
+                    'ON CONFLICT (site, keyword, language) DO UPDATE SET '
+                    'attempts = failures.attempts + 1, updated = excluded.updated',
+                    (site, Keyword, language, now))
+            self._connection.commit()
+        return cursor.rowcount > 0
+
+    def put_row(self, site, row):
+        """
+        put() for a dict with the Keyword, Outline, Article and Processed
+        columns of processed_keywords.csv, and optionally Language.
+        """
+        return self.put(site, row['Keyword'], row['Outline'], row['Article'], row['Processed'],
+                        row.get('Language') or '')
+
+    def failures(self, site):
+        """
+        Returns {(keyword, language): attempts} for rows of {site} whose
+        latest attempt failed, including finished ones that were kept.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT keyword, language, attempts FROM failures WHERE site = ?', (site,)).fetchall()
+        return {(Keyword, language): attempts for Keyword, language, attempts in rows}
+
+    def get(self, site, Keyword, language=''):
+        """
+        Returns the row for ({site}, {Keyword}, {language}) as a dict, or None.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT keyword, status, codec, outline, article, language FROM articles '
+                'WHERE site = ? AND keyword = ? AND language = ?',
+                (site, Keyword, language)).fetchone()
+        return self._row(row) if row else None
+
+    def status(self, site, Keyword, language=''):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT status FROM articles WHERE site = ? AND keyword = ? AND language = ?',
+                (site, Keyword, language)).fetchone()
+        return row[0] if row else None
+
+    def done_keywords(self, site, languages=None):
+        """
+        Keywords of {site} with a finished article in every one of
+        {languages}, or in language '' when none are given.
+        """
+        languages = list(languages or [''])
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT keyword FROM articles WHERE site = ? AND status = 'Yes' AND language IN ({0}) "
+                "GROUP BY keyword HAVING COUNT(DISTINCT language) = ?".format(', '.join('?' * len(languages))),
+                [site] + languages + [len(set(languages))]).fetchall()
+        return {row[0] for row in rows}
+
+    def languages(self, site):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT DISTINCT language FROM articles WHERE site = ? ORDER BY language', (site,)).fetchall()
+        return [row[0] for row in rows]
+
+    def iter_articles(self, site=None, status=None, batch_size=200, language=''):
+        """
+        Yields rows as dicts in insertion order, reading {batch_size} at a
+        time. Only rows in {language} are read, or all of them when it is None.
+        """
+        query = 'SELECT id, keyword, status, codec, outline, article, language FROM articles WHERE id > ?'
+        args = []
+        if language is not None:
+            query += ' AND language = ?'
+            args.append(language)
+        if site is not None:
+            query += ' AND site = ?'
+            args.append(site)
+        if status is not None:
+            query += ' AND status = ?'
+            args.append(status)
+        query += ' ORDER BY id LIMIT ?'
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(query, [last_id] + args + [batch_size]).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                last_id = row[0]
+                yield self._row(row[1:])
+
+    def published(self, site):
+        """
+        Returns {slug: (post_id, digest)} for everything already published
+        for {site}.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT slug, post_id, digest FROM published WHERE site = ?', (site,)).fetchall()
+        return {slug: (post_id, digest) for slug, post_id, digest in rows}
+
+    def mark_published(self, site, slug, post_id, digest):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO published (site, slug, post_id, digest, updated) VALUES (?, ?, ?, ?, ?)',
+                (site, slug, post_id, digest, time.time()))
+            self._connection.commit()
+
+    def _row(self, row):
+        Keyword, status, codec, outline, article, language = row
+        return {
+            'Keyword': Keyword,
+            'Outline': decompress(codec, outline),
+            'Article': decompress(codec, article),
+            'Processed': status,
+            'Language': language,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def site_name(config):
+    return config.get('site') or config.get('business_name', '')
+
+
+def slugify(text):
+    """
+    A URL slug for {text}. Accents are dropped and other letters, such as
+    Cyrillic or CJK, are kept. Text without letters or digits gets a hash,
+    so different keywords never share a slug.
+    """
+    # Marks are only dropped from Latin letters, so "café" becomes "cafe" but "й" stays
+    chars = []
+    for c in unicodedata.normalize('NFKD', text):
+        if not (unicodedata.combining(c) and chars and chars[-1].isascii()):
+            chars.append(c)
+    plain = unicodedata.normalize('NFKC', ''.join(chars))
+    slug = re.sub(r'[\W_]+', '-', plain.lower()).strip('-')
+    return slug or 'article-' + hashlib.sha1(text.encode('utf-8')).hexdigest()[:10]
+
+
+def post_slug(Keyword, language=''):
+    """
+    The slug of the post for {Keyword} in {language}. Articles in
+    config["language"] ('') keep the plain keyword slug.
+    """
+    slug = slugify(Keyword)
+    return f"{slug}-{slugify(language)}" if language else slug
+
+
+def export_csv(store, site, output_file):
+    with open(output_file, 'w', newline='', encoding='utf-8') as f_output:
+        writer = csv.DictWriter(f_output, fieldnames=['Keyword', 'Outline', 'Article', 'Processed', 'Language'])
+        writer.writeheader()
+        count = 0
+        for row in store.iter_articles(site, language=None):
+            writer.writerow(row)
+            count += 1
+    print(f"Exported {count} rows to {output_file}")
+
+
+def export_markdown(store, site, output_dir):
+    # Articles of the "languages" fan-out go into a folder per language
+    count = 0
+    for row in store.iter_articles(site, status='Yes', language=None):
+        language_dir = os.path.join(output_dir, slugify(row['Language'])) if row['Language'] else output_dir
+        os.makedirs(language_dir, exist_ok=True)
+        with open(os.path.join(language_dir, slugify(row['Keyword']) + '.md'), 'w', encoding='utf-8') as f_output:
+            f_output.write(row['Article'])
+        count += 1
+    print(f"Exported {count} articles to {output_dir}")
+
+
+def import_csv(store, site, input_file):
+    """
+    Loads an existing processed_keywords.csv into the store.
+    """
+    csv.field_size_limit(sys.maxsize)
+    count = 0
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            store.put_row(site, row)
+            count += 1
+    print(f"Imported {count} rows from {input_file}")
+
+
+def main(argv):
+    usage = "Usage: python article_store.py export-csv FILE | export-markdown DIR | import-csv FILE"
+    if len(argv) != 3:
+        print(usage)
+        return
+    config = {}
+    if os.path.exists('config.json'):
+        with open('config.json') as config_file:
+            config = json.load(config_file)
+    store = ArticleStore(config.get('article_store', ARTICLE_STORE))
+    site = site_name(config)
+    command, path = argv[1], argv[2]
+    if command == 'export-csv':
+        export_csv(store, site, path)
+    elif command == 'export-markdown':
+        export_markdown(store, site, path)
+    elif command == 'import-csv':
+        import_csv(store, site, path)
+    else:
+        print(usage)
+    store.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,72 @@
+import concurrent.futures
+
+from tqdm import tqdm
+
+import deadline
+from article_store import ArticleStore, ARTICLE_STORE, site_name
+from csv_stream import KeywordRows
+from scheduler import Scheduler, load_estimates
+
+
+def run_batch(config, batch_status, prepare_batch, write_article, rebuild=False,
+              input_file='optimized_keywords.csv'):
+    """
+    Writes an article for every keyword in {input_file} that has none yet,
+    or for every keyword when {rebuild} is set, whichever article script
+    {prepare_batch} and {write_article} come from. Keywords go most valuable
+    first, paced to the provider limits, and each result is stored as soon
+    as it arrives. The keyword file is streamed into the scheduler, so only
+    the keywords still to write are held in memory.
+    Args:
+        config (dict): The loaded config.json.
+        batch_status (BatchStatus): The script's live batch progress.
+        prepare_batch (callable): prepare_batch(keywords) of the script.
+        write_article (callable): write_article(article_store, site, row) of the script.
+    """
+    article_store = ArticleStore(config.get('article_store', ARTICLE_STORE))
+    site = site_name(config)
+
+    # Resume: skip keywords that already have a finished article
+    done = set() if rebuild else article_store.done_keywords(site, config.get('languages'))
+    rows = KeywordRows(input_file, done)
+
+    # Most valuable keywords first, paced to the provider limits
+    scheduler = Scheduler(rows, config, load_estimates(config), done)
+    if rows.skipped:
+        print(f"Skipping {rows.skipped} keywords that are already processed.")
+
+    prepare_batch(scheduler.keywords())
+    print(scheduler.plan())
+    max_workers = config.get('article_workers', 5)
+
+    progress = tqdm(total=len(scheduler), desc="Processing Keywords")
+    added = 0
+    in_flight = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while True:
+                while len(in_flight) < max_workers:
+                    row = scheduler.pop()
+                    if row is None:
+                        break
+                    if scheduler.added > added:
+                        # Urgent keywords from outside the batch
+                        progress.total += scheduler.added - added
+                        batch_status.add(scheduler.added - added)
+                        added = scheduler.added
+                    in_flight.add(executor.submit(write_article, article_store, site, row))
+                if not in_flight:
+                    break
+                done_futures, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done_futures:
+                    future.result()
+                progress.update(len(done_futures))
+        except KeyboardInterrupt:
+            # Running keywords stop at their next check, cancel their runs and store what they have
+            print("Cancelling the batch...")
+            deadline.cancel_all()
+            raise
+    progress.close()
+
+    article_store.close()
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+# "record", "replay" (at recorded speed) or "replay_fast" (zero latency)
+MODE = None
+
+_lock = threading.Lock()
+_connection = None
+_counters = {}
+
+# Headers that describe the wire encoding rather than the stored body
+_DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+
+def install(config):
+    """
+    Records or replays all outbound HTTP traffic, depending on
+    config["cassette_mode"]. Covers requests (Perplexity, Pexels, Freeimage)
+    and httpx, which the OpenAI and Anthropic clients use.
+    Responses are stored zlib-compressed in config["cassette_path"].
+    "record" adds to what the cassette already holds, so every stage script
+    records its own part of a run; "rerecord" empties it first. Only the
+    first call in a process installs anything.
+    """
+    global MODE, _connection
+    mode = config.get('cassette_mode')
+    if not mode:
+        return
+    if mode not in ('record', 'rerecord', 'replay', 'replay_fast'):
+        raise ValueError(f"Unknown cassette_mode: {mode}")
+    if _connection is not None:
+        return
+    path = config.get('cassette_path', 'cassette.sqlite')
+    _connection = sqlite3.connect(path, check_same_thread=False)
+    _connection.execute('''CREATE TABLE IF NOT EXISTS interactions (
+        fingerprint TEXT, seq INTEGER, method TEXT, url TEXT, status INTEGER,
+        headers TEXT, body BLOB, elapsed REAL, PRIMARY KEY (fingerprint, seq))''')
+    if mode == 'rerecord':
+        _connection.execute('DELETE FROM interactions')
+        mode = 'record'
+    _connection.commit()
+    MODE = mode
+    _patch_requests()
+    _patch_httpx()
+    print(f"Cassette {MODE} mode using {path}")
+
+
+def sleep(seconds):
+    """
+    time.sleep, skipped when replaying at zero latency.
+    """
+    if MODE != 'replay_fast':
+        time.sleep(seconds)
+
+
+def fingerprint(method, url, body, content_type):
+    body = body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    match = re.search(r'boundary=([^\s;]+)', content_type or '')
+    if match:
+        # Multipart boundaries are random, so leave them out of the key
+        body = body.replace(match.group(1).encode('utf-8'), b'')
+    digest = hashlib.sha1(body).hexdigest()
+    return hashlib.sha1(f"{method} {url} {digest}".encode('utf-8')).hexdigest()
+
+
+def _next_seq(key):
+    with _lock:
+        seq = _counters.get(key, 0)
+        _counters[key] = seq + 1
+    return seq
+
+
+def _save(key, method, url, status, headers, body, elapsed):
+    headers = {name: value for name, value in headers.items()
+               if name.lower() not in _DROPPED_HEADERS}
+    seq = _next_seq(key)
+    with _lock:
+        _connection.execute('INSERT OR REPLACE INTO interactions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (key, seq, method, url, status, json.dumps(headers),
+                             zlib.compress(body), elapsed))
+        _connection.commit()
+
+
+def _load(key, method, url):
+    seq = _next_seq(key)
+    with _lock:
+        row = _connection.execute(
+            'SELECT status, headers, body, elapsed FROM interactions WHERE fingerprint = ? AND seq <= ? '
+            'ORDER BY seq DESC LIMIT 1', (key, seq)).fetchone()
+    if row is None:
+        raise RuntimeError(f"No recorded response for {method} {url}")
+    status, headers, body, elapsed = row
+    if MODE == 'replay':
+        time.sleep(elapsed)
+    return status, json.loads(headers), zlib.decompress(body), elapsed
+
+
+def _patch_requests():
+    import requests
+    from datetime import timedelta
+    from requests.structures import CaseInsensitiveDict
+
+    original_send = requests.Session.send
+
+    def send(session, request, **kwargs):
+        key = fingerprint(request.method, request.url, request.body,
+                          request.headers.get('Content-Type'))
+        if MODE == 'record':
+            start = time.time()
+            response = original_send(session, request, **kwargs)
+            _save(key, request.method, request.url, response.status_code,
+                  response.headers, response.content, time.time() - start)
+            return response
+
+        status, headers, body, elapsed = _load(key, request.method, request.url)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=elapsed)
+        return response
+
+    requests.Session.send = send
+
+
+def _patch_httpx():
+    try:
+        import httpx
+    except ImportError:
+        return
+
+    original_send = httpx.Client.send
+
+    def send(client, request, **kwargs):
+        body = request.read()
+        key = fingerprint(request.method, str(request.url), body,
+                          request.headers.get('content-type'))
+        if MODE == 'record':
+            start = time.time()
+            response = original_send(client, request, **kwargs)
+            response.read()
+            _save(key, request.method, str(request.url), response.status_code,
+                  dict(response.headers), response.content, time.time() - start)
+            return response
+
+        status, headers, body, elapsed = _load(key, request.method, str(request.url))
+        return httpx.Response(status, headers=headers, content=body, request=request)
+
+    httpx.Client.send = send
@@ -0,0 +1,177 @@
+import atexit
+import concurrent.futures
+import importlib.util
+import math
+import os
+import threading
+
+from article_store import slugify
+from structured import parse_json
+
+CHART_TYPES = ('bar', 'barh', 'line', 'pie')
+
+# Most labels a chart gets, more would not be readable at article size
+MAX_POINTS = 12
+
+CHARTS_DIR = 'charts'
+
+CHART_SPEC_FORMAT = '''Reply with only a JSON array of at most {0} charts, no other text. Each chart is an object:
+{{"type": one of "bar", "barh", "line", "pie", "title": short title, "labels": list of short strings,
+"values": list of numbers of the same length, "unit": unit of the values or ""}}.
+Only use numbers that appear in the research.'''
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def chart_spec_format(count):
+    """
+    Instructions asking the model for {count} chart specs as JSON.
+    """
+    return CHART_SPEC_FORMAT.format(count)
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        value = value.replace(',', '').replace('%', '').replace('$', '').strip()
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def parse_chart_specs(text, limit=3):
+    """
+    The valid chart specs in a model reply, at most {limit}. The reply may
+    wrap the JSON array in a code fence or text. Charts with an unknown
+    type, mismatched labels and values or non-numeric values are dropped.
+    Returns:
+        list: Dicts with type, title, labels, values and unit.
+    """
+    try:
+        charts = parse_json(text)
+    except ValueError:
+        return []
+
+    specs = []
+    for chart in charts if isinstance(charts, list) else []:
+        if not isinstance(chart, dict):
+            continue
+        chart_type = str(chart.get('type', '')).lower()
+        labels = chart.get('labels')
+        values = chart.get('values')
+        if chart_type not in CHART_TYPES or not isinstance(labels, list) or not isinstance(values, list):
+            continue
+        values = [_number(value) for value in values]
+        if not labels or len(labels) != len(values) or None in values:
+            continue
+        if chart_type == 'pie' and (min(values) < 0 or not sum(values)):
+            continue
+        specs.append({
+            'type': chart_type,
+            'title': str(chart.get('title') or '')[:100],
+            'labels': [str(label)[:40] for label in labels[:MAX_POINTS]],
+            'values': values[:MAX_POINTS],
+            'unit': str(chart.get('unit') or '')[:20],
+        })
+        if len(specs) == limit:
+            break
+    return specs
+
+
+def describe_chart(spec):
+    """
+    One line of text for a chart spec, e.g. for a prompt.
+    """
+    unit = f" {spec['unit']}" if spec['unit'] else ''
+    points = ', '.join(f"{label}: {value:g}{unit}" for label, value in zip(spec['labels'], spec['values']))
+    return f"{spec['title']} ({spec['type']} chart) - {points}"
+
+
+def render_chart(spec, path):
+    """
+    Draws one chart spec with matplotlib and saves it to {path}, as SVG or
+    PNG by the file extension. Runs in a worker process.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+
+    # Text stays text in SVG, which keeps the files small
+    matplotlib.rcParams['svg.fonttype'] = 'none'
+    figure, axes = pyplot.subplots(figsize=(6, 3.6))
+    try:
+        labels, values = spec['labels'], spec['values']
+        if spec['type'] == 'pie':
+            axes.pie(values, labels=labels, autopct='%1.0f%%', startangle=90, counterclock=False)
+            axes.axis('equal')
+        elif spec['type'] == 'line':
+            axes.plot(labels, values, marker='o')
+        elif spec['type'] == 'barh':
+            axes.barh(labels, values)
+            axes.invert_yaxis()
+        else:
+            axes.bar(labels, values)
+            if max(len(label) for label in labels) > 8:
+                pyplot.setp(axes.get_xticklabels(), rotation=30, ha='right')
+        if spec['type'] == 'barh':
+            axes.set_xlabel(spec['unit'])
+        elif spec['type'] != 'pie':
+            axes.set_ylabel(spec['unit'])
+        if spec['type'] != 'pie':
+            for side in ('top', 'right'):
+                axes.spines[side].set_visible(False)
+        axes.set_title(spec['title'])
+        figure.tight_layout()
+        if path.endswith('.svg'):
+            figure.savefig(path, format='svg', metadata={'Date': None})
+        else:
+            figure.savefig(path, format='png', dpi=100, pil_kwargs={'optimize': True})
+    finally:
+        pyplot.close(figure)
+    return path
+
+
+def start_pool(max_workers=None):
+    """
+    Starts the process pool charts are rendered in. Call it before the
+    batch's worker threads start, so the rendering processes are forked
+    from the main thread and not from a busy worker.
+    """
+    global _pool
+    if importlib.util.find_spec('matplotlib') is None:
+        print("Rendering charts needs matplotlib, skipping them.")
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+            atexit.register(_pool.shutdown)
+            # The first task starts every worker process
+            _pool.submit(len, '').result()
+        return _pool
+
+
+def render_charts(specs, Keyword, charts_dir=CHARTS_DIR, chart_format='png', max_workers=None):
+    """
+    Renders {specs} for {Keyword} in the shared process pool, starting it
+    if start_pool() was not called.
+    Returns:
+        list: (spec, path) for every chart that rendered.
+    """
+    pool = _pool or start_pool(max_workers)
+    if pool is None:
+        return []
+    os.makedirs(charts_dir, exist_ok=True)
+    paths = [os.path.join(charts_dir, f"{slugify(Keyword)}-{index + 1}.{chart_format}")
+             for index in range(len(specs))]
+    futures = [pool.submit(render_chart, spec, path) for spec, path in zip(specs, paths)]
+    rendered = []
+    for spec, future in zip(specs, futures):
+        try:
+            rendered.append((spec, future.result()))
+        except Exception as exc:
+            print(f"Chart '{spec['title']}' could not be rendered: {exc}")
+    return rendered
@@ -0,0 +1,118 @@
+import atexit
+import csv
+import io
+import threading
+
+# Read and write in blocks this large, so big keyword files take few system calls
+BUFFER_SIZE = 1 << 20
+
+# Rows or lines a ChunkedWriter holds before writing them out
+CHUNK_ROWS = 1000
+
+
+class KeywordRows:
+    """
+    The rows of a keyword CSV, read one at a time as they are iterated, so
+    a file of millions of keywords is never held in memory. Rows without a
+    keyword and rows whose keyword is in {skip} are left out; after a pass,
+    .skipped is the number of rows left out because of {skip}.
+    """
+
+    def __init__(self, path, skip=()):
+        self.path = path
+        self.skip = skip
+        self.skipped = 0
+
+    def __iter__(self):
+        self.skipped = 0
+        with open(self.path, newline='', encoding='utf-8', buffering=BUFFER_SIZE) as csvfile:
+            for row in csv.DictReader(csvfile):
+                if not row['Keyword'].strip():
+                    continue
+                if row['Keyword'] in self.skip:
+                    self.skipped += 1
+                    continue
+                yield row
+
+
+class ChunkedWriter:
+    """
+    Writes CSV rows or text lines to {path} through one handle, opened on
+    the first write. Up to {chunk_rows} of them are held in memory and
+    written out in one go, so many small appends become a few large writes.
+    Safe to share between threads. Whatever is still held is written on
+    flush() and close(), or when the process exits.
+    """
+
+    def __init__(self, path, mode='a', header=None, chunk_rows=CHUNK_ROWS):
+        self.path = path
+        self.mode = mode
+        self.chunk_rows = chunk_rows
+        self._file = None
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._held = 0
+        self._lock = threading.Lock()
+        self._at_exit = False
+        if header is not None:
+            self._writer.writerow(header)
+            self._close_at_exit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        with self._lock:
+            self._close_at_exit()
+            for row in rows:
+                self._writer.writerow(row)
+                self._held += 1
+            if self._held >= self.chunk_rows:
+                self._write()
+
+    def write_lines(self, lines):
+        with self._lock:
+            self._close_at_exit()
+            for line in lines:
+                self._buffer.write(line + '\n')
+                self._held += 1
+            if self._held >= self.chunk_rows:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def close(self):
+        with self._lock:
+            if self._buffer.tell():
+                self._write()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            # Writing after close() appends to the file
+            self.mode = 'a'
+            if self._at_exit:
+                atexit.unregister(self.close)
+                self._at_exit = False
+
+    def _close_at_exit(self):
+        # Only writers holding rows stay registered, so closed ones can be freed
+        if not self._at_exit:
+            atexit.register(self.close)
+            self._at_exit = True
+
+    def _write(self):
+        if self._file is None:
+            self._file = open(self.path, self.mode, newline='', encoding='utf-8', buffering=BUFFER_SIZE)
+        self._file.write(self._buffer.getvalue())
+        self._file.flush()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._held = 0
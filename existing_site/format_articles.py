@@ -1,9 +1,209 @@
+import ast
+import collections
+import concurrent.futures
+import csv
+import html
+import json
+import os
+import re
+import sys
+import time
+
+from article_store import ArticleStore, ARTICLE_STORE, site_name
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+# Rows handed to a worker process at a time
+CHUNK_SIZE = 200
+
+# The repr of Assistants message content, e.g.
+# [TextContentBlock(text=Text(annotations=[], value='# Title\n...'), type='text')]
+VALUE_PATTERN = re.compile(r"value=('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")", re.DOTALL)
+
+# Retrieval citations such as 【7†source】
+CITATION_PATTERN = re.compile(r"\s*【[^】]*】")
+
+
 def replace_newlines(input_string):
     # Replace '\n' with actual new lines
     output_string = input_string.replace("\\n", "\n")
     return output_string
 
-# Example usage:
-input_text = "# Optimizing Your Diet for Colitis Management\n\n### **Key Takeaways**\n\n| **Aspect**                     | **Key Points**                                                                         |\n|-------------------------------|---------------------------------------------------------------------------------------|\n| **Dietary Impact**             | Understanding how diet affects colitis is key to managing symptoms.                   |\n| **Foods to Include**          | Emphasize whole foods, hydration, and safe levels of fiber.                           |\n| **Foods to Limit or Avoid**    | Be mindful of triggers that may worsen symptoms.                                      |\n| **Meal Planning and Prep**     | Preparation is essential for managing a colitis-friendly diet.                        |\n| **Lifestyle Adjustments**      | Incorporate stress management and exercise for better overall management.             |\n\n---\n\n### **Introduction**\n\nFor those navigating the challenges of colitis, adopting a strategic approach to diet can be transformative. While there's no one-size-fits-all diet for colitis, certain dietary modifications can help manage symptoms and improve quality of life.\n\n### **Understanding Colitis and Diet**\n\nColitis, a form of inflammatory bowel disease (IBD), can significantly affect digestive health. Diet plays a critical role in managing colitis symptoms, creating a demand for tailored dietary advice.\n\n### **Foods to Include for Colitis**\n\nA diet rich in fish and vegetables, particularly from a young age, has been linked to a reduced risk of developing ulcerative colitis, highlighting the importance of early dietary choices.\n\n#### **High Nutritional Foods**\nEmphasize whole foods that are rich in nutrients. These include:\n- Leafy greens\n- Lean proteins\n- Fibrous vegetables and fruits, in tolerable amounts\n\n#### **Hydration**\nStay hydrated with options like water and herbal teas, essential for colitis management.\n![Hydration Options](https://images.pexels.com/photos/4021983/pexels-photo-4021983.jpeg?auto=compress&cs=tinysrgb&fit=crop&h=627&w=1200)\n\n#### **Safe Levels of Fiber**\nManage fiber intake carefully, as it can be both beneficial and a trigger for some individuals.\n![Fiber-rich Meal](https://images.pexels.com/photos/6942034/pexels-photo-6942034.jpeg?auto=compress&cs=tinysrgb&fit=crop&h=627&w=1200)\n\n### **Foods to Limit or Avoid**\n\nIdentify personal triggers, which may include dairy, greasy foods, and certain fibrous foods, to better control flare-ups.\n\n### **Tips for Meal Planning and Prep**\n\nOrganize and prepare meals that align with a colitis-friendly diet to help ease digestive discomfort.\n![Meal Preparation](https://images.pexels.com/photos/6942162/pexels-photo-6942162.jpeg?auto=compress&cs=tinysrgb&fit=crop&h=627&w=1200)\n\n### **Lifestyle and Diet Adjustments for Better Management**\n\nIn addition to dietary changes, incorporating stress management techniques and maintaining an active lifestyle can further aid in managing colitis symptoms.\n![Gentle Yoga](https://images.pexels.com/photos/8965139/pexels-photo-8965139.jpeg?auto=compress&cs=tinysrgb&fit=crop&h=627&w=1200)\n\n### **Conclusion**\n\nNavigating colitis requires a comprehensive approach that includes dietary management, understanding personal triggers, and lifestyle adjustments. Emphasizing whole foods, managing hydration and fiber intake, and preparing for mealtime can significantly impact symptom management. Consulting with healthcare providers to tailor dietary approaches is strongly recommended to ensure that patients with colitis can lead a healthier, more comfortable life."
-output_text = replace_newlines(input_text)
-print(output_text)
\ No newline at end of file
+
+def unwrap_message_repr(text):
+    """
+    Returns the text values inside a repr of Assistants message content, or
+    {text} unchanged when it is already plain markdown.
+    """
+    if 'value=' not in text or not re.match(r"\s*\[?\s*\w*(Content|Text)\w*\(", text):
+        return text
+    values = []
+    for literal in VALUE_PATTERN.findall(text):
+        try:
+            values.append(ast.literal_eval(literal))
+        except (ValueError, SyntaxError):
+            values.append(literal[1:-1])
+    return "\n\n".join(values) if values else text
+
+
+def normalize_text(text):
+    text = unwrap_message_repr(text)
+    text = replace_newlines(text).replace("\\t", "\t").replace("\\'", "'").replace('\\"', '"')
+    text = CITATION_PATTERN.sub('', text)
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip() + "\n"
+
+
+def _inline(text):
+    text = html.escape(text, quote=False)
+    text = re.sub(r"!\[([^\]]*)\]\(([^)\s]+)\)", r'<img src="\2" alt="\1">', text)
+    text = re.sub(r"\[([^\]]+)\]\(([^)\s]+)\)", r'<a href="\2">\1</a>', text)
+    text = re.sub(r"\*\*(.+?)\*\*", r"<strong>\1</strong>", text)
+    text = re.sub(r"(?<!\*)\*(?!\s)(.+?)(?<!\s)\*", r"<em>\1</em>", text)
+    return re.sub(r"`([^`]+)`", r"<code>\1</code>", text)
+
+
+def _table(lines):
+    rows = [[cell.strip() for cell in line.strip().strip('|').split('|')] for line in lines]
+    body = [row for row in rows[1:] if not all(re.fullmatch(r":?-+:?", cell) for cell in row)]
+    parts = ["<table>", "<thead><tr>" + "".join(f"<th>{_inline(cell)}</th>" for cell in rows[0]) + "</tr></thead>",
+             "<tbody>"]
+    parts += ["<tr>" + "".join(f"<td>{_inline(cell)}</td>" for cell in row) + "</tr>" for row in body]
+    parts.append("</tbody></table>")
+    return "\n".join(parts)
+
+
+def simple_markdown(text):
+    """
+    A small markdown to HTML converter for headings, paragraphs, lists,
+    tables, rules, images, links and emphasis, used when the markdown
+    package is not installed.
+    """
+    out = []
+    lines = text.split("\n")
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        if not stripped:
+            i += 1
+        elif re.fullmatch(r"(-{3,}|\*{3,}|_{3,})", stripped):
+            out.append("<hr>")
+            i += 1
+        elif re.match(r"#{1,6}\s", stripped):
+            level = len(stripped) - len(stripped.lstrip('#'))
+            out.append(f"<h{level}>{_inline(stripped[level:].strip())}</h{level}>")
+            i += 1
+        elif stripped.startswith('|'):
+            block = []
+            while i < len(lines) and lines[i].strip().startswith('|'):
+                block.append(lines[i])
+                i += 1
+            out.append(_table(block))
+        elif re.match(r"([-*+]|\d+\.)\s", stripped):
+            tag = 'ol' if stripped[0].isdigit() else 'ul'
+            items = []
+            while i < len(lines) and re.match(r"\s*([-*+]|\d+\.)\s", lines[i]):
+                items.append(re.sub(r"^\s*([-*+]|\d+\.)\s+", "", lines[i]))
+                i += 1
+            out.append(f"<{tag}>" + "".join(f"<li>{_inline(item)}</li>" for item in items) + f"</{tag}>")
+        else:
+            block = []
+            while i < len(lines) and lines[i].strip() and not re.match(
+                    r"\s*(#{1,6}\s|\||([-*+]|\d+\.)\s|(-{3,}|\*{3,}|_{3,})\s*$)", lines[i]):
+                block.append(lines[i].strip())
+                i += 1
+            out.append(f"<p>{_inline(' '.join(block))}</p>")
+    return "\n".join(out)
+
+
+def render_html(text):
+    if markdown is not None:
+        return markdown.markdown(text, extensions=['tables'])
+    return simple_markdown(text)
+
+
+def format_chunk(rows):
+    """
+    Formats (Keyword, article, ...) rows into (Keyword, markdown, html, ...)
+    rows, passing any further columns through. Runs in a worker process.
+    """
+    formatted = []
+    for Keyword, article, *extra in rows:
+        text = normalize_text(article or '')
+        formatted.append((Keyword, text, render_html(text), *extra))
+    return formatted
+
+
+def read_articles(input_path, config):
+    """
+    Yields (Keyword, article, language) for every finished article, from
+    the article store or from a processed_keywords.csv file. From the
+    store, only the articles in config["format_language"] are read
+    ('' is config["language"]).
+    """
+    if input_path.endswith('.csv'):
+        csv.field_size_limit(sys.maxsize)
+        with open(input_path, newline='', encoding='utf-8') as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row.get('Processed', 'Yes') == 'Yes':
+                    yield row['Keyword'], row['Article'], row.get('Language') or ''
+    else:
+        store = ArticleStore(input_path)
+        try:
+            for row in store.iter_articles(site_name(config), status='Yes',
+                                           language=config.get('format_language', '')):
+                yield row['Keyword'], row['Article'], row['Language']
+        finally:
+            store.close()
+
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def format_articles(input_path, output_file, config, max_workers=None):
+    """
+    Formats every article with a process pool and writes Keyword, Markdown,
+    HTML and Language columns to {output_file}, one chunk at a time and in input order.
+    At most two chunks per worker are in flight, so memory stays flat.
+    """
+    start = time.time()
+    max_workers = max_workers or os.cpu_count() or 1
+    count = 0
+    with open(output_file, 'w', newline='', encoding='utf-8') as f_output, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        writer = csv.writer(f_output)
+        writer.writerow(['Keyword', 'Markdown', 'HTML', 'Language'])
+        pending = collections.deque()
+        for chunk in chunks(read_articles(input_path, config), config.get('format_chunk_size', CHUNK_SIZE)):
+            pending.append(executor.submit(format_chunk, chunk))
+            if len(pending) >= max_workers * 2:
+                rows = pending.popleft().result()
+                writer.writerows(rows)
+                count += len(rows)
+        while pending:
+            rows = pending.popleft().result()
+            writer.writerows(rows)
+            count += len(rows)
+    print(f"Formatted {count} articles in {time.time() - start:.1f}s, wrote {output_file}")
+
+
+if __name__ == "__main__":
+    config = {}
+    if os.path.exists('config.json'):
+        with open('config.json') as config_file:
+            config = json.load(config_file)
+    input_path = sys.argv[1] if len(sys.argv) > 1 else config.get('article_store', ARTICLE_STORE)
+    output_file = sys.argv[2] if len(sys.argv) > 2 else 'formatted_articles.csv'
+    format_articles(input_path, output_file, config)
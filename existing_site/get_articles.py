@@ -1,116 +1,165 @@
-import os
-import openai
 import time
+
+# Import time is checked by --dry-run against "startup_budget_seconds"
+STARTED = time.time()
+
+import argparse
+import os
+import threading
 import csv
-import requests
-from tqdm import tqdm
 import concurrent.futures
 import json
+import sys
+import cassette
+import deadline
+import metrics
+import providers
+from model_routing import stage_settings, UsageReport
+from status_server import BatchStatus, start_status_server
+from shared_research import SharedResearch
+from article_store import ArticleStore, ARTICLE_STORE, site_name
+from batch_runner import run_batch
+from prompt_builder import build_prompt, content_text, count_tokens, research_text, stage_budget
+from link_validator import LinkIndex, validate_article
+from build_cache import BuildCache, digest, file_digest
+from charts import CHARTS_DIR, chart_spec_format, parse_chart_specs, render_charts, start_pool
+from structured import LINKS_SCHEMA, links_text, response_format, schema_format, structured_reply
+from csv_stream import KeywordRows
+from job_queue import Heartbeat, open_queue, worker_name
+from scheduler import Pacer, URGENT_PRIORITY, keyword_priority, load_estimates
+from providers import assistant_tool_resources, upload_image
+
+# Set by configure(), from config.json or one site's settings
+config = {}
+
+FREEIMAGE_HOST_API_KEY = None
+
+# The OpenAI client and Assistant, created by init_assistant() on first use
+client = None
+assistant = None
+_init_lock = threading.Lock()
+
+# Checked by --dry-run before any API call is made
+REQUIRED_SETTINGS = ['OPENAI_API_TOKEN', 'PERPLEXITY_API_KEY', 'openai_model', 'perplexity_model',
+                     'business_name', 'page_type', 'business_type', 'country', 'language', 'tone']
+# Files given to the Assistant, which --dry-run checks exist
+ASSISTANT_FILES = ['path_to_links_file', 'path_to_plan_csv', 'path_to_example_file_1',
+                   'path_to_example_file_2', 'path_to_website_images']
+
+# Latency and token usage per stage and model
+usage_report = UsageReport()
+
+# Live batch progress, served over HTTP when "status_port" is set
+batch_status = BatchStatus()
+
+# Research shared across topic clusters when "share_research" is set
+shared_research = None
+
+# Allowed image and link URLs, built when "validate_links" is set
+link_index = None
+
+# Stage outputs by a hash of their inputs, unless "build_cache" is null
+build_cache = None
+assistant_key = None
+
+
+def load_config(path='config.json'):
+    """
+    Returns the settings in {path}.
+    """
+    with open(path) as config_file:
+        return json.load(config_file)
 
-# Load configuration from a JSON file
-with open('config.json') as config_file:
-    config = json.load(config_file)
-
-# Set your OpenAI API key from the config file
-OPENAI_API_TOKEN = config["OPENAI_API_TOKEN"]
-print("Setting OpenAI API Key...")
-os.environ["OPENAI_API_KEY"] = OPENAI_API_TOKEN
-
-# Update your Freeimage.host API Key here from the config file
-FREEIMAGE_HOST_API_KEY = config["FREEIMAGE_HOST_API_KEY"]
-
-# Initialize the OpenAI client
-print("Initializing OpenAI client...")
-client = openai.OpenAI()
 
-# Global list to store image URLs
-image_urls = []
+def configure(site_config):
+    """
+    Sets the settings the script runs with, before anything else is called:
+    config.json when it is run or imported by pipeline.py, one site's
+    settings when multi_site.py loads its own copy of the script.
+    """
+    global config, FREEIMAGE_HOST_API_KEY
+    config = site_config
+    metrics.configure(config)
+    cassette.install(config)
+    # Update your Freeimage.host API Key here from the config file
+    FREEIMAGE_HOST_API_KEY = config.get("FREEIMAGE_HOST_API_KEY")
 
 
 def upload_to_freeimage_host(image_path, Keyword):
     """
     Uploads an image to Freeimage.host with {Keyword} in the filename.
-    Also stores the image URL in a global list.
-    """
-    print(f"Uploading {image_path} to Freeimage.host...")
-    with open(image_path, 'rb') as image_file:
-        files = {'source': image_file}
-        data = {
-            'key': FREEIMAGE_HOST_API_KEY,
-            'action': 'upload',
-            'format': 'json',
-            'name': f'{Keyword}_image.png'  # Add {Keyword} in the filename
-        }
-
-        response = requests.post(
-            'https://freeimage.host/api/1/upload', files=files, data=data)
-
-        if response.status_code == 200:
-            url = response.json().get('image', {}).get('url', '')
-            if url:
-                print(f"Uploaded successfully: {url}")
-                # Store both idea and URL
-                image_urls.append({'idea': Keyword, 'url': url})
-                return url
-            else:
-                print("Upload successful but no URL returned, something went wrong.")
-        else:
-            print(
-                f"Failed to upload to Freeimage.host: {response.status_code}, {response.text}")
-    return None
+    Returns:
+        str or None: The image URL, None if the upload failed.
+    """
+    return upload_image(image_path, Keyword, FREEIMAGE_HOST_API_KEY)
 
 
 def upload_file(file_path, purpose):
     print(f"Uploading file: {file_path} for purpose: {purpose}")
-    with open(file_path, "rb") as file:
+    with open(file_path, "rb") as file, metrics.track('openai', None, 'file_upload'):
         response = client.files.create(file=file, purpose=purpose)
     print(f"File uploaded successfully, ID: {response.id}")
     return response.id
 
 
-def clear_image_urls():
+def init_assistant():
     """
-    Clears the global list of image URLs.
+    Creates the OpenAI client, uploads the reference files and creates the
+    Assistant the first time they are needed, so importing this module,
+    --help and --dry-run make no network calls.
     """
-    global image_urls
-    image_urls.clear()
-    print("Cleared global image URLs.")
-
-
-print("Commencing file uploads...")
-# Upload your files using paths from the config file
-internal_links_file_id = upload_file(
-    config["path_to_links_file"], 'assistants')
-content_plan_file_id = upload_file(config["path_to_plan_csv"], 'assistants')
-brand_plan_file_id_1 = upload_file(config["path_to_example_file_1"], 'assistants')
-brand_plan_file_id_2 = upload_file(config["path_to_example_file_2"], 'assistants')
-images_file_id = upload_file(config["path_to_website_images"], 'assistants')
+    global openai, client, assistant
+    with _init_lock:
+        if assistant is not None:
+            return
+        import openai
+
+        # Initialize the OpenAI client with the key from the config file,
+        # unless multi_site.py shares one between sites with the same key
+        if client is None:
+            print("Initializing OpenAI client...")
+            client = openai.OpenAI(api_key=config["OPENAI_API_TOKEN"])
+
+        print("Commencing file uploads...")
+        # Upload your files using paths from the config file
+        files = {config[key]: upload_file(config[key], 'assistants') for key in ASSISTANT_FILES}
+
+        # Create an Assistant
+        print("Creating OpenAI Assistant...")
+
+        assistant = client.beta.assistants.create(
+            name="Content Creation Assistant",
+            model=config["openai_model"],
+            instructions=assistant_instructions(),
+            tools=[{"type": "file_search"}, {"type": "code_interpreter"}],
+            tool_resources=assistant_tool_resources(client, files, f"{site_name(config)} reference files"),
+        )
 
-# Create an Assistant
-print("Creating OpenAI Assistant...")
+        print("Assistant created successfully.")
 
-args = (config['business_name'],
-        config['path_to_website_images'],
-        config['path_to_links_file'],
-        config['path_to_example_file_1'],
-        config['page_type'],
-        config['business_type'],
-        config['country'],
-        config['language'],
-        config['path_to_example_file_2'],
-        )
 
-assistant = client.beta.assistants.create(
-    name="Content Creation Assistant",
-    model = config["openai_model"],
-    instructions='''
+def assistant_instructions():
+    """
+    The Assistant's instructions, filled in from config.json.
+    """
+    args = (config['business_name'],
+            config['path_to_website_images'],
+            config['path_to_links_file'],
+            config['path_to_example_file_1'],
+            config['page_type'],
+            config['business_type'],
+            config['country'],
+            config['language'],
+            config['path_to_example_file_2'],
+            )
+    return '''
         You are writing for {0}. 
         Choose product images and internal links from {1} 
         and {2} and embed them with markdown in the final article.
         You must never EVER invent internal links or image links as this can destroy my SEO. 
         YOU MUST INCLUDE INTERNAL LINKS FROM {2} - 
         read this first and make sure to include real internal links in the final article in the blog post. 
-        When told to use retrieval use retrieval, when told to use code_interpreter use code interpreter. 
+        When told to use file_search use file_search, when told to use code_interpreter use code interpreter. 
         The final content should include internal links and embedded product images from 
         {1} and should include formatting. Your basic steps are: 1. 
         read {1}, get the image, create some visualizations of data, 
@@ -128,29 +177,111 @@ assistant = client.beta.assistants.create(
         Pick 5 strictly relevant brand images and internal links for the articles. 
         First, read the attached files, then create a detailed outline for a {4}, 
         including up to 5 highly relevant internal collection links and brand image links.
-    '''.format(*args),
-    tools=[{"type": "retrieval"}, {"type": "code_interpreter"}],
-    file_ids=[internal_links_file_id, content_plan_file_id,
-              brand_plan_file_id_1, brand_plan_file_id_2, images_file_id]
-)
+    '''.format(*args)
 
-print("Assistant created successfully.")
+
+def assistant_fingerprint():
+    """
+    Hash of everything the Assistant is built from, its instructions and
+    the contents of the files it is given. Part of the build cache key of
+    every Assistant reply.
+    """
+    return digest([assistant_instructions(), [file_digest(config.get(key)) for key in ASSISTANT_FILES]])
 
 
 def wait_for_run_completion(thread_id, run_id, timeout=300):
+    """
+    Polls the run until it completes. The run is cancelled when it takes
+    longer than {timeout} seconds, the keyword's deadline passes or the
+    batch is cancelled, so it stops using tokens.
+    """
     print(
         f"Waiting for run completion, thread ID: {thread_id}, run ID: {run_id}")
     start_time = time.time()
-    while time.time() - start_time < timeout:
-        run_status = client.beta.threads.runs.retrieve(
-            thread_id=thread_id, run_id=run_id)
-        if run_status.status == 'completed':
-            print("Run completed successfully.")
-            return run_status
-        time.sleep(10)
+    try:
+        while time.time() - start_time < timeout:
+            deadline.check('the assistant run')
+            run_status = client.beta.threads.runs.retrieve(
+                thread_id=thread_id, run_id=run_id)
+            if run_status.status == 'completed':
+                print("Run completed successfully.")
+                return run_status
+            if run_status.status in ('failed', 'cancelled', 'expired'):
+                raise RuntimeError(f"Run ended with status {run_status.status}.")
+            deadline.sleep(min(10, max(timeout - (time.time() - start_time), 0)))
+    except deadline.DeadlineExceeded:
+        cancel_run(thread_id, run_id)
+        raise
+    cancel_run(thread_id, run_id)
     raise TimeoutError("Run did not complete within the specified timeout.")
 
 
+def cancel_run(thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        print(f"Cancelled run {run_id}.")
+    except Exception as exc:
+        print(f"Could not cancel run {run_id}: {exc}")
+
+
+def run_stage(thread_id, stage, content, schema=None):
+    """
+    Posts a message to the thread and runs the assistant with the model and
+    max_tokens configured for {stage} in "openai_stage_models". With
+    "structured_output" set, the reply is constrained to {schema}, or to
+    JSON for models without Structured Outputs.
+    Returns the thread messages once the run has completed.
+    """
+    model, max_tokens = stage_settings(
+        config, "openai_stage_models", stage, config["openai_model"])
+    deadline.check(stage)
+    run_args = {'model': model}
+    if max_tokens:
+        run_args['max_completion_tokens'] = max_tokens
+    output_format = stage_response_format(stage, schema, model)
+    if output_format:
+        run_args['response_format'] = output_format
+
+    with metrics.track('openai', model, stage, report=usage_report) as call:
+        client.beta.threads.messages.create(
+            thread_id=thread_id, role="user", content=content)
+        raw_run = client.beta.threads.runs.with_raw_response.create(
+            thread_id=thread_id, assistant_id=assistant.id, **run_args)
+        call['rate_limit'] = metrics.rate_limits(raw_run.headers)
+        run = raw_run.parse()
+        run_status = wait_for_run_completion(thread_id, run.id)
+        if getattr(run_status, 'usage', None):
+            call['input_tokens'] = run_status.usage.prompt_tokens
+            call['output_tokens'] = run_status.usage.completion_tokens
+    return client.beta.threads.messages.list(thread_id=thread_id)
+
+
+def stage_response_format(stage, schema, model):
+    # The response_format a run of {stage} asks for, None for free text
+    if schema and config.get('structured_output'):
+        return response_format(stage, schema, model)
+    return None
+
+
+def stage_reply(thread_id, stage, content, schema=None):
+    """
+    The assistant's reply text to {content} in {stage}. Served from the
+    build cache when the same request was answered before with the same
+    model settings, response format and Assistant.
+    """
+    def run():
+        messages = run_stage(thread_id, stage, content, schema)
+        return content_text(next((m.content for m in messages.data if m.role == "assistant"), None))
+
+    if build_cache is None:
+        return run()
+    model, max_tokens = stage_settings(
+        config, "openai_stage_models", stage, "gpt-4-turbo-preview")
+    return build_cache.get_or_compute(
+        stage, [metrics.current_keyword(), content, model, max_tokens, assistant_key,
+                stage_response_format(stage, schema, model)], run)
+
+
 def perplexity_research(Keyword, max_retries=3, delay=5):
     """
     Conducts perplexity research with retries on failure.
@@ -162,7 +293,6 @@ def perplexity_research(Keyword, max_retries=3, delay=5):
         dict or None: The response from the API or None if failed.
     """
     print(f"Starting perplexity research for: {Keyword}")
-    url = "https://api.perplexity.ai/chat/completions"
     payload = {
         "model": config["perplexity_model"],
         "messages": [
@@ -176,173 +306,538 @@ def perplexity_research(Keyword, max_retries=3, delay=5):
             }
         ]
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {config['PERPLEXITY_API_KEY']}"
-    }
-
-    for attempt in range(max_retries):
-        response = requests.post(url, json=payload, headers=headers, verify=False)
-        if response.status_code == 200:
-            print("Perplexity research completed successfully.")
-            try:
-                return response.json()
-            except ValueError:
-                print("JSON decoding failed")
-                return None
-        else:
-            print(
-                f"Perplexity research failed with status code: {response.status_code}. Attempt {attempt + 1} of {max_retries}.")
-            time.sleep(delay)
-
-    print("Perplexity research failed after maximum retries.")
-    return None
+    return providers.perplexity_research(
+        payload, config['PERPLEXITY_API_KEY'], build_cache, usage_report, max_retries, delay)
 
 
 def get_internal_links(thread_id, Keyword):
+    """
+    Asks for the internal pages and brand images relevant to {Keyword} as
+    JSON, asking once more when the reply is not valid.
+    Returns:
+        str: The chosen links and images as markdown, one per line.
+    """
     print(f"Fetching internal links relevant to: {Keyword}")
-    get_request = f"Use Retrieval. Read brandimages.txt and internal_links.txt, Choose 5 relevant pages and their links that are relevant to {Keyword}. Don't have more than 5. Now read brandimages.txt - choose 5 relevant product images to this article"
-    client.beta.threads.messages.create(
-        thread_id=thread_id, role="user", content=get_request)
-    get_request_run = client.beta.threads.runs.create(
-        thread_id=thread_id, assistant_id=assistant.id)
-    wait_for_run_completion(thread_id, get_request_run.id)
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    print("Internal links fetched successfully.")
-    return next((m.content for m in messages.data if m.role == "assistant"), None)
-
-
-def create_data_vis(thread_id, perplexity_research, Keyword):
-    print("Creating data visualizations...")
-    for _ in range(3):  # Loop to generate 3 visualizations
-        get_request = f"Use Code Interpreter - invent a VERY simple Visualization of some interesting data from {perplexity_research}."
-        client.beta.threads.messages.create(
-            thread_id=thread_id, role="user", content=get_request)
-        get_request_run = client.beta.threads.runs.create(
-            thread_id=thread_id, assistant_id=assistant.id)
-        wait_for_run_completion(thread_id, get_request_run.id)
-
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
+    get_request = f"Use file_search. Read brandimages.txt and internal_links.txt, Choose 5 relevant pages and their links that are relevant to {Keyword}. Don't have more than 5. Now read brandimages.txt - choose 5 relevant product images to this article. {schema_format(LINKS_SCHEMA)}"
+    reply = structured_reply(lambda content: stage_reply(thread_id, 'links', content, LINKS_SCHEMA),
+                             get_request, LINKS_SCHEMA, 'links')
+    links = links_text(reply['links'], 10, link_index) if reply else ''
+    print(f"Fetched {len(links.splitlines())} internal links and images.")
+    return links
 
-        if hasattr(messages.data[0].content[0], 'image_file'):
-            file_id = messages.data[0].content[0].image_file.file_id
 
-            image_data = client.files.content(file_id)
-            image_data_bytes = image_data.read()
-
-            image_path = f"./visualization_image_{_}.png"
-            with open(image_path, "wb") as file:
-                file.write(image_data_bytes)
-
-            print(f"Visualization {_+1} created, attempting upload...")
-            upload_to_freeimage_host(image_path, Keyword)
-        else:
-            print(
-                f"No image file found in response for visualization {_+1}. Attempt aborted.")
+def create_data_vis(thread_id, research_info, Keyword):
+    """
+    Asks for up to config["chart_count"] simple charts of figures from the
+    research as JSON specs in one call, renders them locally and uploads
+    them, so they are among the images the outline and article can use.
+    Returns:
+        list: The URLs of the uploaded charts.
+    """
+    print("Creating data visualizations...")
+    count = config.get('chart_count', 3)
+    request = build_prompt('visualization', "Choose up to {0} VERY simple charts of interesting data from Research.\n{1}".format(
+        count, chart_spec_format(count)),
+        [('Research', research_info)],
+        stage_budget(config, 'visualization'))
+    specs = parse_chart_specs(stage_reply(thread_id, 'visualization', request), count)
+    rendered = render_charts(specs, Keyword, config.get('charts_dir', CHARTS_DIR), config.get('chart_format', 'png'))
+    uploaded = [url for url in (upload_to_freeimage_host(path, Keyword) for _, path in rendered) if url]
+    print(f"Created {len(uploaded)} of {len(specs)} charts.")
+    return uploaded
+
+
+def fix_links(thread_id, section, bad_urls, internal_links_text):
+    """
+    Asks the assistant to rewrite one article section without the URLs in
+    {bad_urls}, which are not on the site. Much cheaper than rewriting the
+    whole article.
+    """
+    print(f"Regenerating a section with {len(bad_urls)} unknown links...")
+    request = build_prompt('fix_links', '''The Section below uses these links that do not exist: {0}.
+    Rewrite the Section so it only uses image links and internal links from Brand images, or none at all.
+    Keep everything else the same. Reply with only the rewritten Section in markdown.'''.format(
+        ", ".join(bad_urls)),
+        [('Section', section),
+         ('Brand images', internal_links_text)],
+        stage_budget(config, 'fix_links'))
+    return stage_reply(thread_id, 'fix_links', request)
+
+
+def outline_prompt(Keyword, internal_links_text, images_for_request, research_info, secondary_keywords=''):
+    return build_prompt('outline', f"Use file_search. Look at brandimages.txt and internal_links.txt. Create a SHORT outline for a {config['page_type']} about '{Keyword}' based on the Research below. Do not invent image links. Use images from brandimages.txt and the internal links from Internal links and include the custom graphs from Custom images. In the outline do not use sources or footnotes, but just add a relevant product images in a relevant section, and a relevant internal link in a relevant section. There is no need for a lot of sources, each article needs a minimum of 5 brand images and internal links.",
+        [('Internal links', internal_links_text),
+         ('Custom images', images_for_request),
+         ('Research', research_info),
+         ('Secondary keywords to also cover', secondary_keywords)],
+        stage_budget(config, 'outline'))
+
+
+def article_prompt(outline_text, internal_links_text, images_for_request, research_info, secondary_keywords='',
+                   language=None):
+    return build_prompt('article', f"Please include images from brandimages.txt. Write a short, snappy article in {language or config['language']} Write at a grade 7 level. ONLY USE INTERNAL LINKS FROM Internal links and Outline. You never invent internal links or image links. Include highly specific information from Research. Do not use overly creative or crazy language. Use a {config['tone']} tone of voice. Write as if writing for The Guardian newspaper.. Just give information. Don't write like a magazine. Use simple language. Do not invent image links. You are writing from a first person plural perspective for the business, refer to it in the first person plural. Add a key takeaway table at the top of the article, summarzing the main points. Never invent links or brand images Choose 3 internal links and 3 images that are relevant to a pillar page and then create a pillar page with good formatting based on the Outline. Title should be around 60 characters. Include the brand images and internal links to other pillar pages naturally and with relevance inside the {config['page_type']}. Use markdown formatting and ensure to use tables and lists to add to formatting. Use 3 relevant brand images and pillar pages with internal links maximum. Never invent any internal links. Include all of the internal links and brand images from the Outline. Use different formatting to enrich the pillar page. Always include a table at the very top wtih key takeaways, also include lists to make more engaging content. Use Custom images with the image name inside [] and with their link in order to enrich the content. The end product shuold look like {config['path_to_example_file_1']} and {config['path_to_example_file_2']} as an example",
+        [('Outline', outline_text),
+         ('Internal links', internal_links_text),
+         ('Custom images', images_for_request),
+         ('Research', research_info),
+         ('Secondary keywords to also cover', secondary_keywords)],
+        stage_budget(config, 'article'))
+
+
+def translate_article(thread_id, article, language):
+    """
+    Translates a finished article into {language}, keeping its markdown,
+    links and images as they are.
+    """
+    request = build_prompt('translate', '''Translate the Article below into {0}.
+    Keep the markdown formatting, tables, image links and internal links exactly as they are.
+    Reply with only the translated Article.'''.format(language),
+        [('Article', article)],
+        stage_budget(config, 'translate'))
+    return stage_reply(thread_id, 'translate', request)
 
 
-def process_blog_post(thread_id, Keyword):
+def prepare_post(thread_id, Keyword, secondary_keywords=''):
+    """
+    Research, link selection and outline for {Keyword}, everything an
+    article needs before it is written in a given language.
+    Returns:
+        dict: The outline and the context the article prompt is built from.
+    """
     print(f"Processing blog post for: {Keyword}")
-    research_results = perplexity_research(Keyword)
-    research_info = str(research_results)
+    metrics.set_keyword(Keyword)
+    batch_status.start(Keyword)
+    if shared_research is not None:
+        research_info = shared_research.research_info(Keyword)
+    else:
+        research_info = research_text(perplexity_research(Keyword))
 
-    # create_data_vis(thread_id, research_info, Keyword)
+    # This keyword's own charts, never shared with the other workers
+    relevant_image_urls = []
+    if config.get('render_charts'):
+        relevant_image_urls = create_data_vis(thread_id, research_info, Keyword)
 
-    internal_links = get_internal_links(thread_id, Keyword)
+    internal_links_text = get_internal_links(thread_id, Keyword)
 
-    # Only include relevant image URLs for the current blog post idea
-    relevant_image_urls = [img['url']
-                           for img in image_urls if img['idea'] == Keyword]
     images_for_request = " ".join(relevant_image_urls)
 
-    outline_request = f"Use retrieval. Look at brandimages.txt and internal_links.txt. Create a SHORT outline for a {config['page_type']} based on {perplexity_research}. Do not invent image links. use images from bradnimages.txt and internal links from {internal_links} and the include the custom graphs from {images_for_request} and use them to create an outline for a {config['page_type']} about {Keyword}' In the outline do not use sources or footnotes, but just add a relevant product images in a relevant section, and a relevant internal link in a relevant section. There is no need for a lot of sources, each article needs a minimum of 5 brand images and internal links."
+    outline_request = outline_prompt(
+        Keyword, internal_links_text, images_for_request, research_info, secondary_keywords)
+
+    outline = stage_reply(thread_id, 'outline', outline_request)
+    return {
+        'Keyword': Keyword,
+        'outline': outline,
+        'research_info': research_info,
+        'internal_links_text': internal_links_text,
+        'images_for_request': images_for_request,
+        'relevant_image_urls': relevant_image_urls,
+        'secondary_keywords': secondary_keywords,
+    }
 
-    client.beta.threads.messages.create(
-        thread_id=thread_id, role="user", content=outline_request)
-    outline_run = client.beta.threads.runs.create(
-        thread_id=thread_id, assistant_id=assistant.id)
-    wait_for_run_completion(thread_id, outline_run.id)
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    outline = next(
-        (m.content for m in messages.data if m.role == "assistant"), None)
 
-    article = None
-    if outline:
-        article_request = f"Please include images from brandimages.txt. Write a short, snappy article in {config['language']} Write at a grade 7 level. ONLY USE INTERNAL LINKS FROM {internal_links} You never invent internal links or image links. Also include real internal links from internal_links.txt. Include highly specific information from {research_results}. Do not use overly creative or crazy language. Use a {config['tone']} tone of voice. Write as if writing for The Guardian newspaper.. Just give information. Don't write like a magazine. Use simple language. Do not invent image links. You are writing from a first person plural perspective for the business, refer to it in the first person plural. Add a key takeaway table at the top of the article, summarzing the main points. Never invent links or brand images Choose 3 internal links and 3 images that are relevant to a pillar page and then create a pillar page with good formatting based on the following outline:\n{outline}, Title should be around 60 characters. Include the brand images and internal links to other pillar pages naturally and with relevance inside the {config['page_type']}. Use markdown formatting and ensure to use tables and lists to add to formatting. Use 3 relevant brand images and pillar pages with internal links maximum. Never invent any internal links.  Include all of the internal links and brand images from {outline} Use different formatting to enrich the pillar page. Always include a table at the very top wtih key takeaways, also include lists to make more engaging content. Use Based on the outline: {outline}, create an article. Use {images_for_request} with the image name inside [] and with the link from {images_for_request} in order to enrich the content, create a pillar page about this topic. Use the brand images from brandimages.txt and internal links gathered from {internal_links}. Use {research_info} to make the  more relevant. The end product shuold look like {config['path_to_example_file_1']} and {config['path_to_example_file_2']} as an example"
-        client.beta.threads.messages.create(
-            thread_id=thread_id, role="user", content=article_request)
-        article_run = client.beta.threads.runs.create(
-            thread_id=thread_id, assistant_id=assistant.id)
-        wait_for_run_completion(thread_id, article_run.id)
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        article = next(
-            (m.content for m in messages.data if m.role == "assistant"), None)
+def write_post(thread_id, post, language=None):
+    """
+    Writes the article for a prepared {post} in {language}
+    (config["language"] by default) and checks its links.
+    """
+    if not post['outline']:
+        return None
+    article_request = article_prompt(
+        content_text(post['outline']), post['internal_links_text'], post['images_for_request'],
+        post['research_info'], post['secondary_keywords'], language)
+
+    article = stage_reply(thread_id, 'article', article_request)
+
+    if article and link_index is not None:
+        article, report = validate_article(
+            content_text(article), link_index,
+            lambda section, bad_urls: fix_links(thread_id, section, bad_urls, post['internal_links_text']),
+            post['relevant_image_urls'])
+        print(f"Checked {report['links']} links: {report['invalid']} unknown, "
+              f"{report['sections']} sections regenerated, {report['stripped']} links removed.")
+    return article
+
+
+def process_blog_post(thread_id, Keyword, secondary_keywords=''):
+    post = prepare_post(thread_id, Keyword, secondary_keywords)
+    try:
+        article = write_post(thread_id, post)
+    except Exception as exc:
+        # The outline is kept, and stays in the build cache for the next attempt
+        print(f"Writing the article for {Keyword} failed: {exc}")
+        article = None
 
     if article:
         print("Article created successfully.")
-        clear_image_urls()  # Call the new function here to clear the image URLs
     else:
         print("Failed to create an article.")
-    return outline, article
-
-
-def process_keywords_concurrent():
-    input_file = 'optimized_keywords.csv'
-    output_file = 'processed_keywords.csv'
-
-    # Corrected fieldnames array to include a missing comma and ensure it matches expected output
-    fieldnames = ['Keyword', 'Outline', 'Article', 'Processed']
-
-    # Read all rows to be processed
-    with open(input_file, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        rows_to_process = [row for row in reader]
-
-    # Process each blog post idea concurrently
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_row = {executor.submit(process_blog_post, client.beta.threads.create(
-        ).id, row['Keyword']): row for row in rows_to_process}
-
-        # Initialize tqdm progress bar
-        progress = tqdm(concurrent.futures.as_completed(future_to_row), total=len(
-            rows_to_process), desc="Processing Keywords")
-
-        # Collect results first to avoid writing to the file inside the loop
-        results = []
-        for future in progress:
-            row = future_to_row[future]
-            try:
-                # Assuming this returns an outline and an article
-                outline, article = future.result()
-                # Create a new dictionary for CSV output to ensure it matches the specified fieldnames
-                processed_row = {
-                    'Keyword': row['Keyword'],
-                    'Outline': outline,
-                    'Article': article,
-                    'Processed': 'Yes'
-                }
-                results.append(processed_row)
-            except Exception as exc:
-                print(
-                    f'Keyword {row["Keyword"]} generated an exception: {exc}')
-                # Handle failed processing by marking as 'Failed' but still match the fieldnames
-                processed_row = {
-                    'Keyword': row['Keyword'],
-                    'Outline': '',  # or you might use 'N/A' or similar placeholder
-                    'Article': '',  # same as above
-                    'Processed': 'Failed'
-                }
-                results.append(processed_row)
-
-    # Write all results to the output file after processing
-    # Use 'w' to overwrite or create anew
-    with open(output_file, 'w', newline='', encoding='utf-8') as f_output:
-        writer = csv.DictWriter(f_output, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
+    return post['outline'], article
+
+
+def process_blog_post_languages(thread_id, Keyword, languages, secondary_keywords=''):
+    """
+    Does research, link selection and the outline for {Keyword} once, then
+    writes the article in each of {languages} at the same time, every one on
+    its own thread. With "language_mode": "translate" the article is written
+    once in config["language"] and translated instead.
+    Returns:
+        tuple: (outline, {language: article})
+    """
+    post = prepare_post(thread_id, Keyword, secondary_keywords)
+    if not post['outline']:
+        print("Failed to create an outline.")
+        return post['outline'], {}
+
+    base_article = None
+    if config.get('language_mode') == 'translate':
+        try:
+            base_article = write_post(thread_id, post)
+        except Exception as exc:
+            print(f"Writing the article for {Keyword} failed: {exc}")
+            base_article = ''
+
+    expires = deadline.expires()
+
+    def write(language):
+        metrics.set_keyword(Keyword)
+        deadline.restore(expires)
+        try:
+            if base_article is None:
+                return write_post(client.beta.threads.create().id, post, language)
+            if not base_article or language == config['language']:
+                return base_article
+            return translate_article(client.beta.threads.create().id, content_text(base_article), language)
+        except Exception as exc:
+            print(f"Writing the {language} article for {Keyword} failed: {exc}")
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(languages)) as executor:
+        articles = dict(zip(languages, executor.map(write, languages)))
+    print(f"Articles created in {len([a for a in articles.values() if a])} of {len(languages)} languages.")
+    return post['outline'], articles
+
+
+def prepare_batch(keywords=None):
+    """
+    Sets up shared research, the link index, the build cache and the status
+    server for a batch. Shared research needs the whole list of {keywords}
+    up front.
+    """
+    global shared_research
+    if config.get('share_research'):
+        if keywords is None:
+            print("share_research needs the whole keyword list up front, skipping it.")
+        else:
+            shared_research = SharedResearch(
+                keywords, perplexity_research,
+                config.get('research_cluster_threshold', 0.4), config.get('research_cluster_size', 8))
+
+    global link_index
+    if config.get('validate_links'):
+        link_index = LinkIndex.from_config(config)
+        if not link_index.urls:
+            print("No image or link URLs found, skipping link validation.")
+            link_index = None
+
+    if config.get('render_charts'):
+        start_pool()
+
+    global build_cache, assistant_key
+    if build_cache is None:
+        build_cache = BuildCache.from_config(config)
+    assistant_key = assistant_fingerprint()
+
+    batch_status.begin(len(keywords or ()))
+    start_status_server(batch_status, config.get('status_port'))
+
+
+def write_article(article_store, site, row):
+    """
+    Writes the article for {row} on a new thread and stores it, marked
+    'Failed' if anything goes wrong. With config["languages"] set, writes
+    and stores one article per language that is not done yet. The keyword
+    gets config["keyword_deadline_seconds"] end to end; a failed row keeps
+    the outline if there was one, and never replaces an article finished
+    in an earlier run, e.g. with --rebuild.
+    Returns:
+        dict: The stored row, for the first language when there are several,
+        'Failed' if any of them failed.
+    """
+    deadline.start(config.get('keyword_deadline_seconds'))
+    languages = config.get('languages')
+    if languages:
+        return write_article_languages(article_store, site, row, languages)
+    try:
+        # A failed upload or Assistant fails this keyword, and the next one tries again
+        init_assistant()
+        outline, article = process_blog_post(
+            client.beta.threads.create().id, row['Keyword'], row.get('Secondary Keywords', ''))
+        processed_row = {
+            'Keyword': row['Keyword'],
+            'Outline': outline or '',
+            'Article': article or '',
+            'Processed': 'Yes' if article else 'Failed'
+        }
+    except Exception as exc:
+        print(
+            f'Keyword {row["Keyword"]} generated an exception: {exc}')
+        processed_row = {
+            'Keyword': row['Keyword'],
+            'Outline': '',
+            'Article': '',
+            'Processed': 'Failed'
+        }
+    if not article_store.put_row(site, processed_row):
+        print(f"Kept the finished article for {row['Keyword']} from an earlier run.")
+    batch_status.finish(row['Keyword'], ok=processed_row['Processed'] == 'Yes')
+    return processed_row
+
+
+def write_article_languages(article_store, site, row, languages):
+    # Languages finished in an earlier run come back from the build cache at no cost
+    try:
+        init_assistant()
+        outline, articles = process_blog_post_languages(
+            client.beta.threads.create().id, row['Keyword'], languages, row.get('Secondary Keywords', ''))
+    except Exception as exc:
+        print(
+            f'Keyword {row["Keyword"]} generated an exception: {exc}')
+        outline, articles = '', {}
+
+    processed_rows = []
+    for language in languages:
+        article = articles.get(language)
+        processed_rows.append({
+            'Keyword': row['Keyword'],
+            'Outline': outline or '',
+            'Article': article or '',
+            'Processed': 'Yes' if article else 'Failed',
+            'Language': language
+        })
+        if not article_store.put_row(site, processed_rows[-1]):
+            print(f"Kept the finished {language} article for {row['Keyword']} from an earlier run.")
+    ok = all(processed_row['Processed'] == 'Yes' for processed_row in processed_rows)
+    batch_status.finish(row['Keyword'], ok=ok)
+
+    return dict(processed_rows[0], Processed='Yes' if ok else 'Failed')
+
+
+def process_keywords_concurrent(rebuild=False):
+    """
+    Writes an article for every keyword in optimized_keywords.csv that has
+    none yet, or for every keyword when {rebuild} is set. Stage results
+    whose inputs did not change since the last run come from the build cache.
+    """
+    run_batch(config, batch_status, prepare_batch, write_article, rebuild)
+
+    usage_report.print_summary()
+    if build_cache is not None:
+        build_cache.print_report()
+
+
+def enqueue_keywords(input_file='optimized_keywords.csv'):
+    """
+    Adds the keywords in {input_file} to the shared job queue for workers.
+    """
+    site = site_name(config)
+    job_queue = open_queue(config)
+    column = config.get('priority_column', 'Score')
+    added = job_queue.enqueue(site, KeywordRows(input_file), lambda row: keyword_priority(row, column))
+    print(f"Queued {added} new keywords. Jobs by status: {job_queue.counts(site)}")
+    job_queue.close()
+
+
+def enqueue_urgent(keywords):
+    """
+    Puts {keywords} at the front of the shared job queue, adding them if
+    they are not in it yet.
+    """
+    site = site_name(config)
+    job_queue = open_queue(config)
+    job_queue.prioritize(site, [{'Keyword': Keyword} for Keyword in keywords], URGENT_PRIORITY)
+    print(f"Moved {len(keywords)} keywords to the front. Jobs by status: {job_queue.counts(site)}")
+    job_queue.close()
+
+
+def run_worker():
+    """
+    Claims keywords from the shared job queue and writes their articles until
+    no job is left. Any number of workers can run at once on the host that
+    holds the job queue and article store: both are SQLite files in WAL
+    mode, which is not safe on a network filesystem. Leases are renewed while
+    an article is being written; the jobs of a worker that dies go back to
+    the queue when its leases expire.
+    """
+    site = site_name(config)
+    job_queue = open_queue(config)
+    article_store = ArticleStore(config.get('article_store', ARTICLE_STORE))
+    worker = worker_name()
+    lease_seconds = config.get('job_lease_seconds', 600)
+    poll_seconds = config.get('job_poll_seconds', 5)
+    max_workers = config.get('article_workers', 5)
+    heartbeat = Heartbeat(job_queue, worker, lease_seconds)
+    # The provider limits are shared by every worker on the queue
+    interval = load_estimates(config).start_interval(config.get('provider_requests_per_minute'))
+    pacer = Pacer()
+    prepare_batch()
+    print(f"Worker {worker} started.")
+
+    in_flight = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while True:
+                if len(in_flight) < max_workers:
+                    jobs = job_queue.claim(site, worker, lease_seconds, max_workers - len(in_flight))
+                    workers = max(job_queue.workers(site), 1)
+                    for job_id, _ in jobs:
+                        heartbeat.add(job_id)
+                    for job_id, row in jobs:
+                        pacer.wait(interval * workers)
+                        batch_status.add(1)
+                        in_flight[executor.submit(write_article, article_store, site, row)] = job_id
+                if not in_flight:
+                    counts = job_queue.counts(site)
+                    if not counts.get('pending') and not counts.get('leased'):
+                        break
+                    # Other workers hold the rest; their leases may still expire
+                    time.sleep(poll_seconds)
+                    continue
+                done, _ = concurrent.futures.wait(
+                    in_flight, timeout=poll_seconds, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job_id = in_flight.pop(future)
+                    heartbeat.remove(job_id)
+                    ok = future.result()['Processed'] == 'Yes'
+                    job_queue.complete(job_id, worker, ok, None if ok else 'article failed')
+        except KeyboardInterrupt:
+            # Unfinished jobs go back to the queue when their leases expire
+            print("Cancelling the worker...")
+            deadline.cancel_all()
+            raise
+
+    heartbeat.stop()
+    print(f"Worker {worker} finished. Jobs by status: {job_queue.counts(site)}")
+    job_queue.close()
+    article_store.close()
+
+    usage_report.print_summary()
+    if build_cache is not None:
+        build_cache.print_report()
+
+
+def is_placeholder(value):
+    return not value or 'YOUR_' in str(value) or str(value).endswith('_HERE')
+
+
+def dry_run(input_file='optimized_keywords.csv', config_path='config.json'):
+    """
+    Loads and checks {config_path}, then the input files and prompt sizes,
+    without any API call, upload or Assistant, and how long the module took
+    to import.
+    Returns:
+        list: The problems found, empty when the batch is ready to run.
+    """
+    problems = []
+    startup = time.time() - STARTED
+    try:
+        site_config = load_config(config_path)
+        if not isinstance(site_config, dict):
+            raise ValueError("it does not hold a JSON object")
+        configure(site_config)
+    except (OSError, ValueError) as exc:
+        return [f"{config_path} could not be loaded: {exc}"]
+    startup_budget = config.get('startup_budget_seconds', 1.0)
+    print(f"Startup took {startup:.2f}s (budget {startup_budget}s).")
+    if startup > startup_budget:
+        problems.append(f"startup took {startup:.2f}s, over the {startup_budget}s budget")
+
+    for key in REQUIRED_SETTINGS:
+        if is_placeholder(config.get(key)):
+            problems.append(f'"{key}" in config.json is missing or still a placeholder')
+    for key in ASSISTANT_FILES:
+        if not os.path.isfile(config.get(key) or ''):
+            problems.append(f'"{key}" in config.json is not a file: {config.get(key)}')
+
+    has_keywords = False
+    if not os.path.isfile(input_file):
+        problems.append(f"{input_file} does not exist, get keywords first")
+    else:
+        with open(input_file, newline='', encoding='utf-8') as csvfile:
+            has_keywords = 'Keyword' in (csv.DictReader(csvfile).fieldnames or [])
+        if not has_keywords:
+            problems.append(f"{input_file} has no Keyword column")
+    row = None
+    if has_keywords:
+        done = set()
+        store_path = config.get('article_store', ARTICLE_STORE)
+        if os.path.isfile(store_path):
+            article_store = ArticleStore(store_path)
+            done = article_store.done_keywords(site_name(config), config.get('languages'))
+            article_store.close()
+        # Counted while streaming, only the first row is kept
+        count = written = 0
+        for keyword_row in KeywordRows(input_file):
+            row = row or keyword_row
+            count += 1
+            written += keyword_row['Keyword'] in done
+        if row:
+            print(f"{count} keywords in {input_file}, {written} already written.")
+
+    # Prompt sizes for the first keyword, before research is added
+    if row:
+        sample_images = ''
+        if os.path.isfile(config.get('path_to_website_images') or ''):
+            with open(config['path_to_website_images'], encoding='utf-8', errors='replace') as f:
+                sample_images = ''.join(f.readlines()[:5])
+        try:
+            prompts = [
+                ('outline', outline_prompt(row['Keyword'], sample_images, '', '', row.get('Secondary Keywords', ''))),
+                ('article', article_prompt('', sample_images, '', '', row.get('Secondary Keywords', ''))),
+            ]
+        except KeyError as exc:
+            problems.append(f"prompts need {exc} in config.json")
+            prompts = []
+        for stage, prompt in prompts:
+            model, _ = stage_settings(config, "openai_stage_models", stage, config.get("openai_model"))
+            budget = stage_budget(config, stage)
+            tokens = count_tokens(prompt)
+            print(f"{stage}: {model}, {tokens} prompt tokens before research, budget {budget}")
+            if budget and tokens > budget:
+                problems.append(f"the {stage} prompt is {tokens} tokens before research, over its {budget} budget")
+    return problems
 
 
 # Example usage
 if __name__ == "__main__":
-    process_keywords_concurrent()
\ No newline at end of file
+    parser = argparse.ArgumentParser(
+        description="Writes an article for every keyword in optimized_keywords.csv.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="check config.json, inputs and prompt sizes offline, then exit")
+    parser.add_argument('--enqueue', action='store_true',
+                        help="add optimized_keywords.csv to the shared job queue, then exit")
+    parser.add_argument('--worker', action='store_true',
+                        help="write articles for jobs claimed from the shared job queue")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="rewrite articles already written, reusing unchanged stage results")
+    parser.add_argument('--urgent', nargs='+', metavar='KEYWORD',
+                        help="move keywords to the front of the shared job queue, then exit")
+    args = parser.parse_args()
+    # --help has exited by now, and --dry-run reports a missing config.json itself
+    if args.dry_run:
+        problems = dry_run()
+        for problem in problems:
+            print(f"Problem: {problem}")
+        print(f"Dry run found {len(problems)} problems." if problems else "Dry run OK.")
+        sys.exit(1 if problems else 0)
+    configure(load_config())
+    if args.enqueue:
+        enqueue_keywords()
+        sys.exit(0)
+    if args.urgent:
+        enqueue_urgent(args.urgent)
+        sys.exit(0)
+    if args.worker:
+        run_worker()
+        sys.exit(0)
+    process_keywords_concurrent(args.rebuild)
\ No newline at end of file
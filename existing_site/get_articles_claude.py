@@ -1,99 +1,97 @@
-import os
-import time
-import csv
-import requests
-from tqdm import tqdm
 import concurrent.futures
 import json
-import random
-from anthropic import APIError, APIConnectionError, APITimeoutError, RateLimitError, Anthropic, HUMAN_PROMPT, AI_PROMPT
+import sys
+import cassette
+import deadline
+import metrics
+import providers
+from model_routing import UsageReport
+from status_server import BatchStatus, start_status_server
+from shared_research import SharedResearch
+from batch_runner import run_batch
+from prompt_builder import build_prompt, research_text, stage_budget
+from link_validator import LinkIndex, validate_article
+from build_cache import BuildCache
+from charts import CHARTS_DIR, chart_spec_format, describe_chart, parse_chart_specs, render_charts, start_pool
+from providers import ProviderPool, upload_image
+from structured import LINKS_SCHEMA, links_text, schema_format, structured_reply
 
-# Load configuration from a JSON file
-with open('config.json') as config_file:
-    config = json.load(config_file)
+# Set by configure(), from config.json or one site's settings
+config = {}
 
-# Set your Anthropic API key from the config file
-ANTHROPIC_API_KEY = config["ANTHROPIC_API_KEY"]
-print("Setting Anthropic API Key...")
-# Initialize the Anthropic client
-client = Anthropic(api_key=ANTHROPIC_API_KEY)
+# Claude by default, or the providers and weights in "provider_weights"
+provider_pool = None
 
-# Update your Freeimage.host API Key here from the config file
-FREEIMAGE_HOST_API_KEY = config["FREEIMAGE_HOST_API_KEY"]
+FREEIMAGE_HOST_API_KEY = None
 
-# Global list to store image URLs
-image_urls = []
+# Latency and token usage per stage and model
+usage_report = UsageReport()
 
+# Live batch progress, served over HTTP when "status_port" is set
+batch_status = BatchStatus()
 
-def upload_to_freeimage_host(image_path, Keyword):
+# Research shared across topic clusters when "share_research" is set
+shared_research = None
+
+# Allowed image and link URLs, built when "validate_links" is set
+link_index = None
+
+# Stage outputs by a hash of their inputs, unless "build_cache" is null
+build_cache = None
+
+
+def load_config(path='config.json'):
     """
-    Uploads an image to Freeimage.host with {Keyword} in the filename.
-    Also stores the image URL in a global list.
+    Returns the settings in {path}.
     """
-    print(f"Uploading {image_path} to Freeimage.host...")
-    with open(image_path, 'rb') as image_file:
-        files = {'source': image_file}
-        data = {
-            'key': FREEIMAGE_HOST_API_KEY,
-            'action': 'upload',
-            'format': 'json',
-            'name': f'{Keyword}_image.png'  # Add {Keyword} in the filename
-        }
-
-        response = requests.post(
-            'https://freeimage.host/api/1/upload', files=files, data=data, verify=Flase)
-
-        if response.status_code == 200:
-            url = response.json().get('image', {}).get('url', '')
-            if url:
-                print(f"Uploaded successfully: {url}")
-                # Store both idea and URL
-                image_urls.append({'idea': Keyword, 'url': url})
-                return url
-            else:
-                print("Upload successful but no URL returned, something went wrong.")
-        else:
-            print(
-                f"Failed to upload to Freeimage.host: {response.status_code}, {response.text}")
-    return None
+    with open(path) as config_file:
+        return json.load(config_file)
 
 
+def configure(site_config):
+    """
+    Sets the settings the script runs with, before anything else is called:
+    config.json when it is run or imported by pipeline.py, one site's
+    settings when multi_site.py loads its own copy of the script.
+    """
+    global config, FREEIMAGE_HOST_API_KEY, provider_pool
+    config = site_config
+    metrics.configure(config)
+    cassette.install(config)
+    provider_pool = ProviderPool.from_config(config, {'anthropic': 1})
+    print(f"Using {', '.join(backend.name for backend in provider_pool.backends)}...")
+    # Update your Freeimage.host API Key here from the config file
+    FREEIMAGE_HOST_API_KEY = config["FREEIMAGE_HOST_API_KEY"]
+
 
-def clear_image_urls():
+def upload_to_freeimage_host(image_path, Keyword):
     """
-    Clears the global list of image URLs.
+    Uploads an image to Freeimage.host with {Keyword} in the filename.
+    Returns:
+        str or None: The image URL, None if the upload failed.
     """
-    global image_urls
-    image_urls.clear()
-    print("Cleared global image URLs.")
+    return upload_image(image_path, Keyword, FREEIMAGE_HOST_API_KEY)
 
 
-def claude_completion(prompt, max_tokens=1000, max_retries=5):
+def completion(prompt, stage, max_tokens=1000, schema=None):
     """
-    Send a completion request to Claude 3.5 Sonnet via the Anthropic API with retry logic.
+    The reply to {prompt} from the next provider in the pool, failing over
+    when one is rate limited. Each provider's model and max_tokens come from
+    {stage} in its "<provider>_stage_models", falling back to {max_tokens}.
+    A reply to the same prompt, settings and schema is served from the
+    build cache.
     """
-    for attempt in range(max_retries):
-        try:
-            response = client.completions.create(
-                model="claude-3-sonnet-20240229",
-                prompt=f"{HUMAN_PROMPT} {prompt}{AI_PROMPT}",
-                max_tokens_to_sample=max_tokens,
-                temperature=0.7,
-            )
-            return response.completion
-        except (APIError, APIConnectionError, APITimeoutError) as e:
-            if attempt == max_retries - 1:
-                raise
-            wait_time = (2 ** attempt) + random.uniform(0, 1)
-            print(f"API error occurred: {str(e)}. Retrying in {wait_time:.2f} seconds...")
-            print(e.__cause__) 
-            time.sleep(wait_time)
-        except RateLimitError as e:
-            wait_time = int(e.retry_after) if hasattr(e, 'retry_after') else 60
-            print(f"Rate limit reached. Waiting for {wait_time} seconds before retrying...")
-            time.sleep(wait_time)
-    
-    raise Exception("Max retries reached. Unable to complete the request.")
+    def complete():
+        return provider_pool.complete(prompt, stage, max_tokens, usage_report=usage_report, schema=schema)
+
+    if build_cache is not None:
+        # The pool only constrains replies with "structured_output" set
+        output_schema = schema if config.get('structured_output') else None
+        return build_cache.get_or_compute(
+            stage, [metrics.current_keyword(), prompt, provider_pool.settings(stage, max_tokens), 0.7,
+                    output_schema], complete)
+    return complete()
+
 
 def perplexity_research(Keyword, max_retries=3, delay=5):
     """
@@ -106,7 +104,6 @@ def perplexity_research(Keyword, max_retries=3, delay=5):
         dict or None: The response from the API or None if failed.
     """
     print(f"Starting perplexity research for: {Keyword}")
-    url = "https://api.perplexity.ai/chat/completions"
     payload = {
         "model": config["perplexity_model"],
         "messages": [
@@ -120,73 +117,112 @@ def perplexity_research(Keyword, max_retries=3, delay=5):
             }
         ]
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {config['PERPLEXITY_API_KEY']}"
-    }
-
-    for attempt in range(max_retries):
-        response = requests.post(url, json=payload, headers=headers, verify=False)
-        if response.status_code == 200:
-            print("Perplexity research completed successfully.")
-            try:
-                return response.json()
-            except ValueError:
-                print("JSON decoding failed")
-                return None
-        else:
-            print(
-                f"Perplexity research failed with status code: {response.status_code}. Attempt {attempt + 1} of {max_retries}.")
-            time.sleep(delay)
-
-    print("Perplexity research failed after maximum retries.")
-    return None
+    return providers.perplexity_research(
+        payload, config['PERPLEXITY_API_KEY'], build_cache, usage_report, max_retries, delay)
 
 
 def get_internal_links(Keyword):
+    """
+    Asks for the internal pages and product images relevant to {Keyword} as
+    JSON, asking once more when the reply is not valid.
+    Returns:
+        str: The chosen links and images as markdown, one per line.
+    """
     with open(config["path_to_website_images"], "r") as f:
         brandimages_content = f.read()
     with open(config["path_to_links_file"], "r") as f:
         internal_links_content = f.read()
     
-    prompt = f"""Read the following content and choose 5 relevant pages and their links that are relevant to {Keyword}. Don't have more than 5. Also choose 5 relevant product images to this article.
+    prompt = build_prompt('links', f"""Read the following content and choose 5 relevant pages and their links that are relevant to {Keyword}. Don't have more than 5. Also choose 5 relevant product images to this article.
+    {schema_format(LINKS_SCHEMA)}""",
+        [('Brand Images', brandimages_content),
+         ('Internal Links', internal_links_content)],
+        stage_budget(config, 'links'))
+    reply = structured_reply(lambda content: completion(content, 'links', schema=LINKS_SCHEMA),
+                             prompt, LINKS_SCHEMA, 'links')
+    return links_text(reply['links'], 10, link_index) if reply else ''
 
-    Brand Images:
-    {brandimages_content}
 
-    Internal Links:
-    {internal_links_content}
+def create_data_vis(research_info, Keyword):
+    """
+    Asks for up to config["chart_count"] simple charts of figures from the
+    research as JSON specs in one call. With "render_charts" set, they are
+    rendered locally and uploaded too.
+    Returns:
+        tuple: (one line per chart with its data and its image URL when
+        uploaded, the URLs of the uploaded charts)
     """
-    return claude_completion(prompt)
+    print("Creating data visualization descriptions...")
+    count = config.get('chart_count', 3)
+    prompt = build_prompt('visualization', f"""Based on the Research information below about {Keyword}, choose up to {count} simple charts that illustrate key points.
+    {chart_spec_format(count)}""",
+        [('Research information', research_info)],
+        stage_budget(config, 'visualization'))
+
+    specs = parse_chart_specs(completion(prompt, 'visualization', max_tokens=1000), count)
+    descriptions = [describe_chart(spec) for spec in specs]
+    chart_urls = []
+    if config.get('render_charts'):
+        for spec, path in render_charts(
+                specs, Keyword, config.get('charts_dir', CHARTS_DIR), config.get('chart_format', 'png')):
+            url = upload_to_freeimage_host(path, Keyword)
+            if url:
+                descriptions[specs.index(spec)] += f" - image: {url}"
+                chart_urls.append(url)
 
+    print("Data visualization descriptions created successfully.")
+    return "\n".join(descriptions), chart_urls
 
-def create_data_vis(perplexity_research, Keyword):
-    print("Creating data visualization descriptions...")
-    
-    prompt = f"""Based on the following research information about {Keyword}, describe 3 simple data visualizations that could be created to illustrate key points. For each visualization, provide:
-    1. The type of chart or graph
-    2. The data it would represent
-    3. A brief description of what it would show
 
-    Research information:
-    {perplexity_research}
+def fix_links(section, bad_urls, internal_links):
+    """
+    Asks Claude to rewrite one article section without the URLs in
+    {bad_urls}, which are not on the site. Much cheaper than rewriting the
+    whole article.
+    """
+    print(f"Regenerating a section with {len(bad_urls)} unknown links...")
+    prompt = build_prompt('fix_links', f"""The Section below uses these links that do not exist: {", ".join(bad_urls)}.
+    Rewrite the Section so it only uses product images and internal links from Images and links, or none at all.
+    Keep everything else the same. Reply with only the rewritten Section in markdown.""",
+        [('Section', section),
+         ('Images and links', internal_links)],
+        stage_budget(config, 'fix_links'))
+    return completion(prompt, 'fix_links', max_tokens=1000)
 
-    Please be specific but concise in your descriptions.
+
+def translate_article(article, language):
     """
-    
-    visualizations = claude_completion(prompt, max_tokens=1000)
-    
-    print("Data visualization descriptions created successfully.")
-    return visualizations
+    Translates a finished article into {language}, keeping its markdown,
+    links and images as they are.
+    """
+    prompt = build_prompt('translate', f"""Translate the Article below into {language}.
+    Keep the markdown formatting, tables, image links and internal links exactly as they are.
+    Reply with only the translated Article.""",
+        [('Article', article)],
+        stage_budget(config, 'translate'))
+    return completion(prompt, 'translate', max_tokens=2000)
+
 
-def process_blog_post(Keyword):
+def process_blog_post(Keyword, secondary_keywords='', languages=None):
+    """
+    Writes the article for {Keyword}. With {languages}, the research and
+    outline are done once and the article is written in each language at
+    the same time, or translated from config["language"] when
+    "language_mode" is "translate".
+    Returns:
+        tuple: (outline, article), or (outline, {language: article}) with {languages}.
+    """
     print(f"Processing blog post for: {Keyword}")
+    metrics.set_keyword(Keyword)
+    batch_status.start(Keyword)
     try:
-        research_results = perplexity_research(Keyword)
-        research_info = str(research_results)
+        if shared_research is not None:
+            research_info = shared_research.research_info(Keyword)
+        else:
+            research_info = research_text(perplexity_research(Keyword))
 
-        data_vis_descriptions = create_data_vis(research_info, Keyword)
+        # This keyword's own charts, never shared with the other workers
+        data_vis_descriptions, relevant_image_urls = create_data_vis(research_info, Keyword)
 
         internal_links = get_internal_links(Keyword)
 
@@ -195,95 +231,199 @@ def process_blog_post(Keyword):
         with open(config["path_to_example_file_2"], "r") as f:
             example_file_2_content = f.read()
 
-        outline_prompt = f"""Create a SHORT outline for a {config['page_type']} based on the following research:
-        {research_info}
-        
-        Include relevant product images and internal links from the following:
-        {internal_links}
+        outline_prompt = build_prompt('outline', f"""Create a SHORT outline for a {config['page_type']} about {Keyword} based on the Research below.
+        Include relevant product images and internal links from Images and links.
+        Also, consider incorporating the Data visualization ideas.""",
+            [('Research', research_info),
+             ('Images and links', internal_links),
+             ('Secondary keywords to also cover', secondary_keywords),
+             ('Data visualization ideas', data_vis_descriptions)],
+            stage_budget(config, 'outline'))
+        outline = completion(outline_prompt, 'outline')
+
+        expires = deadline.expires()
+
+        def write(language=None):
+            metrics.set_keyword(Keyword)
+            deadline.restore(expires)
+            try:
+                return write_article_text(outline, secondary_keywords, internal_links, relevant_image_urls,
+                                          example_file_1_content, example_file_2_content, language)
+            except Exception as e:
+                # The outline is kept, and stays in the build cache for the next attempt
+                print(f"Writing the {language or config['language']} article for '{Keyword}' failed: {str(e)}")
+                return None
 
-        Also, consider incorporating these data visualization ideas:
-        {data_vis_descriptions}
-        """
-        outline = claude_completion(outline_prompt)
+        if languages:
+            base_article = None
+            if outline and config.get('language_mode') == 'translate':
+                base_article = write() or ''
+
+            def write_language(language):
+                if base_article is None:
+                    return write(language)
+                metrics.set_keyword(Keyword)
+                deadline.restore(expires)
+                if not base_article or language == config['language']:
+                    return base_article
+                try:
+                    return translate_article(base_article, language)
+                except Exception as e:
+                    print(f"Translating '{Keyword}' into {language} failed: {str(e)}")
+                    return None
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(languages)) as executor:
+                articles = dict(zip(languages, executor.map(write_language, languages)))
+            print(f"Articles created in {len([a for a in articles.values() if a])} of {len(languages)} languages.")
+            return outline, articles
+
+        article = write()
+        if article:
+            print("Article created successfully.")
+        else:
+            print("Failed to create an article.")
+        return outline, article
+    except Exception as e:
+        print(f"An error occurred while processing '{Keyword}': {str(e)}")
+        return None, None
 
-        article_prompt = f"""Write a short, snappy article in {config['language']} at a grade 7 level based on the following outline:
-        {outline}
 
+def write_article_text(outline, secondary_keywords, internal_links, relevant_image_urls, example_file_1_content,
+                       example_file_2_content, language=None):
+    """
+    Writes the article for {outline} in {language} (config["language"] by
+    default) and checks its links.
+    """
+    if not outline:
+        return None
+    article_prompt = build_prompt('article', f"""Write a short, snappy article in {language or config['language']} at a grade 7 level based on the Outline below.
         Use a {config['tone']} tone of voice. Write from a first person plural perspective for the business. 
         Include a key takeaway table at the top of the article, summarizing the main points. 
         Use markdown formatting and ensure to use tables and lists for formatting. 
         Include 3 relevant brand images and internal links maximum.
+        Use Example 1 and Example 2 as references for the style and format.""",
+        [('Outline', outline),
+         ('Secondary keywords to also cover', secondary_keywords),
+         ('Example 1', example_file_1_content),
+         ('Example 2', example_file_2_content)],
+        stage_budget(config, 'article'))
+    article = completion(article_prompt, 'article', max_tokens=2000)
+
+    if article and link_index is not None:
+        article, report = validate_article(
+            article, link_index,
+            lambda section, bad_urls: fix_links(section, bad_urls, internal_links),
+            relevant_image_urls)
+        print(f"Checked {report['links']} links: {report['invalid']} unknown, "
+              f"{report['sections']} sections regenerated, {report['stripped']} links removed.")
+    return article
+
+
+def prepare_batch(keywords=None):
+    """
+    Sets up shared research, the link index, the build cache and the status
+    server for a batch. Shared research needs the whole list of {keywords}
+    up front.
+    """
+    global shared_research
+    if config.get('share_research'):
+        if keywords is None:
+            print("share_research needs the whole keyword list up front, skipping it.")
+        else:
+            shared_research = SharedResearch(
+                keywords, perplexity_research,
+                config.get('research_cluster_threshold', 0.4), config.get('research_cluster_size', 8))
 
-        Use these examples as references for the style and format:
-
-        Example 1:
-        {example_file_1_content}
+    global link_index
+    if config.get('validate_links'):
+        link_index = LinkIndex.from_config(config)
+        if not link_index.urls:
+            print("No image or link URLs found, skipping link validation.")
+            link_index = None
 
-        Example 2:
-        {example_file_2_content}
-        """
-        article = claude_completion(article_prompt, max_tokens=2000)
+    if config.get('render_charts'):
+        start_pool()
 
-        if article:
-            print("Article created successfully.")
-            clear_image_urls()
-        else:
-            print("Failed to create an article.")
-        return outline, article
-    except Exception as e:
-        print(f"An error occurred while processing '{Keyword}': {str(e)}")
-        return None, None
+    global build_cache
+    if build_cache is None:
+        build_cache = BuildCache.from_config(config)
 
-def process_keywords_concurrent():
-    input_file = 'optimized_keywords.csv'
-    output_file = 'processed_keywords.csv'
+    batch_status.begin(len(keywords or ()))
+    start_status_server(batch_status, config.get('status_port'))
 
-    fieldnames = ['Keyword', 'Outline', 'Article', 'Processed']
 
-    with open(input_file, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        rows_to_process = [row for row in reader]
+def write_article(article_store, site, row):
+    """
+    Writes the article for {row} and stores it, marked 'Failed' if anything
+    goes wrong. With config["languages"] set, stores one article per language.
+    The keyword gets config["keyword_deadline_seconds"] end to end; a failed
+    row keeps the outline if there was one, and never replaces an article
+    finished in an earlier run, e.g. with --rebuild.
+    Returns:
+        dict: The stored row, for the first language when there are several,
+        'Failed' if any of them failed.
+    """
+    deadline.start(config.get('keyword_deadline_seconds'))
+    languages = config.get('languages')
+    if languages:
+        return write_article_languages(article_store, site, row, languages)
+    try:
+        outline, article = process_blog_post(row['Keyword'], row.get('Secondary Keywords', ''))
+    except Exception as exc:
+        print(f'Keyword {row["Keyword"]} generated an exception: {exc}')
+        outline, article = None, None
+    processed_row = {
+        'Keyword': row['Keyword'],
+        'Outline': outline or '',
+        'Article': article or '',
+        'Processed': 'Yes' if article else 'Failed'
+    }
+    if not article_store.put_row(site, processed_row):
+        print(f"Kept the finished article for {row['Keyword']} from an earlier run.")
+    batch_status.finish(row['Keyword'], ok=processed_row['Processed'] == 'Yes')
+    return processed_row
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_row = {executor.submit(process_blog_post, row['Keyword']): row for row in rows_to_process}
 
-        progress = tqdm(concurrent.futures.as_completed(future_to_row), total=len(rows_to_process), desc="Processing Keywords")
+def write_article_languages(article_store, site, row, languages):
+    # Languages finished in an earlier run come back from the build cache at no cost
+    try:
+        outline, articles = process_blog_post(row['Keyword'], row.get('Secondary Keywords', ''), languages)
+    except Exception as exc:
+        print(f'Keyword {row["Keyword"]} generated an exception: {exc}')
+        outline, articles = None, None
+
+    processed_rows = []
+    for language in languages:
+        article = (articles or {}).get(language)
+        processed_rows.append({
+            'Keyword': row['Keyword'],
+            'Outline': outline or '',
+            'Article': article or '',
+            'Processed': 'Yes' if article else 'Failed',
+            'Language': language
+        })
+        if not article_store.put_row(site, processed_rows[-1]):
+            print(f"Kept the finished {language} article for {row['Keyword']} from an earlier run.")
+    ok = all(processed_row['Processed'] == 'Yes' for processed_row in processed_rows)
+    batch_status.finish(row['Keyword'], ok=ok)
+    return dict(processed_rows[0], Processed='Yes' if ok else 'Failed')
+
+
+def process_keywords_concurrent(rebuild=False):
+    """
+    Writes an article for every keyword in optimized_keywords.csv that has
+    none yet, or for every keyword when {rebuild} is set. Stage results
+    whose inputs did not change since the last run come from the build cache.
+    """
+    run_batch(config, batch_status, prepare_batch, write_article, rebuild)
 
-        results = []
-        for future in progress:
-            row = future_to_row[future]
-            try:
-                outline, article = future.result()
-                if outline is None or article is None:
-                    processed_row = {
-                        'Keyword': row['Keyword'],
-                        'Outline': '',
-                        'Article': '',
-                        'Processed': 'Failed'
-                    }
-                else:
-                    processed_row = {
-                        'Keyword': row['Keyword'],
-                        'Outline': outline,
-                        'Article': article,
-                        'Processed': 'Yes'
-                    }
-                results.append(processed_row)
-            except Exception as exc:
-                print(f'Keyword {row["Keyword"]} generated an exception: {exc}')
-                processed_row = {
-                    'Keyword': row['Keyword'],
-                    'Outline': '',
-                    'Article': '',
-                    'Processed': 'Failed'
-                }
-                results.append(processed_row)
-
-    with open(output_file, 'w', newline='', encoding='utf-8') as f_output:
-        writer = csv.DictWriter(f_output, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
+    usage_report.print_summary()
+    provider_pool.print_report()
+    if build_cache is not None:
+        build_cache.print_report()
 
 # Example usage
 if __name__ == "__main__":
-    process_keywords_concurrent()
\ No newline at end of file
+    configure(load_config())
+    # --rebuild rewrites articles already written, reusing unchanged stage results
+    process_keywords_concurrent('--rebuild' in sys.argv)
\ No newline at end of file
@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit, urlunsplit
+
+import metrics
+
+# ![alt](url "title") and [text](url "title")
+LINK_PATTERN = re.compile(r'(!?)\[([^\]]*)\]\(\s*<?([^)\s>]+)>?(?:\s+"[^"]*")?\s*\)')
+
+# Absolute URLs inside brandimages.txt, the links file or any other text
+URL_PATTERN = re.compile(r'https?://[^\s<>"\')\]]+')
+
+HEADING_PATTERN = re.compile(r'^#{1,6}\s', re.MULTILINE)
+
+# Links that never need checking
+_IGNORED_SCHEMES = ('mailto:', 'tel:', '#', 'data:')
+
+
+def normalize_url(url):
+    """
+    Returns the form URLs are compared in: lowercase scheme and host without
+    "www.", no fragment and no trailing slash.
+    """
+    url = url.strip().rstrip('.,;:')
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    path = parts.path.rstrip('/') or ''
+    return urlunsplit((parts.scheme.lower(), host, path, parts.query, ''))
+
+
+class LinkIndex:
+    """
+    Hashed set of every URL an article is allowed to use, plus the paths on
+    the site's own hosts so relative links like /products/mat can be checked.
+    Links to other websites are rejected unless {allow_external} is set
+    (config["allow_external_links"], false by default). Images and pages on
+    the site's own hosts must always be in the set.
+    """
+
+    def __init__(self, urls=(), allow_external=False):
+        self.allow_external = allow_external
+        self.urls = set()
+        self.hosts = set()
+        self.paths = set()
+        for url in urls:
+            self.add(url)
+
+    def add(self, url):
+        url = normalize_url(url)
+        parts = urlsplit(url)
+        self.urls.add(url)
+        if parts.netloc:
+            self.hosts.add(parts.netloc)
+        self.paths.add(urlunsplit(('', '', parts.path, parts.query, '')))
+
+    def __len__(self):
+        return len(self.urls)
+
+    def allows(self, url, is_image=False, extra=()):
+        if url.startswith(_IGNORED_SCHEMES):
+            return True
+        normalized = normalize_url(url)
+        if normalized in self.urls or normalized in extra:
+            return True
+        parts = urlsplit(normalized)
+        if not parts.netloc:
+            return normalized in self.paths
+        # Unknown URLs fail unless they are links to another website and those are allowed
+        return not is_image and self.allow_external and parts.netloc not in self.hosts
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds the index from config["path_to_website_images"],
+        config["path_to_links_file"] and config["sitemap"] (a local XML file
+        or a URL). Files that do not exist are skipped.
+        """
+        index = cls(allow_external=config.get('allow_external_links', False))
+        for key in ('path_to_website_images', 'path_to_links_file'):
+            path = config.get(key)
+            if path and os.path.exists(path):
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    for url in URL_PATTERN.findall(f.read()):
+                        index.add(url)
+        for url in sitemap_urls(config.get('sitemap')):
+            index.add(url)
+        print(f"Link index holds {len(index)} URLs on {len(index.hosts)} hosts.")
+        return index
+
+
+def sitemap_urls(sitemap):
+    """
+    Returns every <loc> (pages and image:loc) in a sitemap file or URL.
+    """
+    if not sitemap:
+        return []
+    if sitemap.startswith(('http://', 'https://')):
+        import requests
+        with metrics.track('sitemap', None, 'sitemap') as call:
+            response = requests.get(sitemap, timeout=30)
+            call['status'] = response.status_code
+        if response.status_code != 200:
+            print(f"Could not fetch sitemap {sitemap}: {response.status_code}")
+            return []
+        root = ET.fromstring(response.content)
+    elif os.path.exists(sitemap):
+        root = ET.parse(sitemap).getroot()
+    else:
+        return []
+    return [element.text.strip() for element in root.iter()
+            if element.tag.rsplit('}', 1)[-1] == 'loc' and element.text]
+
+
+def extract_links(text):
+    """
+    Returns (is_image, label, url) for every markdown link and image in {text}.
+    """
+    return [(bang == '!', label, url) for bang, label, url in LINK_PATTERN.findall(text)]
+
+
+def invalid_links(text, index, extra=()):
+    return [url for is_image, _, url in extract_links(text) if not index.allows(url, is_image, extra)]
+
+
+def split_sections(text):
+    """
+    Splits markdown at its headings. Joining the sections gives back {text}.
+    """
+    starts = [0] + [m.start() for m in HEADING_PATTERN.finditer(text) if m.start() > 0]
+    return [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+
+def strip_links(text, bad_urls):
+    """
+    Removes images with a URL in {bad_urls} and turns such links into
+    their plain text.
+    """
+    bad_urls = set(bad_urls)
+
+    def replace(match):
+        if match.group(3) not in bad_urls:
+            return match.group(0)
+        return '' if match.group(1) else match.group(2)
+
+    return LINK_PATTERN.sub(replace, text)
+
+
+def validate_article(text, index, regenerate=None, extra=()):
+    """
+    Checks every link and image in the article against {index}. Sections with
+    unknown URLs are passed to {regenerate}(section, bad_urls), which returns
+    a rewritten section or None; whatever is still invalid after that is
+    stripped, so no invented URL is ever published.
+    Args:
+        text (str): The article markdown.
+        index (LinkIndex): The allowed URLs.
+        regenerate (callable): Rewrites one section, or None to only strip.
+        extra (iterable): Further allowed URLs, e.g. images uploaded for this article.
+    Returns:
+        tuple: (text, report) where report counts checked, invalid,
+        regenerated and stripped links.
+    """
+    extra = {normalize_url(url) for url in extra}
+    report = {'links': len(extract_links(text)), 'invalid': 0, 'sections': 0, 'stripped': 0}
+    sections = split_sections(text)
+    for i, section in enumerate(sections):
+        bad_urls = invalid_links(section, index, extra)
+        if not bad_urls:
+            continue
+        report['invalid'] += len(bad_urls)
+        if regenerate is not None:
+            report['sections'] += 1
+            rewritten = regenerate(section, bad_urls)
+            if rewritten and rewritten.strip():
+                section = rewritten.strip() + section[len(section.rstrip()):]
+                bad_urls = invalid_links(section, index, extra)
+        if bad_urls:
+            report['stripped'] += len(bad_urls)
+            section = strip_links(section, bad_urls)
+        sections[i] = section
+    return ''.join(sections), report
+
+
+def main(argv):
+    # python link_validator.py FILE.md ... lists links that are not in the index
+    with open('config.json') as config_file:
+        config = json.load(config_file)
+    index = LinkIndex.from_config(config)
+    for path in argv[1:]:
+        with open(path, encoding='utf-8') as f:
+            bad_urls = invalid_links(f.read(), index)
+        for url in bad_urls:
+            print(f"{path}: {url}")
+        if not bad_urls:
+            print(f"{path}: OK")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,174 @@
+import csv
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# The publishing script, by its name in either site folder
+PUBLISH_SCRIPTS = ('5_publish_articles', 'publish_articles')
+
+
+class StandIn:
+    """
+    A local stand-in for a WordPress REST API and an image host, each on its
+    own port, with {latency} seconds added to every response. Records what a
+    publishing run sent: posts, media uploads, requests to the API without
+    credentials and requests to the image host with them.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.posts = {}
+        self.media = 0
+        self.unauthorized = 0
+        self.leaked_auth = 0
+        self._lock = threading.Lock()
+        self.api = self._serve(self._api_handler())
+        self.images = self._serve(self._image_handler())
+
+    def _serve(self, handler):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def url(self, server):
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def close(self):
+        for server in (self.api, self.images):
+            server.shutdown()
+            server.server_close()
+
+    def _api_handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def authorized(self):
+                time.sleep(standin.latency)
+                if self.headers.get('Authorization'):
+                    return True
+                with standin._lock:
+                    standin.unauthorized += 1
+                self.reply(401, {'code': 'rest_not_logged_in'})
+                return False
+
+            def do_GET(self):
+                if not self.authorized():
+                    return
+                url = urlsplit(self.path)
+                slug = parse_qs(url.query).get('slug', [''])[0]
+                with standin._lock:
+                    posts = [{'id': post_id} for post_id, post in standin.posts.items() if post['slug'] == slug]
+                self.reply(200, posts)
+
+            def do_POST(self):
+                data = self.body()
+                if not self.authorized():
+                    return
+                path = urlsplit(self.path).path.split('/wp-json/wp/v2', 1)[-1]
+                with standin._lock:
+                    if path == '/media':
+                        standin.media += 1
+                        self.reply(201, {'source_url': f"{standin.url(standin.api)}/media/{standin.media}.jpg"})
+                        return
+                    post = json.loads(data)
+                    if path == '/posts':
+                        post_id = len(standin.posts) + 1
+                    else:
+                        post_id = int(path.rsplit('/', 1)[-1])
+                    standin.posts[post_id] = post
+                self.reply(201 if path == '/posts' else 200, {'id': post_id})
+
+        return Handler
+
+    def _image_handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(standin.latency)
+                if self.headers.get('Authorization'):
+                    with standin._lock:
+                        standin.leaked_auth += 1
+                data = b'\xff\xd8\xff\xe0' + b'\0' * 2048
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+def write_articles(path, count, image_host):
+    # Formatted articles as 4_format_articles.py writes them, one external image each
+    with open(path, 'w', newline='', encoding='utf-8') as f_output:
+        writer = csv.writer(f_output)
+        writer.writerow(['Keyword', 'Markdown', 'HTML', 'Language'])
+        for index in range(count):
+            html = (f"<h1>Article {index}</h1>\n<p>Text about keyword {index}.</p>\n"
+                    f"<img src=\"{image_host}/images/{index % 50}.jpg\" alt=\"image\">")
+            writer.writerow([f"keyword {index}", '', html, ''])
+
+
+def main(argv):
+    """
+    python publish_standin.py [articles] [latency_ms]
+    Publishes {articles} formatted articles to a local WordPress stand-in
+    and prints the posts/second, first as new posts and then as updates.
+    """
+    count = int(argv[1]) if len(argv) > 1 else 500
+    latency = (float(argv[2]) if len(argv) > 2 else 20) / 1000
+    publish = importlib.import_module(next(
+        name for name in PUBLISH_SCRIPTS if os.path.exists(os.path.join(os.path.dirname(__file__), name + '.py'))))
+
+    standin = StandIn(latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        input_file = os.path.join(tmp, 'formatted_articles.csv')
+        write_articles(input_file, count, standin.url(standin.images))
+        publish.config = dict(publish.config, wordpress_url=standin.url(standin.api),
+                              wordpress_user='standin', wordpress_app_password='standin',
+                              article_store=os.path.join(tmp, 'articles.sqlite'),
+                              publish_upload_images=True)
+        print(f"{count} new posts, {latency * 1000:.0f}ms per response, "
+              f"{publish.config.get('publish_workers', 8)} workers:")
+        publish.publish_articles(input_file)
+        # Changed content makes every post an update of the one published above
+        write_articles(input_file, count, standin.url(standin.images) + '/v2')
+        print(f"{count} updated posts:")
+        publish.publish_articles(input_file)
+    standin.close()
+    print(f"Stand-in holds {len(standin.posts)} posts and {standin.media} media uploads. "
+          f"API requests without credentials: {standin.unauthorized}, "
+          f"image requests with credentials: {standin.leaked_auth}.")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
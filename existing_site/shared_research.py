@@ -0,0 +1,105 @@
+import re
+import threading
+
+from cluster_keywords import normalize_keyword
+from prompt_builder import research_text
+
+
+def topic_clusters(keywords, threshold=0.4, max_size=8):
+    """
+    Groups related keywords by the overlap of their normalized words.
+    Each keyword joins the first cluster whose seed shares at least
+    {threshold} word Jaccard similarity with it, up to {max_size} members.
+    Returns:
+        list: Lists of keywords, in input order.
+    """
+    clusters = []
+    seeds = []
+    word_index = {}
+    for keyword in keywords:
+        words = set(normalize_keyword(keyword).split())
+        best = None
+        candidates = sorted({i for word in words for i in word_index.get(word, ())})
+        for i in candidates:
+            if len(clusters[i]) >= max_size:
+                continue
+            seed = seeds[i]
+            if len(words & seed) / len(words | seed) >= threshold:
+                best = i
+                break
+        if best is None:
+            best = len(clusters)
+            clusters.append([])
+            seeds.append(words)
+            for word in words:
+                word_index.setdefault(word, []).append(best)
+        clusters[best].append(keyword)
+    return clusters
+
+
+def slice_research(text, Keyword, max_chars=2500):
+    """
+    Keeps the paragraphs of a cluster's research that are most relevant to
+    {Keyword}, in their original order, up to {max_chars}.
+    """
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n|\n(?=\s*(?:[-*]|\d+\.)\s)", text) if p.strip()]
+    if sum(len(p) for p in paragraphs) <= max_chars:
+        return text
+    words = set(normalize_keyword(Keyword).split())
+    scored = []
+    for index, paragraph in enumerate(paragraphs):
+        overlap = len(words & set(normalize_keyword(paragraph).split()))
+        scored.append((-overlap, index))
+    kept = []
+    used = 0
+    for _, index in sorted(scored):
+        if used + len(paragraphs[index]) > max_chars:
+            continue
+        kept.append(index)
+        used += len(paragraphs[index])
+    return "\n\n".join(paragraphs[index] for index in sorted(kept))
+
+
+class SharedResearch:
+    """
+    Runs one broader research query per topic cluster and hands each member
+    keyword the slice of it that is relevant to that keyword. Concurrent
+    members of the same cluster wait for the single in-flight query.
+    """
+
+    def __init__(self, keywords, research, threshold=0.4, max_size=8, max_chars=2500):
+        self.research = research
+        self.max_chars = max_chars
+        self.cluster_of = {}
+        self.clusters = topic_clusters(keywords, threshold, max_size)
+        for index, members in enumerate(self.clusters):
+            for Keyword in members:
+                self.cluster_of[Keyword] = index
+        self._lock = threading.Lock()
+        self._cluster_locks = {}
+        self._cache = {}
+        print(f"Sharing research across {len(self.clusters)} topic clusters "
+              f"for {len(self.cluster_of)} keywords.")
+
+    def cluster_query(self, members):
+        if len(members) == 1:
+            return members[0]
+        return "{0}, including {1}".format(members[0], ", ".join(members[1:]))
+
+    def research_info(self, Keyword):
+        index = self.cluster_of.get(Keyword)
+        if index is None:
+            return research_text(self.research(Keyword))
+
+        with self._lock:
+            cluster_lock = self._cluster_locks.setdefault(index, threading.Lock())
+        with cluster_lock:
+            text = self._cache.get(index)
+            if text is None:
+                text = research_text(self.research(self.cluster_query(self.clusters[index])))
+                # Failed research is not cached, so the next member retries it
+                if text:
+                    self._cache[index] = text
+            else:
+                print(f"Reusing cluster research for: {Keyword}")
+        return slice_research(text, Keyword, self.max_chars)
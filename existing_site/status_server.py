@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+
+
+class BatchStatus:
+    """
+    Live view of a keyword batch: in-flight keywords by stage, queue depth,
+    completed/failed counts, rate-limit headroom per provider and ETA.
+    Fed by process_keywords_concurrent and by every metrics.track call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.started_at = time.time()
+        self.in_flight = {}
+        self.rate_limits = {}
+        self.calls = {}
+        metrics.add_listener(self.on_call)
+
+    def begin(self, total):
+        with self._lock:
+            self.total = total
+            self.started_at = time.time()
+
+    def add(self, count=1):
+        """
+        Grows the batch while keywords are still streaming in.
+        """
+        with self._lock:
+            self.total += count
+
+    def start(self, Keyword):
+        with self._lock:
+            self.in_flight[Keyword] = 'starting'
+
+    def finish(self, Keyword, ok=True):
+        with self._lock:
+            self.in_flight.pop(Keyword, None)
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def on_call(self, event, record):
+        with self._lock:
+            Keyword = record.get('keyword')
+            if event == 'start':
+                if Keyword in self.in_flight:
+                    self.in_flight[Keyword] = record['stage']
+                return
+            key = (record['provider'], record['stage'])
+            calls = self.calls.setdefault(key, [0, 0, 0.0])
+            calls[0] += 1
+            calls[1] += 0 if record['status'] == 200 else 1
+            calls[2] += record['seconds']
+            if record.get('rate_limit'):
+                self.rate_limits[record['provider']] = dict(record['rate_limit'])
+
+    def snapshot(self):
+        with self._lock:
+            done = self.completed + self.failed
+            elapsed = time.time() - self.started_at
+            remaining = max(self.total - done, 0)
+            by_stage = {}
+            for Keyword, stage in self.in_flight.items():
+                by_stage.setdefault(stage, []).append(Keyword)
+            return {
+                'total': self.total,
+                'completed': self.completed,
+                'failed': self.failed,
+                'in_flight': by_stage,
+                'queue_depth': max(remaining - len(self.in_flight), 0),
+                'elapsed_seconds': round(elapsed, 1),
+                'eta_seconds': round(elapsed / done * remaining, 1) if done else None,
+                'rate_limits': {provider: dict(limits) for provider, limits in self.rate_limits.items()},
+                'calls': [{'provider': provider, 'stage': stage, 'count': count,
+                           'failed': failed, 'seconds': round(seconds, 3)}
+                          for (provider, stage), (count, failed, seconds) in sorted(self.calls.items())],
+            }
+
+    def prometheus(self):
+        status = self.snapshot()
+        lines = [
+            f"autoblogger_keywords_total {status['total']}",
+            f"autoblogger_keywords_completed {status['completed']}",
+            f"autoblogger_keywords_failed {status['failed']}",
+            f"autoblogger_queue_depth {status['queue_depth']}",
+        ]
+        if status['eta_seconds'] is not None:
+            lines.append(f"autoblogger_eta_seconds {status['eta_seconds']}")
+        for stage, keywords in sorted(status['in_flight'].items()):
+            lines.append(f'autoblogger_in_flight{{stage="{stage}"}} {len(keywords)}')
+        for provider, limits in sorted(status['rate_limits'].items()):
+            for kind, value in sorted(limits.items()):
+                lines.append(
+                    f'autoblogger_rate_limit_remaining{{provider="{provider}",kind="{kind}"}} {value}')
+        for call in status['calls']:
+            labels = f'provider="{call["provider"]}",stage="{call["stage"]}"'
+            lines.append(f"autoblogger_calls_total{{{labels}}} {call['count']}")
+            lines.append(f"autoblogger_calls_failed_total{{{labels}}} {call['failed']}")
+            lines.append(f"autoblogger_call_seconds_sum{{{labels}}} {call['seconds']}")
+        return "\n".join(lines) + "\n"
+
+
+def start_status_server(batch_status, port, host='127.0.0.1'):
+    """
+    Serves /metrics (Prometheus text format) and /status (JSON) for
+    {batch_status} from a daemon thread.
+    Returns the server, or None when {port} is not set.
+    """
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = batch_status.prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path in ('/', '/status'):
+                body = json.dumps(batch_status.snapshot(), indent=2).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving batch status on http://{host}:{port}/status and /metrics")
+    return server
@@ -0,0 +1,206 @@
+import json
+
+# {"keywords": [...]} and {"subtopics": [...]} replies
+KEYWORDS_SCHEMA = {
+    "type": "object",
+    "properties": {"keywords": {"type": "array", "items": {"type": "string"}}},
+    "required": ["keywords"],
+    "additionalProperties": False,
+}
+
+SUBTOPICS_SCHEMA = {
+    "type": "object",
+    "properties": {"subtopics": {"type": "array", "items": {"type": "string"}}},
+    "required": ["subtopics"],
+    "additionalProperties": False,
+}
+
+# Product images and internal pages chosen for an article
+LINKS_SCHEMA = {
+    "type": "object",
+    "properties": {"links": {"type": "array", "items": {
+        "type": "object",
+        "properties": {
+            "kind": {"type": "string", "enum": ["image", "page"]},
+            "title": {"type": "string"},
+            "url": {"type": "string"},
+        },
+        "required": ["kind", "title", "url"],
+        "additionalProperties": False,
+    }}},
+    "required": ["links"],
+    "additionalProperties": False,
+}
+
+# OpenAI models that accept a json_schema response_format, by name prefix
+STRUCTURED_OUTPUT_MODELS = ('gpt-4o', 'gpt-4.1', 'gpt-4.5', 'gpt-5', 'o1', 'o3', 'o4')
+NO_STRUCTURED_OUTPUT_MODELS = ('gpt-4o-2024-05-13', 'o1-preview', 'o1-mini')
+
+# Models that only accept {"type": "json_object"}
+JSON_MODE_MODELS = ('gpt-4o', 'gpt-4-turbo', 'gpt-4-1106', 'gpt-4-0125', 'gpt-3.5-turbo')
+NO_JSON_MODE_MODELS = ('gpt-3.5-turbo-0613', 'gpt-3.5-turbo-16k-0613', 'gpt-3.5-turbo-instruct')
+
+REPAIR_PROMPT = '''Your previous reply could not be used: {0}.
+{1}
+Previous reply:
+{2}'''
+
+_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'number': (int, float),
+    'integer': int,
+    'boolean': bool,
+}
+
+
+def compact(value):
+    """
+    {value} as JSON without spaces, the cheapest form to put in a prompt.
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def schema_format(schema):
+    """
+    Instructions asking for a reply that matches {schema}.
+    """
+    return f"Reply with only JSON matching this JSON schema, no other text: {compact(schema)}"
+
+
+def response_format(name, schema, model):
+    """
+    The OpenAI response_format for a reply matching {schema} from {model}.
+    Models with Structured Outputs are constrained to {schema}. Older models
+    that have JSON mode only get valid JSON, which is then checked and
+    repaired like any other reply.
+    Returns:
+        dict or None: The response_format, None for models with neither.
+    """
+    model = model or ''
+    if model.startswith(STRUCTURED_OUTPUT_MODELS) and not model.startswith(NO_STRUCTURED_OUTPUT_MODELS):
+        return {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
+    if model.startswith(JSON_MODE_MODELS) and model not in NO_JSON_MODE_MODELS:
+        return {"type": "json_object"}
+    return None
+
+
+def parse_json(text):
+    """
+    The first JSON object or array in {text}, which may wrap it in a code
+    fence or other text.
+    Raises:
+        ValueError: When {text} holds no JSON object or array.
+    """
+    text = (text or '').strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    decoder = json.JSONDecoder()
+    start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=-1)
+    while start >= 0:
+        try:
+            return decoder.raw_decode(text, start)[0]
+        except ValueError:
+            starts = [i for i in (text.find('{', start + 1), text.find('[', start + 1)) if i >= 0]
+            start = min(starts, default=-1)
+    raise ValueError("no JSON object or array found")
+
+
+def validate(value, schema, path='$'):
+    """
+    Checks {value} against the parts of JSON schema the replies use: type,
+    properties, required, additionalProperties, items and enum.
+    Returns:
+        str or None: What is wrong with the first invalid value, None if it is valid.
+    """
+    expected = schema.get('type')
+    if expected and (not isinstance(value, _TYPES[expected])
+                     or (expected in ('number', 'integer') and isinstance(value, bool))):
+        return f"{path} should be {expected}"
+    if 'enum' in schema and value not in schema['enum']:
+        return f"{path} should be one of {', '.join(map(str, schema['enum']))}"
+    if isinstance(value, dict):
+        properties = schema.get('properties', {})
+        for key in schema.get('required', ()):
+            if key not in value:
+                return f"{path} is missing {key}"
+        for key, item in value.items():
+            if key in properties:
+                error = validate(item, properties[key], f"{path}.{key}")
+                if error:
+                    return error
+            elif schema.get('additionalProperties') is False:
+                return f"{path} has unknown field {key}"
+    elif isinstance(value, list) and 'items' in schema:
+        for index, item in enumerate(value):
+            error = validate(item, schema['items'], f"{path}[{index}]")
+            if error:
+                return error
+    return None
+
+
+def parse_reply(text, schema):
+    """
+    Returns:
+        tuple: (value, None) for a reply matching {schema}, (None, error) otherwise.
+    """
+    try:
+        value = parse_json(text)
+    except ValueError as exc:
+        return None, str(exc)
+    error = validate(value, schema)
+    return (None, error) if error else (value, None)
+
+
+def structured_reply(ask, request, schema, stage):
+    """
+    Sends {request} through {ask}, a function returning the reply text, and
+    parses the reply against {schema}. An invalid reply is sent back once
+    with what is wrong with it.
+    Returns:
+        dict or list or None: The parsed reply, None if the repaired one is still invalid.
+    """
+    reply = ask(request)
+    value, error = parse_reply(reply, schema)
+    if error is None:
+        return value
+    print(f"The {stage} reply is not valid ({error}), asking for a corrected one...")
+    value, error = parse_reply(ask(REPAIR_PROMPT.format(error, schema_format(schema), (reply or '')[:2000])), schema)
+    if error is not None:
+        print(f"The corrected {stage} reply is not valid either ({error}).")
+    return value
+
+
+def string_list(values, limit=None):
+    """
+    The non-empty strings of {values}, stripped and without repeats.
+    """
+    strings = []
+    for value in values:
+        value = value.strip()
+        if value and value not in strings:
+            strings.append(value)
+    return strings[:limit]
+
+
+def links_text(links, limit=None, index=None):
+    """
+    Chosen {links} as markdown, one per line, which the outline and article
+    prompts can copy from. With a LinkIndex {index}, links to URLs that are
+    not on the site are left out.
+    """
+    lines = []
+    for link in links:
+        url = link['url'].strip()
+        if not url or (index is not None and not index.allows(url, link['kind'] == 'image')):
+            continue
+        title = ' '.join(link['title'].replace('[', '(').replace(']', ')').split())
+        line = f"![{title}]({url})" if link['kind'] == 'image' else f"[{title}]({url})"
+        if line not in lines:
+            lines.append(line)
+        if len(lines) == limit:
+            break
+    return "\n".join(lines)
@@ -1,45 +1,66 @@
 import os
 import openai
 import time
-import csv
 from tqdm import tqdm
 import concurrent.futures
 import json
-import re
+import sys
+import collections
+import itertools
+import cassette
+import metrics
+from csv_stream import ChunkedWriter
+from keyword_metrics import rank_keyword_export
+from structured import KEYWORDS_SCHEMA, SUBTOPICS_SCHEMA, response_format, schema_format, string_list, \
+    structured_reply
 
 # Load configuration from a JSON file
 with open('config.json') as config_file:
     config = json.load(config_file)
+metrics.configure(config)
+cassette.install(config)
 
-# Set your OpenAI API key from the config file
-OPENAI_API_TOKEN = config["OPENAI_API_TOKEN"]
-print("Setting OpenAI API Key...")
-os.environ["OPENAI_API_KEY"] = OPENAI_API_TOKEN
+client = None
+assistant = None
 
-# Initialize the OpenAI client
-print("Initializing OpenAI client...")
-client = openai.OpenAI()
 
+def init_assistant():
+    """
+    Creates the OpenAI client and the keyword Assistant, so ranking a keyword
+    metric export needs no API key and makes no calls.
+    """
+    global client, assistant
+    if assistant is not None:
+        return
 
-# Create an Assistant
-print("Creating OpenAI Assistant...")
+    # Set your OpenAI API key from the config file
+    OPENAI_API_TOKEN = config["OPENAI_API_TOKEN"]
+    print("Setting OpenAI API Key...")
+    os.environ["OPENAI_API_KEY"] = OPENAI_API_TOKEN
 
-args = (config['business_name'],
-        config['business_type'],
-        config['country'],
-        config['language'])
+    # Initialize the OpenAI client
+    print("Initializing OpenAI client...")
+    client = openai.OpenAI()
 
-assistant = client.beta.assistants.create(
-    name="Content Creation Assistant",
-    model="gpt-4-turbo-preview",
-    instructions=''' You are SEOGPT, an AI that is profficient in SEO. 
-    Your goal is to give best keywords for a business called {0}.
-    It is a {1} business aimed at the population and consumers located in {2}. The keywords must be in {3}.
-    '''.format(*args),
-    tools=[{"type": "retrieval"}, {"type": "code_interpreter"}],
-)
+    # Create an Assistant
+    print("Creating OpenAI Assistant...")
 
-print("Assistant created successfully.")
+    args = (config['business_name'],
+            config['business_type'],
+            config['country'],
+            config['language'])
+
+    assistant = client.beta.assistants.create(
+        name="Content Creation Assistant",
+        model="gpt-4-turbo-preview",
+        instructions=''' You are SEOGPT, an AI that is profficient in SEO. 
+        Your goal is to give best keywords for a business called {0}.
+        It is a {1} business aimed at the population and consumers located in {2}. The keywords must be in {3}.
+        '''.format(*args),
+        tools=[{"type": "file_search"}, {"type": "code_interpreter"}],
+    )
+
+    print("Assistant created successfully.")
 
 
 def wait_for_run_completion(thread_id, run_id, timeout=300):
@@ -52,33 +73,91 @@ def wait_for_run_completion(thread_id, run_id, timeout=300):
         if run_status.status == 'completed':
             print("Run completed successfully.")
             return run_status
-        time.sleep(10)
+        cassette.sleep(10)
     raise TimeoutError("Run did not complete within the specified timeout.")
 
 
 output_file = "./optimized_keywords.csv"
 
+# Angles that vary the shards generated for the same sub-topic
+KEYWORD_ANGLES = [
+    "informational questions people ask",
+    "long-tail searches with buying intent",
+    "comparisons and alternatives",
+    "how-to guides and tutorials",
+    "problems and their solutions",
+    "beginner topics",
+    "seasonal and local searches",
+    "features, materials and specifications",
+]
 
-def get_keywords(thread_id, count=10):
 
-    keywords = None
-
-    get_request = '''Give me {0} keywords for this niche. Your goal is to come up with such keywords that
-    are with low SEO difficulty, high search volume, low paid difficulty, low cost per click
-    and suited for excellent ranking on Google. 
-    It is very important to give me the keywords in a python list format, no new lines and no trailing new line.
-    Like that: [keyword1, keyword2, keyword3, keyword4, keyword5, keyword6, keyword7, keyword8]. Also do not put the keywords in "" or in ''! '''.format(count)
-    client.beta.threads.messages.create(
-        thread_id=thread_id, role="user", content=get_request)
-    get_request_run = client.beta.threads.runs.create(
-        thread_id=thread_id, assistant_id=assistant.id)
-    wait_for_run_completion(thread_id, get_request_run.id)
+def ask_assistant(thread_id, request, stage, schema=None):
+    """
+    Runs {request} on its own thread and returns the assistant's reply text.
+    With "structured_output" set, the reply is constrained to {schema}, or to
+    JSON for models without Structured Outputs.
+    """
+    run_args = {}
+    output_format = response_format(stage, schema, assistant.model) if schema and config.get('structured_output') else None
+    if output_format:
+        run_args['response_format'] = output_format
+    with metrics.track('openai', assistant.model, stage) as call:
+        client.beta.threads.messages.create(
+            thread_id=thread_id, role="user", content=request)
+        get_request_run = client.beta.threads.runs.create(
+            thread_id=thread_id, assistant_id=assistant.id, **run_args)
+        run_status = wait_for_run_completion(thread_id, get_request_run.id)
+        if getattr(run_status, 'usage', None):
+            call['input_tokens'] = run_status.usage.prompt_tokens
+            call['output_tokens'] = run_status.usage.completion_tokens
 
     messages = client.beta.threads.messages.list(thread_id=thread_id)
 
-    keywords = next(
+    return next(
         (m.content[0].text.value for m in messages.data if m.role == "assistant"), None)
 
+
+def normalize_keyword(keyword):
+    return ' '.join(keyword.lower().split())
+
+
+def structured_answer(thread_id, request, schema, stage):
+    """
+    The assistant's reply to {request} parsed against {schema}, asking once
+    more on the same thread when it is not valid.
+    """
+    return structured_reply(
+        lambda content: ask_assistant(thread_id, content, stage, schema), request, schema, stage)
+
+
+def get_subtopics(thread_id, count=20):
+    get_request = '''Give me {0} distinct sub-topics of this niche that people search for.
+    {1}'''.format(count, schema_format(SUBTOPICS_SCHEMA))
+    reply = structured_answer(thread_id, get_request, SUBTOPICS_SCHEMA, 'subtopics')
+    subtopics = string_list(reply['subtopics']) if reply else []
+    print(f"Got {len(subtopics)} sub-topics.")
+    return subtopics
+
+
+def get_keywords(thread_id, count=10, subtopic=None, angle=None, exclude=()):
+
+    focus = ''
+    if subtopic:
+        focus += 'Only give keywords about the sub-topic "{0}". '.format(subtopic)
+    if angle:
+        focus += 'Focus on {0}. '.format(angle)
+    if exclude:
+        focus += 'Do not repeat any of these keywords: {0}. '.format(', '.join(exclude))
+
+    get_request = '''Give me {0} keywords for this niche. {1}Your goal is to come up with such keywords that
+    are with low SEO difficulty, high search volume, low paid difficulty, low cost per click
+    and suited for excellent ranking on Google. 
+    {2}'''.format(count, focus, schema_format(KEYWORDS_SCHEMA))
+
+    reply = structured_answer(thread_id, get_request, KEYWORDS_SCHEMA, 'keywords')
+    keywords = string_list(reply['keywords']) if reply else []
+
     if keywords:
         print("Keywords returned successfully.")
     else:
@@ -86,30 +165,94 @@ def get_keywords(thread_id, count=10):
 
     return keywords
 
-def process_keywords():
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_row = {executor.submit(get_keywords, client.beta.threads.create(
-        ).id)}
 
-        # Initialize tqdm progress bar
-        progress = tqdm(concurrent.futures.as_completed(
-            future_to_row), desc="Processing Keywords\n")
+def process_keywords(on_keywords=None):
+    """
+    Generates config["keyword_target"] unique keywords by fanning out shards of
+    config["keyword_shard_size"] keywords over sub-topics and angles.
+    Each shard is told to skip the latest keywords already found for its
+    sub-topic, and new keywords are appended to the CSV as shards finish.
+    {on_keywords}, if given, is called with each shard's new keywords so
+    later stages can start on them straight away.
+    """
+    init_assistant()
+    target = config.get('keyword_target', 10)
+    shard_size = config.get('keyword_shard_size', 10)
+    max_workers = config.get('keyword_workers', 5)
+    exclude_limit = config.get('keyword_exclude_limit', 100)
+
+    subtopics = config.get('keyword_subtopics') or []
+    if not subtopics and target > shard_size:
+        subtopics = get_subtopics(client.beta.threads.create().id,
+                                  config.get('keyword_subtopic_count', 20))
+    angles = KEYWORD_ANGLES if target > shard_size else [None]
+    shards = itertools.cycle(itertools.product(subtopics or [None], angles))
+
+    seen = set()
+    recent = {}
+    empty_shards = 0
+
+    with ChunkedWriter(output_file, 'w', header=['Keyword']) as writer, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
 
-        # Regular expression pattern to match content between backticks
-        pattern = r"(\[.*?\])"
+        progress = tqdm(total=target, desc="Processing Keywords")
+        future_to_shard = {}
 
-        for future in progress:
-            # Find all matches
-            matches = re.findall(pattern, future.result(), re.DOTALL)
-            for match in matches:
-                keyword_list = match[1:-1].split(', ')
+        def submit_shard():
+            subtopic, angle = next(shards)
+            exclude = list(recent.get(subtopic, ()))
+            future = executor.submit(get_keywords, client.beta.threads.create().id,
+                                     shard_size, subtopic, angle, exclude)
+            future_to_shard[future] = subtopic
 
-                # Write the list to the CSV file
-                with open(output_file, 'w', newline='') as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerow(['Keyword'])  # Write the header
-                    writer.writerows([[keyword] for keyword in keyword_list]) 
+        for _ in range(min(max_workers, -(-target // shard_size))):
+            submit_shard()
+
+        while future_to_shard and len(seen) < target:
+            done, _ = concurrent.futures.wait(
+                future_to_shard, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                subtopic = future_to_shard.pop(future)
+                try:
+                    keyword_list = future.result()
+                except Exception as exc:
+                    print(f"Keyword shard for {subtopic} generated an exception: {exc}")
+                    keyword_list = []
+
+                new_keywords = []
+                for keyword in keyword_list:
+                    key = normalize_keyword(keyword)
+                    if key not in seen and len(seen) < target:
+                        seen.add(key)
+                        new_keywords.append(keyword)
+                        recent.setdefault(subtopic, collections.deque(maxlen=exclude_limit)).append(keyword)
+
+                writer.writerows([keyword] for keyword in new_keywords)
+                # On disk as soon as each shard returns, for whatever reads the file meanwhile
+                writer.flush()
+                if on_keywords and new_keywords:
+                    on_keywords(new_keywords)
+                progress.update(len(new_keywords))
+                empty_shards = 0 if new_keywords else empty_shards + 1
+
+            if empty_shards >= 2 * max_workers:
+                print("Shards keep returning no new keywords, stopping early.")
+                break
+            while len(future_to_shard) < max_workers and \
+                    len(seen) + len(future_to_shard) * shard_size < target:
+                submit_shard()
+
+        for future in future_to_shard:
+            future.cancel()
+        progress.close()
+
+    print(f"Wrote {len(seen)} unique keywords to {output_file}")
 
 
 if __name__ == "__main__":
-    process_keywords()
+    # A keyword metric export (CSV or Parquet) replaces LLM keyword generation
+    metrics_file = sys.argv[1] if len(sys.argv) > 1 else config.get('keyword_metrics_file')
+    if metrics_file:
+        rank_keyword_export(metrics_file, output_file, config)
+    else:
+        process_keywords()
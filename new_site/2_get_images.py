@@ -1,39 +1,54 @@
-import os
-import csv
 import json
 import requests
+import cassette
+import metrics
+from csv_stream import ChunkedWriter, KeywordRows
 
 
 # Load configuration from a JSON file
 with open('config.json') as config_file:
     config = json.load(config_file)
+metrics.configure(config)
+cassette.install(config)
 
 PEXELS_API_KEY = config["PEXELS_API_KEY"]
 
+# brandimages.txt, kept open and written a chunk of lines at a time
+images_file = ChunkedWriter('brandimages.txt')
+
 
 def get_images(Keyword):
+    """
+    Appends Pexels images for {Keyword} to brandimages.txt.
+    Returns:
+        list: The image URLs.
+    """
     url = f'https://api.pexels.com/v1/search?query={Keyword}'
 
     headers = { 
         'Authorization': PEXELS_API_KEY 
     }
 
-    r = requests.get(url, headers=headers, verify=False)
+    metrics.set_keyword(Keyword)
+    with metrics.track('pexels', None, 'images') as call:
+        r = requests.get(url, headers=headers, verify=False)
+        call['status'] = r.status_code
     
     response = json.loads(r.content)
     photos = response['photos']
-    with open('brandimages.txt', 'a', newline='') as f_output:
-        for photo in photos:
-            f_output.write(photo['src']['small']+'\n')
-
+    image_urls = [photo['src']['small'] for photo in photos]
+    images_file.write_lines(image_urls)
+    return image_urls
 
-input_file = 'optimized_keywords.csv'
 
-# Read all rows to be processed
-with open(input_file, newline='', encoding='utf-8') as csvfile:
-    reader = csv.DictReader(csvfile)
-    rows_to_process = [row for row in reader]
+def process_keywords():
+    input_file = 'optimized_keywords.csv'
 
-    # Process each blog post idea concurrently
-    for row in rows_to_process:
+    # Rows are read one at a time, so the keyword file can be any size
+    for row in KeywordRows(input_file):
         get_images(row['Keyword'])
+    images_file.close()
+
+
+if __name__ == "__main__":
+    process_keywords()
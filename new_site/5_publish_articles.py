@@ -0,0 +1,182 @@
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import cassette
+import metrics
+from article_store import ArticleStore, ARTICLE_STORE, post_slug, site_name
+
+# Load configuration from a JSON file
+with open('config.json') as config_file:
+    config = json.load(config_file)
+metrics.configure(config)
+cassette.install(config)
+
+# Responses worth retrying, with a growing delay
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+H1_PATTERN = re.compile(r"^\s*<h1>(.*?)</h1>\s*", re.DOTALL)
+IMG_PATTERN = re.compile(r'<img src="([^"]+)"')
+
+
+class Publisher:
+    """
+    Posts articles to a WordPress REST API over one pooled keep-alive
+    session. Posts are created or updated by slug, so publishing the same
+    article twice never makes a duplicate. The WordPress credentials are
+    only sent to the REST API; images hosted elsewhere are downloaded
+    through a second session without them.
+    """
+
+    def __init__(self, config, workers):
+        self.api = config['wordpress_url'].rstrip('/') + '/wp-json/wp/v2'
+        self.status = config.get('publish_status', 'draft')
+        self.upload_images = config.get('publish_upload_images', False)
+        self.auth = (config['wordpress_user'], config['wordpress_app_password'])
+        self.session = requests.Session()
+        self.downloads = requests.Session()
+        for session in (self.session, self.downloads):
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.host = urlsplit(self.api).netloc
+        self._media = {}
+        self._media_lock = threading.Lock()
+
+    def request(self, method, path, stage, max_retries=4, **kwargs):
+        """
+        Sends a request to the REST API, or to another server when {path} is
+        a full URL. Only REST API requests carry the WordPress credentials.
+        """
+        if path.startswith('http'):
+            url, session, auth = path, self.downloads, None
+        else:
+            url, session, auth = self.api + path, self.session, self.auth
+        for attempt in range(max_retries):
+            with metrics.track('wordpress', None, stage, retries=attempt) as call:
+                response = session.request(method, url, auth=auth, timeout=60, **kwargs)
+                call['status'] = response.status_code
+            if response.status_code not in RETRY_STATUSES:
+                break
+            print(f"{method} {url} returned {response.status_code}. Attempt {attempt + 1} of {max_retries}.")
+            cassette.sleep(2 ** attempt)
+        response.raise_for_status()
+        return response
+
+    def find_post(self, slug):
+        posts = self.request('GET', '/posts', 'publish_lookup',
+                             params={'slug': slug, 'status': 'any', 'context': 'edit'}).json()
+        return posts[0]['id'] if posts else None
+
+    def upload_image(self, url):
+        """
+        Copies an image hosted elsewhere into the media library, once per URL.
+        Returns the media library URL.
+        """
+        with self._media_lock:
+            if url in self._media:
+                return self._media[url]
+        image = self.request('GET', url, 'publish_image_download')
+        filename = os.path.basename(urlsplit(url).path) or 'image.jpg'
+        media = self.request('POST', '/media', 'publish_image_upload', data=image.content, headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Type': image.headers.get('Content-Type', 'image/jpeg'),
+        }).json()
+        with self._media_lock:
+            self._media[url] = media['source_url']
+        return media['source_url']
+
+    def publish(self, Keyword, html, post_id=None, language=''):
+        """
+        Creates or updates the post for {Keyword} in {language}.
+        Returns:
+            tuple: (slug, post_id)
+        """
+        slug = post_slug(Keyword, language)
+        match = H1_PATTERN.match(html)
+        title = re.sub(r"<[^>]+>", '', match.group(1)) if match else Keyword
+        content = html[match.end():] if match else html
+
+        if self.upload_images:
+            for url in set(IMG_PATTERN.findall(content)):
+                if urlsplit(url).netloc != self.host:
+                    content = content.replace(f'src="{url}"', f'src="{self.upload_image(url)}"')
+
+        post = {'title': title, 'content': content, 'slug': slug, 'status': self.status}
+        post_id = post_id or self.find_post(slug)
+        if post_id:
+            self.request('POST', f'/posts/{post_id}', 'publish', json=post)
+        else:
+            post_id = self.request('POST', '/posts', 'publish', json=post).json()['id']
+        return slug, post_id
+
+
+def read_formatted(input_file):
+    csv.field_size_limit(sys.maxsize)
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield row['Keyword'], row['HTML'], row.get('Language') or ''
+
+
+def publish_articles(input_file='formatted_articles.csv'):
+    """
+    Publishes every article in {input_file} (written by 4_format_articles.py)
+    with "publish_workers" requests in flight. Published slugs and a hash of
+    their content are kept in the article store, so a rerun after a failure
+    only sends what is new or changed.
+    """
+    workers = config.get('publish_workers', 8)
+    publisher = Publisher(config, workers)
+    article_store = ArticleStore(config.get('article_store', ARTICLE_STORE))
+    site = site_name(config)
+    published = article_store.published(site)
+
+    start = time.time()
+    counts = collections.Counter()
+
+    def handle(done):
+        for future in done:
+            Keyword, digest = pending.pop(future)
+            try:
+                slug, post_id = future.result()
+                article_store.mark_published(site, slug, post_id, digest)
+                counts['published'] += 1
+            except Exception as exc:
+                print(f'Keyword {Keyword} could not be published: {exc}')
+                counts['failed'] += 1
+
+    # Futures in flight, at most two per worker so a slow post never stalls the rest
+    pending = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for Keyword, html, language in read_formatted(input_file):
+            digest = hashlib.sha1(html.encode('utf-8')).hexdigest()
+            post_id, published_digest = published.get(post_slug(Keyword, language), (None, None))
+            if published_digest == digest:
+                counts['unchanged'] += 1
+                continue
+            pending[executor.submit(publisher.publish, Keyword, html, post_id, language)] = (Keyword, digest)
+            if len(pending) >= workers * 2:
+                handle(concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED).done)
+        handle(concurrent.futures.wait(pending).done)
+
+    article_store.close()
+    seconds = time.time() - start
+    print(f"Published {counts['published']} posts in {seconds:.1f}s "
+          f"({counts['published'] / max(seconds, 1e-9):.1f} posts/s), "
+          f"{counts['unchanged']} unchanged, {counts['failed']} failed.")
+
+
+if __name__ == "__main__":
+    publish_articles(sys.argv[1] if len(sys.argv) > 1 else 'formatted_articles.csv')
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from article_store import compress, decompress
+
+BUILD_CACHE = 'build_cache.sqlite'
+
+
+def digest(inputs):
+    """
+    sha256 of {inputs}, any JSON-serializable value.
+    """
+    data = json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    """
+    sha256 of the contents of {path}, None if there is no such file.
+    """
+    if not path or not os.path.isfile(path):
+        return None
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f_input:
+        for block in iter(lambda: f_input.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class BuildCache:
+    """
+    Stage outputs (research, link selection, outline, article, ...) stored
+    under a hash of the exact inputs that produced them: the request text,
+    which already holds the keyword and every upstream output, plus the
+    model settings and reference files. Rerunning a batch after a change
+    only recomputes the stages whose inputs changed, like a build system.
+    """
+
+    def __init__(self, path=BUILD_CACHE):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS outputs (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                codec TEXT NOT NULL,
+                value BLOB NOT NULL,
+                created REAL NOT NULL
+            )
+        ''')
+        self._connection.commit()
+        self.reused = {}
+        self.computed = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        The cache at config["build_cache"], or None when it is turned off.
+        """
+        path = config.get('build_cache', BUILD_CACHE)
+        return cls(path) if path else None
+
+    def get(self, stage, inputs):
+        """
+        The stored output of {stage} for {inputs}, or None.
+        """
+        key = digest([stage, inputs])
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT codec, value FROM outputs WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.reused[stage] = self.reused.get(stage, 0) + 1
+        return json.loads(decompress(*row))
+
+    def put(self, stage, inputs, value):
+        codec, data = compress(json.dumps(value, ensure_ascii=False))
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO outputs (key, stage, codec, value, created) VALUES (?, ?, ?, ?, ?)',
+                (digest([stage, inputs]), stage, codec, data, time.time()))
+            self._connection.commit()
+            self.computed[stage] = self.computed.get(stage, 0) + 1
+
+    def get_or_compute(self, stage, inputs, compute):
+        """
+        The stored output of {stage} for {inputs}, or compute() stored under
+        them. Empty results are never stored, so failures are retried.
+        """
+        value = self.get(stage, inputs)
+        if value is None:
+            value = compute()
+            if value:
+                self.put(stage, inputs, value)
+        return value
+
+    def report(self):
+        stages = sorted(set(self.reused) | set(self.computed))
+        if not stages:
+            return "Build cache: no stage results."
+        reused = sum(self.reused.values())
+        total = reused + sum(self.computed.values())
+        parts = [f"{stage} {self.reused.get(stage, 0)}/{self.reused.get(stage, 0) + self.computed.get(stage, 0)}"
+                 for stage in stages]
+        return f"Build cache: reused {reused} of {total} stage results ({', '.join(parts)})."
+
+    def print_report(self):
+        print(self.report())
+
+    def clear(self, stage=None):
+        """
+        Deletes the stored outputs of {stage}, or all of them. Returns how many.
+        """
+        with self._lock:
+            if stage:
+                cursor = self._connection.execute('DELETE FROM outputs WHERE stage = ?', (stage,))
+            else:
+                cursor = self._connection.execute('DELETE FROM outputs')
+            self._connection.commit()
+            return cursor.rowcount
+
+    def counts(self):
+        with self._lock:
+            return dict(self._connection.execute(
+                'SELECT stage, COUNT(*) FROM outputs GROUP BY stage').fetchall())
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def main(argv):
+    # python build_cache.py [clear [stage]]
+    config = {}
+    if os.path.exists('config.json'):
+        with open('config.json') as config_file:
+            config = json.load(config_file)
+    cache = BuildCache(config.get('build_cache') or BUILD_CACHE)
+    if len(argv) > 1 and argv[1] == 'clear':
+        stage = argv[2] if len(argv) > 2 else None
+        print(f"Deleted {cache.clear(stage)} stored {stage or 'stage'} results.")
+    else:
+        print(json.dumps(cache.counts(), indent=2))
+    cache.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
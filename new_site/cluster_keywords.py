@@ -0,0 +1,188 @@
+import csv
+import re
+import sys
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STOPWORDS = {'a', 'an', 'and', 'the', 'for', 'of', 'in', 'on', 'to', 'with', 'vs', 'versus', 'or'}
+
+# MinHash signature length and LSH banding (bands * rows == NUM_PERM)
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+
+# Keys hashed per NumPy batch; each shingle of a batch takes NUM_PERM * 8 bytes
+SIGNATURE_CHUNK = 4096
+
+# Hash permutations are (x * a + b) % _PRIME with a, b below 2**31, so they
+# stay within uint64 for the 32-bit shingle hashes
+_PRIME = (1 << 31) - 1
+
+
+def normalize_keyword(keyword):
+    """
+    Lowercases, strips punctuation and stopwords, singularizes simple plurals
+    and sorts the words, so "Best running shoes" and "running shoe best"
+    share one key.
+    """
+    words = []
+    for word in re.findall(r"\w+", keyword.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.append(word)
+    return ' '.join(sorted(words))
+
+
+def shingles(text):
+    text = f" {text} "
+    return {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))}
+
+
+def _shingle_hashes(text):
+    return [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text)]
+
+
+def _permutations():
+    # Fixed seeds keep clusters stable between runs
+    a = [(2654435761 * (i + 1)) % _PRIME or 1 for i in range(NUM_PERM)]
+    b = [(40503 * (i + 7) * 12345) % _PRIME for i in range(NUM_PERM)]
+    return a, b
+
+
+def minhash_signatures(keys):
+    """
+    Returns one MinHash signature (a tuple of NUM_PERM ints) per key, over its
+    character shingles. Uses NumPy when it is installed, {SIGNATURE_CHUNK}
+    keys at a time, so memory stays flat however many keys there are.
+    """
+    a, b = _permutations()
+    if np is None:
+        return [tuple(min((x * a[i] + b[i]) % _PRIME for x in _shingle_hashes(key)) for i in range(NUM_PERM))
+                for key in keys]
+
+    a = np.array(a, dtype=np.uint64)
+    b = np.array(b, dtype=np.uint64)
+    signatures = []
+    for start in range(0, len(keys), SIGNATURE_CHUNK):
+        hashes = [_shingle_hashes(key) for key in keys[start:start + SIGNATURE_CHUNK]]
+        lengths = np.fromiter((len(row) for row in hashes), dtype=np.int64, count=len(hashes))
+        flat = np.fromiter((x for row in hashes for x in row), dtype=np.uint64, count=int(lengths.sum()))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        permuted = (flat[:, None] * a + b) % np.uint64(_PRIME)
+        signatures.extend(tuple(row) for row in np.minimum.reduceat(permuted, offsets, axis=0).tolist())
+    return signatures
+
+
+def numbers(text):
+    # "size 10" and "size 11" are different keywords however similar they look
+    return re.findall(r"\d+", text)
+
+
+def jaccard(left, right):
+    if not left and not right:
+        return 1.0
+    return len(left & right) / len(left | right)
+
+
+def cluster_keywords(keywords, threshold=0.7):
+    """
+    Groups near-duplicate keywords.
+    Keywords with the same normalized form always share a cluster. Other
+    candidates come from MinHash LSH on character shingles and are kept when
+    they contain the same numbers and their shingle Jaccard similarity is at
+    least {threshold}.
+    Args:
+        keywords (list): Keywords in priority order.
+        threshold (float): Minimum Jaccard similarity to merge two keys.
+    Returns:
+        list: (representative, [secondary keywords]) pairs in input order.
+        The representative is the first keyword of each cluster.
+    """
+    key_index = {}
+    members = []
+    for keyword in keywords:
+        key = normalize_keyword(keyword) or keyword.lower()
+        if key not in key_index:
+            key_index[key] = len(members)
+            members.append([])
+        members[key_index[key]].append(keyword)
+
+    keys = list(key_index)
+    parent = list(range(len(keys)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    shingle_sets = {}
+
+    def shingle_set(i):
+        if i not in shingle_sets:
+            shingle_sets[i] = shingles(keys[i])
+        return shingle_sets[i]
+
+    signatures = minhash_signatures(keys)
+    for band in range(BANDS):
+        buckets = {}
+        start = band * ROWS
+        for i, signature in enumerate(signatures):
+            buckets.setdefault(signature[start:start + ROWS], []).append(i)
+        for bucket in buckets.values():
+            if len(bucket) < 2:
+                continue
+            for i in bucket[1:]:
+                root_i, root_first = find(i), find(bucket[0])
+                if root_i != root_first and numbers(keys[i]) == numbers(keys[bucket[0]]) \
+                        and jaccard(shingle_set(i), shingle_set(bucket[0])) >= threshold:
+                    parent[max(root_i, root_first)] = min(root_i, root_first)
+
+    clusters = {}
+    for i in range(len(keys)):
+        clusters.setdefault(find(i), []).extend(members[i])
+    return [(group[0], group[1:]) for _, group in sorted(clusters.items())]
+
+
+def main(argv):
+    input_file = argv[1] if len(argv) > 1 else 'optimized_keywords.csv'
+    output_file = argv[2] if len(argv) > 2 else input_file
+    threshold = float(argv[3]) if len(argv) > 3 else 0.7
+
+    start = time.time()
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        fieldnames = list(reader.fieldnames)
+        rows = {}
+        for row in reader:
+            if row['Keyword'].strip():
+                rows.setdefault(row['Keyword'], row)
+    if 'Secondary Keywords' not in fieldnames:
+        fieldnames.append('Secondary Keywords')
+
+    keywords = list(rows)
+    clusters = cluster_keywords(keywords, threshold)
+
+    with open(output_file, 'w', newline='', encoding='utf-8') as f_output:
+        writer = csv.DictWriter(f_output, fieldnames=fieldnames)
+        writer.writeheader()
+        for keyword, secondary in clusters:
+            row = rows[keyword]
+            earlier = [k for k in (row.get('Secondary Keywords') or '').split('; ') if k]
+            row['Secondary Keywords'] = '; '.join(earlier + secondary)
+            writer.writerow(row)
+
+    print(f"Clustered {len(keywords)} keywords into {len(clusters)} in {time.time() - start:.2f}s, "
+          f"wrote {output_file}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import cassette
+
+# The shortest timeout timeout() gives a call that starts just before the deadline
+MIN_TIMEOUT = 0.1
+
+_local = threading.local()
+_cancelled = threading.Event()
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised inside a worker whose keyword ran out of time, or when the whole
+    batch is being cancelled.
+    """
+
+
+def start(seconds):
+    """
+    Gives the keyword on the current worker thread {seconds} from now to
+    finish, end to end. None or 0 means no limit.
+    """
+    _local.expires = time.time() + seconds if seconds else None
+
+
+def expires():
+    """
+    When the current thread's keyword runs out of time, for handing the
+    deadline to helper threads with restore().
+    """
+    return getattr(_local, 'expires', None)
+
+
+def restore(expires_at):
+    _local.expires = expires_at
+
+
+def remaining(cap=None):
+    """
+    Seconds left for the current thread's keyword, at most {cap}.
+    {cap} (None for no limit) when there is no deadline.
+    """
+    expires_at = expires()
+    if expires_at is None:
+        return cap
+    left = max(expires_at - time.time(), 0.0)
+    return left if cap is None else min(left, cap)
+
+
+def check(stage=''):
+    """
+    Raises DeadlineExceeded when the batch was cancelled or the current
+    keyword is out of time. Called before every API call and while waiting
+    on one.
+    """
+    if _cancelled.is_set():
+        raise DeadlineExceeded("The batch was cancelled.")
+    if remaining() == 0:
+        raise DeadlineExceeded(f"The keyword ran out of time{' in ' + stage if stage else ''}.")
+
+
+def timeout(cap, stage=''):
+    """
+    The timeout for an API call of {stage}: the seconds left, at most {cap}.
+    Raises DeadlineExceeded rather than return 0, which requests and the
+    SDKs reject.
+    """
+    check(stage)
+    left = remaining(cap)
+    return left if left is None else max(left, MIN_TIMEOUT)
+
+
+def sleep(seconds):
+    """
+    cassette.sleep that wakes up early at the deadline or on cancellation.
+    """
+    check()
+    end = time.time() + remaining(seconds)
+    while not _cancelled.is_set() and time.time() < end:
+        cassette.sleep(min(end - time.time(), 1.0))
+        if cassette.MODE == 'replay_fast':
+            break
+    check()
+
+
+def cancel_all():
+    """
+    Makes every worker stop at its next check, cancelling the API runs
+    they are waiting on.
+    """
+    _cancelled.set()
+
+
+def reset():
+    _cancelled.clear()
@@ -0,0 +1,236 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from article_store import site_name
+
+JOB_QUEUE = 'sqlite:///jobs.sqlite'
+
+
+class SQLiteQueue:
+    """
+    Durable lease-based job queue in one SQLite file. Workers claim pending
+    jobs, or jobs whose lease has expired, renew their leases while they
+    work and mark each job done or failed. A worker that dies simply lets
+    its leases run out, and its jobs go back to the others.
+
+    The file is in WAL mode, which needs shared memory between the workers,
+    so they must all run on the host the file is on, never over NFS or SMB.
+    Workers on several machines need a networked backend with the same
+    methods, added to BACKENDS.
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                queue TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                error TEXT,
+                updated REAL NOT NULL,
+                priority REAL NOT NULL DEFAULT 0,
+                UNIQUE (queue, keyword)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (queue, status, lease_expires);
+        ''')
+        # Queues made before jobs had a priority
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(jobs)')]
+        if 'priority' not in columns:
+            self._connection.execute('ALTER TABLE jobs ADD COLUMN priority REAL NOT NULL DEFAULT 0')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_priority ON jobs (queue, status, priority DESC, id)')
+
+    def enqueue(self, queue, rows, priority=None):
+        """
+        Adds one job per row (a dict with a Keyword column), with the
+        priority given by {priority}(row). Keywords already in {queue} are
+        left as they are. Returns the number added.
+        """
+        now = time.time()
+        with self._lock:
+            before = self._connection.total_changes
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO jobs (queue, keyword, payload, updated, priority) VALUES (?, ?, ?, ?, ?)',
+                ((queue, row['Keyword'], json.dumps(row), now, priority(row) if priority else 0)
+                 for row in rows))
+            self._connection.execute('COMMIT')
+            return self._connection.total_changes - before
+
+    def prioritize(self, queue, rows, priority):
+        """
+        Adds {rows} with {priority}, or raises the priority of the ones
+        already waiting in {queue}. Failed jobs get another go; finished
+        ones are left alone.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._connection.executemany(
+                "INSERT INTO jobs (queue, keyword, payload, updated, priority) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (queue, keyword) DO UPDATE SET priority = excluded.priority, "
+                "status = CASE WHEN status = 'failed' THEN 'pending' ELSE status END, "
+                "attempts = CASE WHEN status = 'failed' THEN 0 ELSE attempts END, "
+                "updated = excluded.updated WHERE status != 'done'",
+                [(queue, row['Keyword'], json.dumps(row), now, priority) for row in rows])
+            self._connection.execute('COMMIT')
+
+    def claim(self, queue, worker, lease_seconds, limit=1):
+        """
+        Leases up to {limit} jobs to {worker}, highest priority first.
+        Returns:
+            list: (job_id, row) pairs.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Jobs whose workers keep dying are given up on
+                self._connection.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'lease expired too often', updated = ? "
+                    "WHERE queue = ? AND status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                    (now, queue, now, self.max_attempts))
+                jobs = self._connection.execute(
+                    "SELECT id, payload FROM jobs WHERE queue = ? AND (status = 'pending' "
+                    "OR (status = 'leased' AND lease_expires < ?)) ORDER BY priority DESC, id LIMIT ?",
+                    (queue, now, limit)).fetchall()
+                self._connection.executemany(
+                    "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+                    "attempts = attempts + 1, updated = ? WHERE id = ?",
+                    [(worker, now + lease_seconds, now, job_id) for job_id, _ in jobs])
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+        return [(job_id, json.loads(payload)) for job_id, payload in jobs]
+
+    def heartbeat(self, job_ids, worker, lease_seconds):
+        """
+        Extends the leases {worker} still holds. Returns the job ids it lost.
+        """
+        now = time.time()
+        lost = []
+        with self._lock:
+            for job_id in job_ids:
+                cursor = self._connection.execute(
+                    "UPDATE jobs SET lease_expires = ?, updated = ? "
+                    "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                    (now + lease_seconds, now, job_id, worker))
+                if cursor.rowcount == 0:
+                    lost.append(job_id)
+        return lost
+
+    def complete(self, job_id, worker, ok=True, error=None):
+        """
+        Marks a leased job done, or sends it back to pending until it has
+        failed max_attempts times. Returns False if {worker} no longer
+        holds the lease.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET status = CASE WHEN ? THEN 'done' WHEN attempts >= ? THEN 'failed' "
+                "ELSE 'pending' END, lease_owner = NULL, lease_expires = NULL, error = ?, updated = ? "
+                "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                (ok, self.max_attempts, error, time.time(), job_id, worker))
+            return cursor.rowcount == 1
+
+    def counts(self, queue):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT status, COUNT(*) FROM jobs WHERE queue = ? GROUP BY status', (queue,)).fetchall()
+        return dict(rows)
+
+    def workers(self, queue):
+        """
+        Number of workers holding a live lease in {queue}.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(DISTINCT lease_owner) FROM jobs WHERE queue = ? AND status = 'leased' "
+                "AND lease_expires >= ?", (queue, time.time())).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# Queue backends by URL scheme, e.g. "sqlite:///jobs.sqlite"
+BACKENDS = {
+    'sqlite': lambda location, config: SQLiteQueue(
+        location[1:] if location.startswith('/') else location, config.get('job_max_attempts', 3)),
+}
+
+
+def open_queue(config):
+    url = config.get('job_queue') or JOB_QUEUE
+    scheme, _, location = url.partition('://')
+    if scheme not in BACKENDS:
+        raise ValueError(f"Unknown job_queue backend: {scheme}")
+    return BACKENDS[scheme](location, config)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Heartbeat:
+    """
+    Background thread that renews the leases of the jobs a worker is
+    running every third of the lease time.
+    """
+
+    def __init__(self, job_queue, worker, lease_seconds):
+        self.job_queue = job_queue
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.job_ids = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, job_id):
+        with self._lock:
+            self.job_ids.add(job_id)
+
+    def remove(self, job_id):
+        with self._lock:
+            self.job_ids.discard(job_id)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                job_ids = list(self.job_ids)
+            for job_id in self.job_queue.heartbeat(job_ids, self.worker, self.lease_seconds):
+                print(f"Lost the lease on job {job_id}, another worker will redo it.")
+                self.remove(job_id)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def main():
+    # Prints how many jobs of this site's batch are pending, leased, done and failed
+    with open('config.json') as config_file:
+        config = json.load(config_file)
+    job_queue = open_queue(config)
+    print(json.dumps(job_queue.counts(site_name(config)), indent=2))
+    job_queue.close()
+
+
+if __name__ == "__main__":
+    main()
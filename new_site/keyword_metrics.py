@@ -0,0 +1,179 @@
+import csv
+import math
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Column names used by common keyword tool exports, mapped to ours
+COLUMN_ALIASES = {
+    'keyword': 'keyword', 'keywords': 'keyword', 'query': 'keyword',
+    'volume': 'volume', 'search volume': 'volume', 'avg. monthly searches': 'volume',
+    'difficulty': 'difficulty', 'kd': 'difficulty', 'keyword difficulty': 'difficulty', 'kd %': 'difficulty',
+    'cpc': 'cpc', 'cpc (usd)': 'cpc', 'top of page bid (high range)': 'cpc',
+    'intent': 'intent', 'intents': 'intent', 'search intent': 'intent',
+}
+
+DEFAULT_FORMULA = "log1p(volume) * (1 - difficulty / 100) / (1 + cpc) * intent"
+
+DEFAULT_INTENT_WEIGHTS = {
+    'informational': 1.0,
+    'commercial': 1.2,
+    'transactional': 1.1,
+    'navigational': 0.5,
+}
+
+# Names a score formula may use besides the metric columns
+_FORMULA_FUNCTIONS = ('log', 'log1p', 'sqrt', 'exp', 'minimum', 'maximum', 'where', 'clip')
+
+
+def _to_number(value):
+    try:
+        return float(str(value).replace(',', '').replace('$', '').strip() or 'nan')
+    except ValueError:
+        return float('nan')
+
+
+def load_metrics(path):
+    """
+    Loads a keyword metric export (CSV or Parquet) into NumPy columns.
+    Returns:
+        dict: 'keyword' and 'intent' as object arrays, 'volume', 'difficulty'
+        and 'cpc' as float arrays with missing values set to 0.
+    """
+    if np is None:
+        raise ImportError("Ranking keyword metrics needs numpy (and pandas for Parquet files).")
+
+    if pd is not None:
+        frame = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path, low_memory=False)
+        frame = frame.rename(columns=lambda name: COLUMN_ALIASES.get(str(name).strip().lower(), name))
+        frame = frame.loc[:, ~frame.columns.duplicated()]
+        columns = {'keyword': frame['keyword'].astype(str).to_numpy(dtype=object)}
+        for name in ('volume', 'difficulty', 'cpc'):
+            if name in frame:
+                values = pd.to_numeric(frame[name].astype(str).str.replace(r'[,$]', '', regex=True),
+                                       errors='coerce')
+                columns[name] = values.fillna(0).to_numpy(dtype=float)
+        if 'intent' in frame:
+            columns['intent'] = frame['intent'].fillna('').astype(str).to_numpy(dtype=object)
+    else:
+        if path.endswith('.parquet'):
+            raise ImportError("Reading Parquet keyword exports needs pandas.")
+        with open(path, newline='', encoding='utf-8') as csvfile:
+            reader = csv.reader(csvfile)
+            header = [COLUMN_ALIASES.get(name.strip().lower(), name) for name in next(reader)]
+            positions = {name: header.index(name) for name in COLUMN_ALIASES.values() if name in header}
+            rows = list(reader)
+        columns = {'keyword': np.array([row[positions['keyword']] for row in rows], dtype=object)}
+        for name in ('volume', 'difficulty', 'cpc'):
+            if name in positions:
+                values = np.array([_to_number(row[positions[name]]) for row in rows], dtype=float)
+                columns[name] = np.nan_to_num(values)
+        if 'intent' in positions:
+            columns['intent'] = np.array([row[positions['intent']] for row in rows], dtype=object)
+
+    size = len(columns['keyword'])
+    for name in ('volume', 'difficulty', 'cpc'):
+        columns.setdefault(name, np.zeros(size))
+    columns.setdefault('intent', np.full(size, '', dtype=object))
+    return columns
+
+
+def intent_weights(intents, weights):
+    """
+    Maps each row's intent labels to a weight. Rows with several intents
+    ("commercial, informational") get the highest of their weights; rows
+    without a known intent get 1.
+    """
+    uniques, inverse = np.unique(intents.astype(str), return_inverse=True)
+    unique_weights = np.ones(len(uniques))
+    for i, intent in enumerate(uniques):
+        parts = [part.strip().lower() for part in intent.replace(';', ',').split(',')]
+        known = [weights[part] for part in parts if part in weights]
+        if known:
+            unique_weights[i] = max(known)
+    return unique_weights[inverse]
+
+
+def score_keywords(columns, formula=DEFAULT_FORMULA, weights=None):
+    """
+    Evaluates {formula} over whole columns at once. The formula can use
+    volume, difficulty, cpc, intent (the intent weight) and the NumPy
+    functions in _FORMULA_FUNCTIONS.
+    """
+    namespace = {name: getattr(np, name) for name in _FORMULA_FUNCTIONS}
+    namespace.update({
+        'volume': columns['volume'],
+        'difficulty': columns['difficulty'],
+        'cpc': columns['cpc'],
+        'intent': intent_weights(columns['intent'], weights or DEFAULT_INTENT_WEIGHTS),
+    })
+    code = compile(formula, '<keyword_score_formula>', 'eval')
+    for name in code.co_names:
+        if name not in namespace:
+            raise ValueError(f"Unknown name in keyword score formula: {name}")
+    scores = eval(code, {'__builtins__': {}}, namespace)
+    return np.nan_to_num(np.broadcast_to(np.asarray(scores, dtype=float), columns['volume'].shape),
+                         nan=-math.inf)
+
+
+def top_keywords(columns, scores, top_n, min_volume=0, max_difficulty=100):
+    """
+    Returns the row indexes of the {top_n} best scoring unique keywords,
+    best first.
+    """
+    keep = (columns['volume'] >= min_volume) & (columns['difficulty'] <= max_difficulty)
+    candidates = np.flatnonzero(keep)
+    keywords = columns['keyword']
+
+    # Sort only a shortlist picked with argpartition, unless duplicates use it up
+    shortlist = max(top_n * 2, top_n + 1000)
+    while True:
+        if shortlist < len(candidates):
+            part = candidates[np.argpartition(-scores[candidates], shortlist - 1)[:shortlist]]
+        else:
+            part = candidates
+        ordered = part[np.argsort(-scores[part], kind='stable')]
+
+        seen = set()
+        chosen = []
+        for index in ordered:
+            key = ' '.join(keywords[index].lower().split())
+            if key not in seen:
+                seen.add(key)
+                chosen.append(index)
+                if len(chosen) == top_n:
+                    return chosen
+        if len(part) == len(candidates):
+            return chosen
+        shortlist *= 4
+
+
+def rank_keyword_export(path, output_file, config):
+    """
+    Scores a keyword metric export and writes the top config["keyword_target"]
+    keywords, best first, to {output_file}. No API calls are made.
+    """
+    start = time.time()
+    columns = load_metrics(path)
+    scores = score_keywords(columns, config.get('keyword_score_formula', DEFAULT_FORMULA),
+                            config.get('keyword_intent_weights'))
+    chosen = top_keywords(columns, scores, config.get('keyword_target', 10),
+                          config.get('keyword_min_volume', 0), config.get('keyword_max_difficulty', 100))
+
+    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Keyword', 'Volume', 'Difficulty', 'CPC', 'Intent', 'Score'])
+        writer.writerows([[columns['keyword'][i], int(columns['volume'][i]), columns['difficulty'][i],
+                           columns['cpc'][i], columns['intent'][i], round(float(scores[i]), 4)]
+                          for i in chosen])
+
+    print(f"Ranked {len(columns['keyword'])} keywords in {time.time() - start:.2f}s, "
+          f"wrote the top {len(chosen)} to {output_file}")
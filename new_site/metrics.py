@@ -0,0 +1,284 @@
+import atexit
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+# Append-only log with one JSON record per API call
+METRICS_LOG = 'metrics.jsonl'
+
+_lock = threading.Lock()
+_local = threading.local()
+_listeners = []
+
+# The open metrics log, shared by every thread and kept open between calls
+_log_file = None
+
+# Response headers carrying the remaining rate limit, per provider
+RATE_LIMIT_HEADERS = {
+    'requests': ('x-ratelimit-remaining-requests', 'anthropic-ratelimit-requests-remaining',
+                 'x-ratelimit-remaining'),
+    'tokens': ('x-ratelimit-remaining-tokens', 'anthropic-ratelimit-tokens-remaining'),
+}
+
+
+def configure(config):
+    """
+    Points the metrics log at config["metrics_log"] if it is set.
+    """
+    global METRICS_LOG
+    with _lock:
+        path = config.get('metrics_log', METRICS_LOG)
+        if path != METRICS_LOG:
+            _close_log()
+        METRICS_LOG = path
+
+
+def set_keyword(Keyword):
+    """
+    Tags every call made from the current worker thread with {Keyword}.
+    """
+    _local.keyword = Keyword
+
+
+def current_keyword():
+    """
+    The keyword set for the current worker thread, if any.
+    """
+    return getattr(_local, 'keyword', None)
+
+
+def add_listener(listener):
+    """
+    Registers listener(event, record), called with 'start' and 'end' for every
+    tracked call.
+    """
+    _listeners.append(listener)
+
+
+def rate_limits(headers):
+    """
+    Extracts the remaining request/token limits from response headers.
+    """
+    limits = {}
+    for kind, names in RATE_LIMIT_HEADERS.items():
+        for name in names:
+            value = headers.get(name)
+            if value is not None:
+                try:
+                    limits[kind] = int(value)
+                except ValueError:
+                    pass
+                break
+    return limits
+
+
+def write_record(record):
+    """
+    Appends {record} to the metrics log as one line. The log is opened once
+    and line buffered, so every record is on disk as soon as it is written.
+    """
+    global _log_file
+    line = json.dumps(record, ensure_ascii=False)
+    with _lock:
+        if _log_file is None:
+            _log_file = open(METRICS_LOG, 'a', encoding='utf-8', buffering=1)
+        _log_file.write(line + '\n')
+
+
+def _close_log():
+    # Called with _lock held
+    global _log_file
+    if _log_file is not None:
+        _log_file.close()
+        _log_file = None
+
+
+def close():
+    """
+    Closes the metrics log. The next record opens it again.
+    """
+    with _lock:
+        _close_log()
+
+
+atexit.register(close)
+
+
+def track(provider, model, stage, retries=0, report=None):
+    """
+    Context manager that times one API call and appends it to the metrics log.
+    The yielded dict can be updated with 'input_tokens', 'output_tokens',
+    'status' and 'rate_limit'. Exceptions are recorded with their HTTP status when they have one.
+    Args:
+        provider (str): e.g. "openai", "anthropic", "perplexity", "pexels".
+        model (str or None): The model used, if any.
+        stage (str): The pipeline stage, e.g. "research" or "article".
+        retries (int): How many attempts preceded this one.
+        report (UsageReport or None): Also add the call to this in-memory report.
+    """
+    return _TrackedCall(provider, model, stage, retries, report)
+
+
+class _TrackedCall:
+
+    def __init__(self, provider, model, stage, retries, report):
+        self.report = report
+        self.record = {
+            'provider': provider,
+            'model': model,
+            'stage': stage,
+            'keyword': getattr(_local, 'keyword', None),
+            'retries': retries,
+            'thread': threading.get_ident(),
+            'input_tokens': 0,
+            'output_tokens': 0,
+            'status': None,
+        }
+
+    def __enter__(self):
+        self.start = time.time()
+        for listener in _listeners:
+            listener('start', self.record)
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        record = self.record
+        record['ts'] = self.start
+        record['seconds'] = round(time.time() - self.start, 3)
+        if exc is not None:
+            record['status'] = getattr(exc, 'status_code', None) or exc_type.__name__
+        elif record['status'] is None:
+            record['status'] = 200
+        write_record(record)
+        for listener in _listeners:
+            listener('end', record)
+        if self.report is not None:
+            self.report.record(record['stage'], record['model'] or record['provider'],
+                               record['seconds'], record['input_tokens'], record['output_tokens'])
+        return False
+
+
+def read_records(path):
+    with open(path, encoding='utf-8') as f_input:
+        for line in f_input:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(values)))
+    return values[rank - 1]
+
+
+def call_cost(record, prices):
+    """
+    Cost in USD of one call, using prices per million input/output tokens.
+    """
+    input_price, output_price = prices.get(record.get('model'), (0, 0))
+    return (record.get('input_tokens', 0) * input_price
+            + record.get('output_tokens', 0) * output_price) / 1000000.0
+
+
+def summarize(records, prices):
+    stages = {}
+    models = {}
+    keywords = set()
+    articles = set()
+    first = last = None
+    total_cost = 0.0
+    # The attempts of one call run in one thread with rising "retries" (how
+    # many attempts came before), so a call's retries are its highest value
+    calls = {}
+
+    def end_call(key):
+        stage_name, retries = calls.pop(key)
+        stages[stage_name]['retries'] += retries
+
+    for record in records:
+        ok = record['status'] == 200
+        start = record['ts']
+        end = start + record['seconds']
+        first = start if first is None else min(first, start)
+        last = end if last is None else max(last, end)
+        if record.get('keyword'):
+            keywords.add(record['keyword'])
+        if record['stage'] == 'article' and ok:
+            articles.add(record.get('keyword') or ('call', record['ts']))
+
+        cost = call_cost(record, prices)
+        total_cost += cost
+
+        stage = stages.setdefault(record['stage'], {
+            'latencies': [], 'failed': 0, 'retries': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0})
+        stage['latencies'].append(record['seconds'])
+        stage['failed'] += 0 if ok else 1
+        call_key = (record.get('thread'), record['stage'], record.get('keyword'))
+        retries = record.get('retries') or 0
+        if call_key in calls and retries <= calls[call_key][1]:
+            end_call(call_key)
+        calls[call_key] = (record['stage'], max(retries, calls.get(call_key, (None, 0))[1]))
+        stage['input_tokens'] += record.get('input_tokens', 0)
+        stage['output_tokens'] += record.get('output_tokens', 0)
+        stage['cost'] += cost
+
+        model = models.setdefault((record['provider'], record.get('model')), [0, 0, 0, 0.0])
+        model[0] += 1
+        model[1] += record.get('input_tokens', 0)
+        model[2] += record.get('output_tokens', 0)
+        model[3] += cost
+
+    for call_key in list(calls):
+        end_call(call_key)
+
+    if first is None:
+        return "No API calls recorded."
+
+    hours = max(last - first, 1e-9) / 3600.0
+    articles = len(articles)
+    lines = [
+        f"Wall time: {hours * 60:.1f} min, keywords: {len(keywords)}, articles: {articles}",
+        f"Throughput: {articles / hours:.1f} articles/hour",
+        f"Total cost: ${total_cost:.4f}, cost per article: ${total_cost / articles:.4f}"
+        if articles else f"Total cost: ${total_cost:.4f}",
+        "",
+        "{:<14} {:>7} {:>7} {:>8} {:>8} {:>8} {:>12} {:>12} {:>10}".format(
+            'Stage', 'Calls', 'Failed', 'Retries', 'p50 s', 'p95 s', 'In tokens', 'Out tokens', 'Cost $'),
+    ]
+    for name, stage in sorted(stages.items()):
+        latencies = sorted(stage['latencies'])
+        lines.append("{:<14} {:>7} {:>7} {:>8} {:>8.2f} {:>8.2f} {:>12} {:>12} {:>10.4f}".format(
+            name, len(latencies), stage['failed'], stage['retries'],
+            percentile(latencies, 50), percentile(latencies, 95),
+            stage['input_tokens'], stage['output_tokens'], stage['cost']))
+
+    lines.append("")
+    lines.append("{:<12} {:<32} {:>7} {:>12} {:>12} {:>10}".format(
+        'Provider', 'Model', 'Calls', 'In tokens', 'Out tokens', 'Cost $'))
+    for (provider, model), (calls, input_tokens, output_tokens, cost) in sorted(
+            models.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+        lines.append("{:<12} {:<32} {:>7} {:>12} {:>12} {:>10.4f}".format(
+            provider, model or '-', calls, input_tokens, output_tokens, cost))
+    return "\n".join(lines)
+
+
+def main(argv):
+    config = {}
+    if os.path.exists('config.json'):
+        with open('config.json') as config_file:
+            config = json.load(config_file)
+    path = argv[1] if len(argv) > 1 else config.get('metrics_log', METRICS_LOG)
+    prices = {model: tuple(price) for model, price in config.get('model_prices', {}).items()}
+    print(summarize(read_records(path), prices))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,67 @@
+import threading
+
+
+def stage_settings(config, config_key, stage, default_model, default_max_tokens=None):
+    """
+    Looks up the model and max_tokens for a pipeline stage.
+    Args:
+        config (dict): The loaded config.json.
+        config_key (str): The per-stage map in the config, e.g. "openai_stage_models".
+        stage (str): The stage name, e.g. "links", "outline" or "article".
+        default_model (str): Model to use when the stage is not configured.
+        default_max_tokens (int or None): max_tokens to use when not configured.
+    Returns:
+        tuple: (model, max_tokens)
+    """
+    stage_config = config.get(config_key, {}).get(stage, {})
+    model = stage_config.get("model", default_model)
+    max_tokens = stage_config.get("max_tokens", default_max_tokens)
+    return model, max_tokens
+
+
+class UsageReport:
+    """
+    Collects latency and token usage per (stage, model) across worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, stage, model, seconds, input_tokens=0, output_tokens=0):
+        with self._lock:
+            totals = self._totals.setdefault(
+                (stage, model), {'calls': 0, 'seconds': 0.0, 'input_tokens': 0, 'output_tokens': 0})
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            totals['input_tokens'] += input_tokens or 0
+            totals['output_tokens'] += output_tokens or 0
+
+    def summary(self):
+        with self._lock:
+            items = sorted(self._totals.items())
+        lines = ["{:<14} {:<32} {:>6} {:>10} {:>9} {:>12} {:>12}".format(
+            'Stage', 'Model', 'Calls', 'Total s', 'Avg s', 'In tokens', 'Out tokens')]
+        for (stage, model), totals in items:
+            lines.append("{:<14} {:<32} {:>6} {:>10.1f} {:>9.2f} {:>12} {:>12}".format(
+                stage, model, totals['calls'], totals['seconds'],
+                totals['seconds'] / totals['calls'],
+                totals['input_tokens'], totals['output_tokens']))
+
+        per_model = {}
+        for (stage, model), totals in items:
+            model_totals = per_model.setdefault(model, [0, 0.0, 0, 0])
+            model_totals[0] += totals['calls']
+            model_totals[1] += totals['seconds']
+            model_totals[2] += totals['input_tokens']
+            model_totals[3] += totals['output_tokens']
+        lines.append("")
+        for model, (calls, seconds, input_tokens, output_tokens) in sorted(per_model.items()):
+            lines.append("{:<14} {:<32} {:>6} {:>10.1f} {:>9.2f} {:>12} {:>12}".format(
+                'all stages', model, calls, seconds, seconds / calls, input_tokens, output_tokens))
+        return "\n".join(lines)
+
+    def print_summary(self):
+        print("Usage per stage and model:")
+        print(self.summary())
+
@@ -0,0 +1,209 @@
+import concurrent.futures
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import cassette
+import deadline
+import metrics
+from article_store import ArticleStore, ARTICLE_STORE, site_name
+from build_cache import BuildCache, BUILD_CACHE
+from csv_stream import KeywordRows
+from scheduler import Pacer, Scheduler, load_estimates
+
+# The article script each site runs unless it names another one
+ARTICLE_SCRIPTS = ('3_get_articles.py', 'get_articles.py')
+
+# Site settings holding paths, which are relative to the site's folder
+PATH_SETTINGS = ('article_store', 'sitemap', 'urgent_keywords_file', 'keyword_metrics_file')
+
+
+class Site:
+    """
+    One site of a multi-site run: its folder, config.json, article store,
+    keyword scheduler and its own copy of the article script, configured
+    with that config so the script's module-level state stays per site.
+    """
+
+    def __init__(self, index, entry, run_config, base_dir):
+        if isinstance(entry, str):
+            entry = {'dir': entry}
+        self.dir = os.path.abspath(os.path.join(base_dir, entry['dir']))
+        with open(os.path.join(self.dir, 'config.json')) as config_file:
+            config = json.load(config_file)
+        for key, value in config.items():
+            if (key.startswith('path_to_') or key in PATH_SETTINGS) and isinstance(value, str) \
+                    and value and '://' not in value:
+                config[key] = os.path.join(self.dir, value)
+        config.setdefault('article_store', os.path.join(self.dir, ARTICLE_STORE))
+        # The run's metrics log and build cache, one cassette and no status server per site
+        config['metrics_log'] = run_config.get('metrics_log', metrics.METRICS_LOG)
+        config['build_cache'] = run_config.get('build_cache', BUILD_CACHE)
+        for key in ('cassette_mode', 'status_port'):
+            config.pop(key, None)
+        self.config = config
+        self.name = site_name(config)
+        self.weight = entry.get('weight', 1)
+        self.input_file = os.path.join(self.dir, entry.get('keywords', 'optimized_keywords.csv'))
+
+        script = entry.get('script') or next(
+            name for name in ARTICLE_SCRIPTS if os.path.exists(os.path.join(os.path.dirname(__file__), name)))
+        path = os.path.abspath(os.path.join(os.path.dirname(__file__), script))
+        spec = importlib.util.spec_from_file_location(f"site_{index}_articles", path)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+        self.module.configure(config)
+
+        self.scheduler = None
+        self.finished = False
+        self.started = 0
+        self.in_flight = 0
+        self.counts = {'written': 0, 'failed': 0, 'skipped': 0}
+
+    def load(self, article_store, estimates, rebuild=False):
+        """
+        Reads the site's keywords and queues the ones without an article yet.
+        """
+        self.article_store = article_store
+        done = set() if rebuild else article_store.done_keywords(self.name, self.config.get('languages'))
+        rows = KeywordRows(self.input_file, done)
+        self.scheduler = Scheduler(rows, self.config, estimates, done)
+        self.counts['skipped'] = rows.skipped
+        self.module.prepare_batch(self.scheduler.keywords())
+
+    def share(self, clients):
+        """
+        Hands the site's script the API clients of earlier sites with the
+        same keys, and makes every site's provider pool keep one rate limit
+        state, so a key that is limited for one site sits out for all.
+        """
+        pool = getattr(self.module, 'provider_pool', None)
+        if pool is not None:
+            for backend in pool.backends:
+                backend.client = clients.setdefault((backend.name, backend.key), backend.client)
+            first_pool = clients.setdefault('provider_pool', pool)
+            if first_pool is not pool:
+                pool.share_limits(first_pool)
+            return
+        key = ('openai', self.config.get('OPENAI_API_TOKEN'))
+        if not hasattr(self.module, 'init_assistant') or not key[1]:
+            return
+        # The script creates its Assistant on the site's first keyword, so a
+        # site whose files or Assistant fail only fails its own keywords
+        if key not in clients:
+            import openai
+            clients[key] = openai.OpenAI(api_key=key[1])
+        self.module.client = clients[key]
+
+
+class MultiSiteRunner:
+    """
+    Writes the articles of many sites through one worker pool, one pacer
+    per run and one build cache, so the API limits rather than the number of
+    processes bound throughput. Sites take turns in proportion to their
+    weight, each one's keywords go most valuable first, and every site keeps
+    its own article store.
+    """
+
+    def __init__(self, run_config, base_dir='.'):
+        self.config = run_config
+        self.sites = [Site(index, entry, run_config, base_dir)
+                      for index, entry in enumerate(run_config['sites'])]
+        # The site scripts configure metrics and the cassette when loaded, so set them for the run afterwards
+        metrics.configure(run_config)
+        cassette.install(run_config)
+        self.workers = run_config.get('article_workers', 10)
+        self.estimates = load_estimates(run_config)
+        self.pacer = Pacer(self.estimates.start_interval(run_config.get('provider_requests_per_minute')))
+        self.build_cache = BuildCache.from_config(run_config)
+        self.stores = {}
+
+    def store(self, path):
+        # Sites that share an article store file share its connection
+        path = os.path.abspath(path)
+        if path not in self.stores:
+            self.stores[path] = ArticleStore(path)
+        return self.stores[path]
+
+    def next_site(self):
+        """
+        The site with keywords left that has had the fewest starts for its
+        weight, or None when every site is done.
+        """
+        waiting = [site for site in self.sites if not site.finished and len(site.scheduler)]
+        if not waiting:
+            return None
+        return min(waiting, key=lambda site: (site.started / site.weight, site.in_flight))
+
+    def write(self, site, row):
+        return site.module.write_article(site.article_store, site.name, row)
+
+    def run(self, rebuild=False):
+        start = time.time()
+        clients = {}
+        for site in self.sites:
+            site.module.build_cache = self.build_cache
+            site.load(self.store(site.config['article_store']), self.estimates, rebuild)
+            site.scheduler.pacer = self.pacer
+            site.share(clients)
+        total = sum(len(site.scheduler) for site in self.sites)
+        print(f"{len(self.sites)} sites, {total} keywords to write with {self.workers} workers.")
+
+        in_flight = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while True:
+                    while len(in_flight) < self.workers:
+                        site = self.next_site()
+                        if site is None:
+                            break
+                        row = site.scheduler.pop()
+                        if row is None:
+                            site.finished = True  # Its budget is used up
+                            continue
+                        site.started += 1
+                        site.in_flight += 1
+                        in_flight[executor.submit(self.write, site, row)] = site
+                    if not in_flight:
+                        break
+                    done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        site = in_flight.pop(future)
+                        site.in_flight -= 1
+                        try:
+                            ok = future.result()['Processed'] == 'Yes'
+                        except Exception as exc:
+                            print(f"An article for {site.name} failed: {exc}")
+                            ok = False
+                        site.counts['written' if ok else 'failed'] += 1
+            except KeyboardInterrupt:
+                # Running keywords stop at their next check and store what they have
+                print("Cancelling the run...")
+                deadline.cancel_all()
+                raise
+
+        for store in self.stores.values():
+            store.close()
+        self.print_summary(time.time() - start)
+
+    def print_summary(self, seconds):
+        print("{:<30} {:>8} {:>8} {:>8}".format('Site', 'Written', 'Failed', 'Skipped'))
+        for site in self.sites:
+            print("{:<30} {:>8} {:>8} {:>8}".format(
+                site.name[:30], site.counts['written'], site.counts['failed'], site.counts['skipped']))
+        written = sum(site.counts['written'] for site in self.sites)
+        print(f"Wrote {written} articles for {len(self.sites)} sites in {seconds:.0f}s "
+              f"({written / max(seconds, 1e-9) * 3600:.0f} articles/hour).")
+        if self.build_cache is not None:
+            self.build_cache.print_report()
+
+
+if __name__ == "__main__":
+    # python multi_site.py [sites.json] [--rebuild]
+    args = [arg for arg in sys.argv[1:] if arg != '--rebuild']
+    sites_file = args[0] if args else 'sites.json'
+    with open(sites_file) as f_input:
+        run_config = json.load(f_input)
+    MultiSiteRunner(run_config, os.path.dirname(os.path.abspath(sites_file))).run('--rebuild' in sys.argv)
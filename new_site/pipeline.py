@@ -0,0 +1,145 @@
+import concurrent.futures
+import csv
+import importlib
+import sys
+import threading
+import time
+
+import deadline
+from article_store import ArticleStore, ARTICLE_STORE, site_name
+from csv_stream import KeywordRows
+from keyword_metrics import rank_keyword_export
+from prompt_builder import content_text
+
+# The stage scripts start with a digit, so they are imported by name.
+# Each one loads config.json and sets up its clients once, here; the
+# article script is configured explicitly.
+keywords_stage = importlib.import_module('1_get_keywords')
+images_stage = importlib.import_module('2_get_images')
+articles_stage = importlib.import_module('3_get_articles')
+articles_stage.configure(articles_stage.load_config())
+format_stage = importlib.import_module('4_format_articles')
+
+config = articles_stage.config
+
+
+class Pipeline:
+    """
+    Runs stages 1-4 in one process. Every keyword moves on to image fetching
+    as soon as its shard returns, and to article writing as soon as its
+    images are in, so the first articles are done while keywords are
+    still being generated. Finished articles are stored, formatted and
+    appended to {output_file} one by one, after those of earlier runs.
+    """
+
+    def __init__(self, output_file='formatted_articles.csv'):
+        self.start_time = time.time()
+        self.first_article = None
+        self.article_store = ArticleStore(config.get('article_store', ARTICLE_STORE))
+        self.site = site_name(config)
+        self.done = self.article_store.done_keywords(self.site, config.get('languages'))
+        self.seen = set()
+        self.counts = {'keywords': 0, 'articles': 0, 'failed': 0}
+        self._lock = threading.Lock()
+
+        self.images = concurrent.futures.ThreadPoolExecutor(max_workers=config.get('image_workers', 4))
+        self.articles = concurrent.futures.ThreadPoolExecutor(max_workers=config.get('article_workers', 5))
+        self.image_futures = []
+
+        # Earlier runs skip the keywords they wrote, so their articles are kept
+        self.output = open(output_file, 'a', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.output)
+        if not self.output.tell():
+            self.writer.writerow(['Keyword', 'Markdown', 'HTML', 'Language'])
+
+    def add_keywords(self, rows):
+        """
+        Queues keyword rows (dicts with a Keyword column) for images and
+        articles, skipping ones seen before or already written.
+        """
+        for row in rows:
+            Keyword = row['Keyword']
+            with self._lock:
+                if Keyword in self.done or Keyword in self.seen:
+                    continue
+                self.seen.add(Keyword)
+                self.counts['keywords'] += 1
+            articles_stage.batch_status.add(1)
+            self.image_futures.append(self.images.submit(self.fetch_images, row))
+
+    def fetch_images(self, row):
+        try:
+            image_urls = images_stage.get_images(row['Keyword'])
+            # The Assistant is given brandimages.txt when the first article starts
+            images_stage.images_file.flush()
+        except Exception as exc:
+            print(f"Images for {row['Keyword']} failed, writing the article without them: {exc}")
+            image_urls = []
+        return self.articles.submit(self.write_article, row, image_urls)
+
+    def write_article(self, row, image_urls):
+        processed_row = articles_stage.write_article(self.article_store, self.site, row, image_urls)
+        if processed_row['Processed'] != 'Yes':
+            with self._lock:
+                self.counts['failed'] += 1
+            return
+        # Every language's article, as stored, since a finished one from an earlier run is kept
+        articles = [self.article_store.get(self.site, row['Keyword'], language)
+                    for language in config.get('languages') or ['']]
+        formatted = format_stage.format_chunk(
+            [(row['Keyword'], content_text(article['Article']), article['Language'])
+             for article in articles if article])
+        with self._lock:
+            self.writer.writerows(formatted)
+            self.output.flush()
+            self.counts['articles'] += 1
+            if self.first_article is None:
+                self.first_article = time.time() - self.start_time
+                print(f"First article finished after {self.first_article:.0f}s: {row['Keyword']}")
+
+    def generate_keywords(self, keyword_file=None):
+        """
+        Streams keywords from {keyword_file}, a ranked keyword metric export
+        or 1_get_keywords.py, in that order of preference.
+        """
+        metrics_file = config.get('keyword_metrics_file')
+        if not keyword_file and metrics_file:
+            rank_keyword_export(metrics_file, keywords_stage.output_file, config)
+            keyword_file = keywords_stage.output_file
+        if keyword_file:
+            self.add_keywords(KeywordRows(keyword_file))
+        else:
+            keywords_stage.process_keywords(
+                on_keywords=lambda keywords: self.add_keywords([{'Keyword': k} for k in keywords]))
+
+    def run(self, keyword_file=None):
+        if self.done:
+            print(f"Skipping {len(self.done)} keywords that are already processed.")
+        articles_stage.prepare_batch()
+        try:
+            self.generate_keywords(keyword_file)
+        except KeyboardInterrupt:
+            # Running keywords stop at their next check and store what they have
+            print("Cancelling the pipeline...")
+            deadline.cancel_all()
+            raise
+        finally:
+            # Every image job hands its keyword to the article pool, so wait for those first
+            self.images.shutdown(wait=True)
+            images_stage.images_file.close()
+            article_futures = [future.result() for future in self.image_futures]
+            concurrent.futures.wait(article_futures)
+            self.articles.shutdown(wait=True)
+            self.output.close()
+            self.article_store.close()
+
+        print(f"Pipeline wrote {self.counts['articles']} articles for {self.counts['keywords']} keywords "
+              f"({self.counts['failed']} failed) in {time.time() - self.start_time:.0f}s.")
+        articles_stage.usage_report.print_summary()
+        if articles_stage.build_cache is not None:
+            articles_stage.build_cache.print_report()
+
+
+if __name__ == "__main__":
+    # An existing keyword CSV skips keyword generation
+    Pipeline().run(sys.argv[1] if len(sys.argv) > 1 else None)
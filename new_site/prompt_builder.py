@@ -0,0 +1,116 @@
+import hashlib
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+# Rough characters per token when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def research_text(research_results):
+    """
+    Reduces a Perplexity chat completion response to its answer text.
+    Args:
+        research_results (dict or None): The JSON returned by perplexity_research.
+    Returns:
+        str: The answer content, or an empty string if there is none.
+    """
+    if not research_results:
+        return ""
+    try:
+        return research_results['choices'][0]['message']['content'].strip()
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
+def content_text(content):
+    """
+    Returns the plain text of an assistant reply, which is either a string or
+    the list of message content objects returned by the Assistants API.
+    """
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content.strip()
+    parts = []
+    for part in content:
+        text = getattr(part, 'text', None)
+        if text is not None:
+            parts.append(getattr(text, 'value', str(text)))
+    return "\n".join(parts).strip()
+
+
+def _truncate(text, max_tokens):
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Leave room for the truncation marker; without any, nothing of the block fits
+    max_tokens -= count_tokens(" [...]")
+    if max_tokens <= 0:
+        return ""
+    cut = max_tokens * CHARS_PER_TOKEN
+    while cut > 0 and count_tokens(text[:cut]) > max_tokens:
+        cut = int(cut * 0.9)
+    kept = text[:max(cut, 0)].rstrip()
+    return kept + " [...]" if kept else ""
+
+
+def build_prompt(stage, instructions, blocks, budget=None):
+    """
+    Assembles a stage prompt from its instructions and named context blocks.
+    Empty blocks and blocks repeating earlier content are dropped. When the
+    prompt exceeds {budget} tokens, blocks are truncated starting from the
+    last one, so blocks should be passed most important first.
+    Args:
+        stage (str): Stage name, used for logging.
+        instructions (str): The task; refers to blocks by their names.
+        blocks (list): (name, text) pairs.
+        budget (int or None): Maximum prompt tokens.
+    Returns:
+        str: The final prompt.
+    """
+    seen = set()
+    kept = []
+    for name, text in blocks:
+        text = (text or "").strip()
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        if not text or digest in seen:
+            continue
+        seen.add(digest)
+        kept.append([name, text])
+
+    def render():
+        sections = [instructions.strip()]
+        for name, text in kept:
+            sections.append(f"{name}:\n{text}")
+        return "\n\n".join(sections)
+
+    prompt = render()
+    tokens = count_tokens(prompt)
+    if budget:
+        for block in list(reversed(kept)):
+            if tokens <= budget:
+                break
+            block_tokens = count_tokens(block[1])
+            block[1] = _truncate(block[1], block_tokens - (tokens - budget))
+            if not block[1]:
+                kept.remove(block)
+            prompt = render()
+            tokens = count_tokens(prompt)
+
+    print(f"Built {stage} prompt: {tokens} tokens from {len(kept)} context blocks.")
+    return prompt
+
+
+def stage_budget(config, stage):
+    return config.get("prompt_token_budgets", {}).get(stage)
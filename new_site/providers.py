@@ -0,0 +1,402 @@
+import random
+import threading
+import time
+
+import requests
+
+import cassette
+import deadline
+import metrics
+from model_routing import stage_settings
+from structured import response_format
+
+PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
+FREEIMAGE_URL = 'https://freeimage.host/api/1/upload'
+
+# Client errors that can succeed on another try: request timeout, conflict, rate limit
+RETRYABLE_STATUS = (408, 409, 429)
+
+# Longest wait for one response, in seconds
+PERPLEXITY_TIMEOUT = 120
+COMPLETION_TIMEOUT = 600
+
+# Assistant files that file_search cannot index, which code_interpreter reads instead
+CODE_INTERPRETER_TYPES = ('.csv', '.tsv', '.xls', '.xlsx')
+
+
+def assistant_tool_resources(client, files, name, timeout=300):
+    """
+    The Assistants v2 tool_resources for uploaded {files}, a dict of
+    {path: file_id}. Spreadsheets go to code_interpreter and everything
+    else into a new vector store for file_search, which is waited on until
+    its files are indexed.
+    """
+    search_ids = [file_id for path, file_id in files.items() if not path.lower().endswith(CODE_INTERPRETER_TYPES)]
+    code_ids = [file_id for path, file_id in files.items() if path.lower().endswith(CODE_INTERPRETER_TYPES)]
+    resources = {}
+    if code_ids:
+        resources['code_interpreter'] = {'file_ids': code_ids}
+    if search_ids:
+        # Vector stores moved out of client.beta in later SDK versions
+        vector_stores = getattr(client, 'vector_stores', None) or client.beta.vector_stores
+        with metrics.track('openai', None, 'vector_store'):
+            store = vector_stores.create(name=name, file_ids=search_ids)
+            start = time.time()
+            while store.status == 'in_progress' and time.time() - start < timeout:
+                cassette.sleep(1)
+                store = vector_stores.retrieve(store.id)
+        print(f"Vector store {store.id} is {store.status}.")
+        resources['file_search'] = {'vector_store_ids': [store.id]}
+    return resources
+
+
+def retryable(status_code):
+    """
+    Whether a request that failed with {status_code} is worth another try.
+    Timeouts, rate limits and server errors are; other client errors, such
+    as 400 for a bad request or 401 and 403 for a bad key, would fail again.
+    A {status_code} of None is a connection error or timeout.
+    """
+    return status_code is None or status_code >= 500 or status_code in RETRYABLE_STATUS
+
+
+def perplexity_research(payload, api_key, build_cache=None, usage_report=None, max_retries=3, delay=5):
+    """
+    Sends a research request to Perplexity with retries on failure.
+    Args:
+        payload (dict): The chat completion request, model and messages.
+        api_key (str): The Perplexity API key.
+        build_cache (BuildCache or None): Serves and stores results by payload.
+        usage_report (UsageReport or None): Also add the calls to this report.
+        max_retries (int): Maximum number of retries.
+        delay (int): Delay in seconds before retrying.
+    Returns:
+        dict or None: The response from the API or None if failed.
+    """
+    headers = {
+        "accept": "application/json",
+        "content-type": "application/json",
+        "authorization": f"Bearer {api_key}",
+    }
+
+    if build_cache is not None:
+        cached = build_cache.get('research', payload)
+        if cached is not None:
+            print("Perplexity research reused from the build cache.")
+            return cached
+
+    for attempt in range(max_retries):
+        timeout = deadline.timeout(PERPLEXITY_TIMEOUT, 'research')
+        try:
+            with metrics.track('perplexity', payload['model'], 'research',
+                               retries=attempt, report=usage_report) as call:
+                response = requests.post(PERPLEXITY_URL, json=payload, headers=headers, verify=False,
+                                         timeout=timeout)
+                call['status'] = response.status_code
+                call['rate_limit'] = metrics.rate_limits(response.headers)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            print(f"Perplexity research failed: {exc}. Attempt {attempt + 1} of {max_retries}.")
+            deadline.sleep(delay)
+            continue
+        if response.status_code == 200:
+            print("Perplexity research completed successfully.")
+            try:
+                result = response.json()
+            except ValueError:
+                print("JSON decoding failed")
+                return None
+            if build_cache is not None:
+                build_cache.put('research', payload, result)
+            return result
+        elif not retryable(response.status_code):
+            print(f"Perplexity research failed with status code: {response.status_code}, not retrying.")
+            return None
+        else:
+            print(
+                f"Perplexity research failed with status code: {response.status_code}. Attempt {attempt + 1} of {max_retries}.")
+            deadline.sleep(delay)
+
+    print("Perplexity research failed after maximum retries.")
+    return None
+
+
+def upload_image(image_path, Keyword, api_key):
+    """
+    Uploads an image to Freeimage.host with {Keyword} in the filename.
+    Returns:
+        str or None: The image URL, None if the upload failed.
+    """
+    print(f"Uploading {image_path} to Freeimage.host...")
+    with open(image_path, 'rb') as image_file:
+        files = {'source': image_file}
+        data = {
+            'key': api_key,
+            'action': 'upload',
+            'format': 'json',
+            'name': f'{Keyword}_image.png'  # Add {Keyword} in the filename
+        }
+
+        with metrics.track('freeimage', None, 'image_upload') as call:
+            response = requests.post(FREEIMAGE_URL, files=files, data=data, verify=False)
+            call['status'] = response.status_code
+
+        if response.status_code == 200:
+            url = response.json().get('image', {}).get('url', '')
+            if url:
+                print(f"Uploaded successfully: {url}")
+                return url
+            print("Upload successful but no URL returned, something went wrong.")
+        else:
+            print(
+                f"Failed to upload to Freeimage.host: {response.status_code}, {response.text}")
+    return None
+
+
+class RateLimited(Exception):
+    """
+    A provider refused a request because of its rate limit.
+    """
+    status_code = 429
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderError(Exception):
+    """
+    A provider request failed. Only errors that are .retryable are tried
+    again.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    @property
+    def retryable(self):
+        return retryable(self.status_code)
+
+
+def retry_after(exc):
+    # Seconds from the Retry-After header of a failed response, if it has one
+    try:
+        return float(exc.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class AnthropicBackend:
+    name = 'anthropic'
+    stage_models = 'claude_stage_models'
+    default_model = 'claude-3-sonnet-20240229'
+
+    def __init__(self, api_key):
+        import anthropic  # Only needed when the batch uses Claude
+        self.sdk = anthropic
+        self.key = api_key
+        self.client = anthropic.Anthropic(api_key=api_key)
+
+    def complete(self, prompt, model, max_tokens, temperature, call, schema=None):
+        # No constrained output here, the prompt asks for {schema}
+        timeout = deadline.timeout(COMPLETION_TIMEOUT, call['stage'])
+        try:
+            raw_response = self.client.messages.with_raw_response.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens or 1000,
+                temperature=temperature,
+                timeout=timeout,
+            )
+        except self.sdk.RateLimitError as exc:
+            raise RateLimited(str(exc), retry_after(exc)) from exc
+        except (self.sdk.APIError, self.sdk.APIConnectionError, self.sdk.APITimeoutError) as exc:
+            raise ProviderError(str(exc), getattr(exc, 'status_code', None)) from exc
+        call['rate_limit'] = metrics.rate_limits(raw_response.headers)
+        response = raw_response.parse()
+        call['input_tokens'] = response.usage.input_tokens
+        call['output_tokens'] = response.usage.output_tokens
+        return response.content[0].text
+
+
+class OpenAIBackend:
+    name = 'openai'
+    stage_models = 'openai_stage_models'
+    default_model = 'gpt-4-turbo-preview'
+
+    def __init__(self, api_key):
+        import openai  # Only needed when the batch uses OpenAI
+        self.sdk = openai
+        self.key = api_key
+        self.client = openai.OpenAI(api_key=api_key)
+
+    def complete(self, prompt, model, max_tokens, temperature, call, schema=None):
+        request = {'model': model, 'messages': [{"role": "user", "content": prompt}], 'temperature': temperature,
+                   'timeout': deadline.timeout(COMPLETION_TIMEOUT, call['stage'])}
+        if max_tokens:
+            request['max_tokens'] = max_tokens
+        output_format = response_format(call['stage'], schema, model) if schema else None
+        if output_format:
+            request['response_format'] = output_format
+        try:
+            raw_response = self.client.chat.completions.with_raw_response.create(**request)
+        except self.sdk.RateLimitError as exc:
+            raise RateLimited(str(exc), retry_after(exc)) from exc
+        except (self.sdk.APIError, self.sdk.APIConnectionError, self.sdk.APITimeoutError) as exc:
+            raise ProviderError(str(exc), getattr(exc, 'status_code', None)) from exc
+        call['rate_limit'] = metrics.rate_limits(raw_response.headers)
+        response = raw_response.parse()
+        call['input_tokens'] = response.usage.prompt_tokens
+        call['output_tokens'] = response.usage.completion_tokens
+        return response.choices[0].message.content
+
+
+# LLM backends by name, as used in "provider_weights"
+BACKENDS = {
+    'anthropic': lambda config: AnthropicBackend(config['ANTHROPIC_API_KEY']),
+    'openai': lambda config: OpenAIBackend(config['OPENAI_API_TOKEN']),
+}
+
+
+class ProviderPool:
+    """
+    Prompt completions spread over several LLM providers in proportion to
+    their weights. A provider that is rate limited sits out until its limit
+    resets and the others take its share, so a batch gets the sum of the
+    providers' limits instead of stalling on one of them.
+
+    Every backend takes a prompt and returns the reply text, so any
+    provider in BACKENDS can answer any stage, with the model and
+    max_tokens from its own "<provider>_stage_models".
+    """
+
+    def __init__(self, backends, weights, config, cooldown=60):
+        self.backends = backends
+        self.weights = weights
+        self.config = config
+        self.cooldown = cooldown
+        self.calls = {backend.name: 0 for backend in backends}
+        self.failovers = 0
+        # When each provider key is back from its rate limit, shared between
+        # pools by share_limits()
+        self._resume = {(backend.name, backend.key): 0.0 for backend in backends}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, default_weights):
+        """
+        The providers in config["provider_weights"], {default_weights}
+        when it is not set.
+        """
+        weights = config.get('provider_weights') or default_weights
+        for name in weights:
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown provider in provider_weights: {name}")
+        backends = [BACKENDS[name](config) for name, weight in weights.items() if weight]
+        if not backends:
+            raise ValueError("provider_weights gives no provider a weight.")
+        return cls(backends, weights, config, config.get('provider_cooldown_seconds', 60))
+
+    def settings(self, stage, max_tokens=None):
+        """
+        (provider, model, max_tokens) of {stage} for every provider, part of
+        the build cache key of a reply.
+        """
+        return [[backend.name, *stage_settings(
+            self.config, backend.stage_models, stage, backend.default_model, max_tokens)]
+            for backend in self.backends]
+
+    def pick(self, exclude=()):
+        """
+        The provider furthest behind its share of the calls, among those not
+        rate limited and not in {exclude}. None if there is none.
+        """
+        with self._lock:
+            now = time.time()
+            ready = [backend for backend in self.backends
+                     if backend.name not in exclude and self._resume[(backend.name, backend.key)] <= now]
+            if not ready:
+                return None
+            backend = min(ready, key=lambda backend: self.calls[backend.name] / self.weights[backend.name])
+            self.calls[backend.name] += 1
+            return backend
+
+    def rest(self, backend, seconds):
+        with self._lock:
+            limit_key = (backend.name, backend.key)
+            self._resume[limit_key] = max(self._resume[limit_key], time.time() + seconds)
+            self.failovers += 1
+
+    def wait_time(self):
+        # Seconds until the first rate limited provider is back
+        with self._lock:
+            resume = min(self._resume[(backend.name, backend.key)] for backend in self.backends)
+            return max(resume - time.time(), 0.0)
+
+    def share_limits(self, other):
+        """
+        Makes this pool keep its rate limits in {other}'s state, so a
+        provider key limited in one pool sits out in both.
+        """
+        with other._lock:
+            for limit_key, resume in self._resume.items():
+                other._resume[limit_key] = max(other._resume.get(limit_key, 0.0), resume)
+        self._resume = other._resume
+        self._lock = other._lock
+
+    def complete(self, prompt, stage, max_tokens=None, temperature=0.7, usage_report=None, max_retries=5,
+                 schema=None):
+        """
+        The reply to {prompt} from the next provider in turn. Rate limited
+        providers are skipped until their limit resets; other errors are
+        retried on another provider when there is one, with backoff. With
+        "structured_output" set, providers that support it constrain the
+        reply to {schema}.
+        """
+        if not self.config.get('structured_output'):
+            schema = None
+        tried = set()
+        for attempt in range(max_retries):
+            deadline.check(stage)
+            backend = self.pick(tried)
+            if backend is None:
+                tried.clear()
+                wait_time = self.wait_time()
+                if wait_time:
+                    print(f"Every provider is rate limited. Waiting {wait_time:.0f} seconds...")
+                    deadline.sleep(wait_time)
+                backend = self.pick()
+                if backend is None:
+                    continue
+            model, stage_max_tokens = stage_settings(
+                self.config, backend.stage_models, stage, backend.default_model, max_tokens)
+            try:
+                with metrics.track(backend.name, model, stage, retries=attempt, report=usage_report) as call:
+                    return backend.complete(prompt, model, stage_max_tokens, temperature, call, schema)
+            except RateLimited as exc:
+                tried.add(backend.name)
+                self.rest(backend, exc.retry_after or self.cooldown)
+                print(f"{backend.name} is rate limited, moving {stage} to another provider.")
+            except ProviderError as exc:
+                if not exc.retryable:
+                    print(f"API error occurred on {backend.name}: {exc}. Not retrying.")
+                    raise
+                if attempt == max_retries - 1:
+                    raise
+                tried.add(backend.name)
+                if len(tried) < len(self.backends):
+                    print(f"API error occurred on {backend.name}: {exc}. Trying another provider...")
+                    continue
+                tried.clear()
+                wait_time = (2 ** attempt) + random.uniform(0, 1)
+                print(f"API error occurred on {backend.name}: {exc}. Retrying in {wait_time:.2f} seconds...")
+                deadline.sleep(wait_time)
+
+        raise Exception("Max retries reached. Unable to complete the request.")
+
+    def report(self):
+        calls = ', '.join(f"{name} {count}" for name, count in self.calls.items())
+        return f"Provider calls: {calls} ({self.failovers} rate limit failovers)."
+
+    def print_report(self):
+        print(self.report())
@@ -0,0 +1,257 @@
+import heapq
+import itertools
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import cassette
+import metrics
+from csv_stream import KeywordRows
+
+# Priority given to urgent keywords, above any score
+URGENT_PRIORITY = 1e18
+
+# Column of the keyword CSV holding each keyword's value, e.g. "Score" or "Volume"
+PRIORITY_COLUMN = 'Score'
+
+
+def keyword_priority(row, column=PRIORITY_COLUMN):
+    """
+    The value of {row}'s priority column as a number, 0 when it is missing.
+    Rows with a truthy "Urgent" column come before everything else.
+    """
+    if str(row.get('Urgent') or '').strip().lower() in ('1', 'yes', 'true', 'y'):
+        return URGENT_PRIORITY
+    try:
+        value = float(str(row.get(column) or '').replace(',', '').replace('$', ''))
+    except ValueError:
+        return 0.0
+    return value if math.isfinite(value) else 0.0
+
+
+def read_urgent(path):
+    """
+    Keywords listed one per line in {path}, in file order.
+    """
+    if not path or not os.path.isfile(path):
+        return []
+    with open(path, encoding='utf-8') as f_input:
+        return [line.strip() for line in f_input if line.strip()]
+
+
+class Estimates:
+    """
+    Average cost, wall time and API calls per provider of one article,
+    from the keywords in a metrics log that got an article written.
+    """
+
+    def __init__(self, articles=0, seconds=None, cost=None, calls=None):
+        self.articles = articles
+        self.seconds = seconds
+        self.cost = cost
+        self.calls = calls or {}
+
+    @classmethod
+    def from_metrics(cls, path, prices):
+        if not path or not os.path.isfile(path):
+            return cls()
+        # Per keyword: call seconds, cost, calls per provider and articles written.
+        # Calls for one article run one after another, so their seconds add up.
+        keywords = {}
+        for record in metrics.read_records(path):
+            if not record.get('keyword'):
+                continue
+            keyword = keywords.setdefault(record['keyword'], {'seconds': 0.0, 'cost': 0.0, 'calls': {}, 'articles': 0})
+            keyword['seconds'] += record['seconds']
+            keyword['cost'] += metrics.call_cost(record, prices)
+            keyword['calls'][record['provider']] = keyword['calls'].get(record['provider'], 0) + 1
+            if record['stage'] == 'article' and record['status'] == 200:
+                keyword['articles'] += 1
+
+        written = [keyword for keyword in keywords.values() if keyword['articles']]
+        articles = sum(keyword['articles'] for keyword in written)
+        if not articles:
+            return cls()
+        calls = {}
+        for keyword in written:
+            for provider, count in keyword['calls'].items():
+                calls[provider] = calls.get(provider, 0) + count
+        return cls(articles,
+                   sum(keyword['seconds'] for keyword in written) / articles,
+                   sum(keyword['cost'] for keyword in written) / articles,
+                   {provider: count / articles for provider, count in calls.items()})
+
+    def start_interval(self, requests_per_minute):
+        """
+        Seconds between article starts that keeps every provider in
+        {requests_per_minute} at its limit. 0 when nothing limits the rate.
+        """
+        interval = 0.0
+        for provider, limit in (requests_per_minute or {}).items():
+            if limit and self.calls.get(provider):
+                interval = max(interval, self.calls[provider] * 60.0 / limit)
+        return interval
+
+
+class Pacer:
+    """
+    Spaces calls to wait() at least {interval} seconds apart across threads,
+    so article starts, and the API calls behind them, arrive evenly instead
+    of in bursts.
+    """
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, interval=None):
+        interval = self.interval if interval is None else interval
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + interval
+        if start > now:
+            cassette.sleep(start - now)
+
+
+class Scheduler:
+    """
+    Hands out keyword rows highest priority first, paced so no provider in
+    config["provider_requests_per_minute"] is pushed past its limit.
+    Keywords written to config["urgent_keywords_file"] while the batch runs
+    jump ahead of everything still waiting, whether or not they were in
+    the batch. With config["batch_budget_usd"] set, only the most valuable
+    keywords that fit the estimated cost are handed out.
+    """
+
+    def __init__(self, rows, config, estimates=None, done=()):
+        self.column = config.get('priority_column', PRIORITY_COLUMN)
+        self.urgent_file = config.get('urgent_keywords_file')
+        self.estimates = estimates or Estimates()
+        self.pacer = Pacer(self.estimates.start_interval(config.get('provider_requests_per_minute')))
+        self.workers = config.get('article_workers', 5)
+        self.limit = None
+        budget = config.get('batch_budget_usd')
+        if budget and self.estimates.cost:
+            self.limit = int(budget // self.estimates.cost)
+
+        self._heap = []
+        self._entries = {}
+        self._waiting = 0
+        self._counter = itertools.count()
+        self._urgent_mtime = None
+        self._done = set(done)
+        self._lock = threading.Lock()
+        self.handed_out = 0
+        # Urgent keywords that were not in {rows}
+        self.added = 0
+        for row in rows:
+            self.push(row, keyword_priority(row, self.column))
+
+    def push(self, row, priority):
+        # A keyword pushed again keeps only its newest entry
+        with self._lock:
+            old = self._entries.get(row['Keyword'])
+            if old is not None and old[-1] is not None:
+                old[-1] = None
+            else:
+                self._waiting += 1
+            entry = [-priority, next(self._counter), row]
+            self._entries[row['Keyword']] = entry
+            heapq.heappush(self._heap, entry)
+
+    def check_urgent(self):
+        """
+        Moves keywords from the urgent file to the front, once per change of the file.
+        """
+        if not self.urgent_file or not os.path.isfile(self.urgent_file):
+            return
+        mtime = os.path.getmtime(self.urgent_file)
+        if mtime == self._urgent_mtime:
+            return
+        self._urgent_mtime = mtime
+        for Keyword in read_urgent(self.urgent_file):
+            entry = self._entries.get(Keyword)
+            if Keyword in self._done or (entry is not None and entry[-1] is None):
+                continue  # Already written or handed out
+            row = entry[-1] if entry is not None else {'Keyword': Keyword}
+            if entry is None or entry[0] > -URGENT_PRIORITY:
+                print(f"Urgent keyword moved to the front: {Keyword}")
+                self.push(row, URGENT_PRIORITY)
+                if entry is None:
+                    self.added += 1
+
+    def pop(self):
+        """
+        Waits for the next start slot and returns the most valuable row
+        left, or None when the batch (or its budget) is used up.
+        """
+        self.check_urgent()
+        with self._lock:
+            row = None
+            while self._heap and row is None:
+                entry = heapq.heappop(self._heap)
+                row = entry[-1]
+                entry[-1] = None
+            if row is not None:
+                self._waiting -= 1
+            urgent = row is not None and -entry[0] >= URGENT_PRIORITY
+            if row is None or (self.limit is not None and self.handed_out >= self.limit and not urgent):
+                return None
+            self.handed_out += 1
+        self.pacer.wait()
+        return row
+
+    def __len__(self):
+        return self._waiting
+
+    def keywords(self):
+        """
+        The keywords waiting to be handed out, in the order they were added.
+        """
+        with self._lock:
+            return [Keyword for Keyword, entry in self._entries.items() if entry[-1] is not None]
+
+    def plan(self):
+        """
+        One line with the estimated cost, duration and pacing of the batch.
+        """
+        count = len(self)
+        if self.limit is not None and self.limit < count:
+            print(f"batch_budget_usd covers {self.limit} of {count} keywords, the most valuable run first.")
+            count = self.limit
+        if not self.estimates.articles:
+            return f"{count} keywords to write, no past metrics to estimate cost or time from."
+        seconds = max(count * self.estimates.seconds / max(self.workers, 1), count * self.pacer.interval)
+        pacing = f", one article started every {self.pacer.interval:.1f}s" if self.pacer.interval else ''
+        return (f"{count} keywords to write, estimated ${count * self.estimates.cost:.2f} and "
+                f"{seconds / 60:.0f} min ({self.estimates.seconds:.0f}s and ${self.estimates.cost:.4f} "
+                f"per article over {self.estimates.articles} past articles{pacing}).")
+
+
+def load_estimates(config):
+    prices = {model: tuple(price) for model, price in config.get('model_prices', {}).items()}
+    return Estimates.from_metrics(config.get('metrics_log', metrics.METRICS_LOG), prices)
+
+
+def main(argv):
+    # Prints the order and estimates for a keyword CSV without running anything
+    with open('config.json') as config_file:
+        config = json.load(config_file)
+    input_file = argv[1] if len(argv) > 1 else 'optimized_keywords.csv'
+    scheduler = Scheduler(KeywordRows(input_file), config, load_estimates(config))
+    print(scheduler.plan())
+    scheduler.pacer.interval = 0
+    for position in range(1, 11):
+        row = scheduler.pop()
+        if row is None:
+            break
+        print(f"{position:>3}. {row['Keyword']} ({row.get(scheduler.column, '-')})")
+
+
+if __name__ == "__main__":
+    main(sys.argv)